@@ -13,6 +13,19 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": os.path.join(_PATH, "example.sqlite"),
+        # File-backed so that the concurrency tests can use threads.
+        "TEST_NAME": os.path.join(_PATH, "test_example.sqlite"),
+    },
+    # Shards of the sharding tests, see friends.routers.
+    "shard0": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.path.join(_PATH, "shard0.sqlite"),
+        "TEST_NAME": os.path.join(_PATH, "test_shard0.sqlite"),
+    },
+    "shard1": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.path.join(_PATH, "shard1.sqlite"),
+        "TEST_NAME": os.path.join(_PATH, "test_shard1.sqlite"),
     },
 }
 
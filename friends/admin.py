@@ -1,12 +1,127 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.contrib.auth.models import User
 from django.utils.translation import ugettext_lazy as _
-from models import FriendshipRequest, Friendship, UserBlocks
+from models import FriendshipRequest, Friendship, FriendshipEdge, UserBlocks, \
+                   SharedBlocklist
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator counting unfiltered querysets on PostgreSQL with the row
+    estimate of the table statistics, instead of a ``COUNT(*)`` scanning the
+    whole table, once they have more than :attr:`threshold` rows.
+    """
+
+    threshold = 10000
+
+    def _get_count(self):
+        if self._count is None:
+            self._count = self._estimate()
+        return super(EstimatedCountPaginator, self)._get_count()
+    count = property(_get_count)
+
+    def _estimate(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is None or query.where or query.having or query.distinct:
+            return None
+        connection = connections[self.object_list.db]
+        if connection.vendor != 'postgresql':
+            return None
+        cursor = connection.cursor()
+        cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                       [query.model._meta.db_table])
+        row = cursor.fetchone()
+        if row is None or row[0] < self.threshold:
+            return None
+        return int(row[0])
+
+
+class SummaryChangeList(ChangeList):
+    def get_results(self, request):
+        super(SummaryChangeList, self).get_results(request)
+        self.model_admin.summarize(list(self.result_list),
+                                   self.result_list.db)
+
+
+class SummaryAdmin(admin.ModelAdmin):
+    """
+    Base class of the admins listing a count and a summary of the users
+    related to each row.
+
+    The count is selected along with the rows by a subquery, so the page is
+    a single query, and the summaries of all the rows of a page are read
+    with one ``UNION ALL`` query, see :meth:`summarize`.
+    """
+
+    list_select_related = True
+    paginator = EstimatedCountPaginator
+    summary_size = 7
+    count_attr = summary_attr = None
+    count_sql = summary_sql = None
+
+    def get_changelist(self, request, **kwargs):
+        return SummaryChangeList
+
+    def queryset(self, request):
+        queryset = super(SummaryAdmin, self).queryset(request)
+        return queryset.extra(select={
+            self.count_attr: self.count_sql.format(**self.names(queryset.db)),
+        })
+
+    def names(self, using):
+        qn = connections[using].ops.quote_name
+        edges = FriendshipEdge._meta
+        blocks = UserBlocks.blocks.through._meta
+        return {
+            'edges': qn(edges.db_table),
+            'edge_id': qn(edges.pk.column),
+            'from': qn(edges.get_field('from_friendship').column),
+            'to': qn(edges.get_field('to_friendship').column),
+            'friendship': qn(Friendship._meta.db_table),
+            'friendship_id': qn(Friendship._meta.pk.column),
+            'user': qn(Friendship._meta.get_field('user').column),
+            'blocks': qn(blocks.db_table),
+            'block_id': qn(blocks.pk.column),
+            'userblocks': qn(blocks.get_field('userblocks').column),
+            'blocked': qn(blocks.get_field('user').column),
+            'user_blocks': qn(UserBlocks._meta.db_table),
+            'user_blocks_id': qn(UserBlocks._meta.pk.column),
+            'users': qn(User._meta.db_table),
+            'user_id': qn(User._meta.pk.column),
+            'username': qn(User._meta.get_field('username').column),
+        }
+
+    def summarize(self, objs, using):
+        """
+        Set the :attr:`summary_attr` of ``objs`` to the usernames of their
+        first :attr:`summary_size` related users.
+        """
+        if not objs:
+            return
+        sql = 'SELECT * FROM (%s LIMIT %d) t' % (
+            self.summary_sql.format(**self.names(using)),
+            self.summary_size)
+        cursor = connections[using].cursor()
+        cursor.execute(' UNION ALL '.join(sql + str(i)
+                                          for i in xrange(len(objs))),
+                       [obj.pk for obj in objs])
+        names = dict((obj.pk, []) for obj in objs)
+        for pk, username in cursor.fetchall():
+            names[pk].append(username)
+        for obj in objs:
+            setattr(obj, self.summary_attr, names[obj.pk])
 
 
 class FriendshipRequestAdmin(admin.ModelAdmin):
     date_hierarchy = 'created'
     list_display = ('from_user', 'to_user', 'accepted', 'created')
     list_filter = ('accepted',)
+    list_select_related = True
+    raw_id_fields = ('from_user', 'to_user')
+    paginator = EstimatedCountPaginator
     actions = ('accept_friendship', 'decline_friendship', 'cancel_friendship')
 
     def accept_friendship(self, request, queryset):
@@ -29,11 +144,36 @@ class FriendshipRequestAdmin(admin.ModelAdmin):
 admin.site.register(FriendshipRequest, FriendshipRequestAdmin)
 
 
-class FriendshipAdmin(admin.ModelAdmin):
+class FriendshipAdmin(SummaryAdmin):
     list_display = ('user', 'friend_count', 'friend_summary')
+    raw_id_fields = ('user',)
+    count_attr = '_friend_count'
+    summary_attr = '_friend_names'
+    count_sql = ('SELECT COUNT(*) FROM {edges} e '
+                 'WHERE e.{from} = {friendship}.{friendship_id}')
+    summary_sql = ('SELECT e.{from}, u.{username} FROM {edges} e '
+                   'INNER JOIN {friendship} f ON f.{friendship_id} = e.{to} '
+                   'INNER JOIN {users} u ON u.{user_id} = f.{user} '
+                   'WHERE e.{from} = %s ORDER BY e.{edge_id}')
 admin.site.register(Friendship, FriendshipAdmin)
 
 
-class UserBlocksAdmin(admin.ModelAdmin):
+class UserBlocksAdmin(SummaryAdmin):
     list_display = ('user', 'block_count', 'block_summary')
+    raw_id_fields = ('user', 'blocks')
+    count_attr = '_block_count'
+    summary_attr = '_block_names'
+    count_sql = ('SELECT COUNT(*) FROM {blocks} b '
+                 'WHERE b.{userblocks} = {user_blocks}.{user_blocks_id}')
+    summary_sql = ('SELECT b.{userblocks}, u.{username} FROM {blocks} b '
+                   'INNER JOIN {users} u ON u.{user_id} = b.{blocked} '
+                   'WHERE b.{userblocks} = %s ORDER BY b.{block_id}')
 admin.site.register(UserBlocks, UserBlocksAdmin)
+
+
+class SharedBlocklistAdmin(admin.ModelAdmin):
+    list_display = ('name', 'owner', 'created')
+    list_select_related = True
+    raw_id_fields = ('owner', 'entries', 'subscribers')
+    search_fields = ('name',)
+admin.site.register(SharedBlocklist, SharedBlocklistAdmin)
@@ -9,3 +9,63 @@ REDIRECT_FALLBACK_TO_PROFILE = getattr(settings,
 # each user. This setting controls the batch size on the bulk creation of those
 # records when that process runs.
 FRIENDS_SYNCDB_BATCH_SIZE = getattr(settings, 'FRIENDS_SYNCDB_BATCH_SIZE', 999)
+
+# Number of rows fetched per query while streaming relationship exports.
+EXPORT_CHUNK_SIZE = getattr(settings, 'FRIENDS_EXPORT_CHUNK_SIZE', 1000)
+
+# Database alias that stores this app's models and receives its writes, and
+# the aliases of its read replicas. See friends.routers.
+DATABASE = getattr(settings, 'FRIENDS_DATABASE', 'default')
+READ_DATABASES = tuple(getattr(settings, 'FRIENDS_READ_DATABASES', ()))
+
+# Database aliases the relationships are sharded over by user id, see
+# friends.routers. Empty to store them all in FRIENDS_DATABASE.
+SHARDS = tuple(getattr(settings, 'FRIENDS_SHARDS', ()))
+
+# Seconds a user's reads stick to FRIENDS_DATABASE after a relationship of
+# theirs is modified, so that replication lag doesn't show stale data.
+READ_STICKINESS = getattr(settings, 'FRIENDS_READ_STICKINESS', 5)
+
+# Read-only graph snapshot used to answer are_friends() and friend_ids(), and
+# how often (in seconds) it is checked for being rebuilt. See friends.snapshot.
+SNAPSHOT_PATH = getattr(settings, 'FRIENDS_SNAPSHOT_PATH', None)
+SNAPSHOT_RELOAD_INTERVAL = getattr(settings,
+                                   'FRIENDS_SNAPSHOT_RELOAD_INTERVAL', 10)
+
+# Longest time in seconds between the recording of a FriendshipChange and the
+# commit of its transaction. Change ids are handed out before commit, so the
+# sequence numbers of snapshots only cover the changes older than this.
+CHANGE_COMMIT_LAG = getattr(settings, 'FRIENDS_CHANGE_COMMIT_LAG', 60)
+
+# Users with at least this many friends have their friends' usernames cached
+# for search_friends(). Set to None to always search in the database.
+SEARCH_CACHE_MIN_FRIENDS = getattr(settings,
+                                   'FRIENDS_SEARCH_CACHE_MIN_FRIENDS', 500)
+SEARCH_CACHE_TIMEOUT = getattr(settings, 'FRIENDS_SEARCH_CACHE_TIMEOUT',
+                               60 * 60)
+SEARCH_MAX_RESULTS = getattr(settings, 'FRIENDS_SEARCH_MAX_RESULTS', 50)
+
+# Rate limits of the action views keyed by BaseActionView.throttle_scope, e.g.
+# {'request': '20/m'}. See friends.throttling.
+THROTTLE_RATES = getattr(settings, 'FRIENDS_THROTTLE_RATES', {})
+
+# Maximum number of changes a delta sync applies, clients that are further
+# behind get a full snapshot instead. See friends.sync.
+SYNC_MAX_CHANGES = getattr(settings, 'FRIENDS_SYNC_MAX_CHANGES', 10000)
+
+# Users with at least this many friends get a Bloom filter of their friends in
+# the cache, answering most negative are_friends() without a query. Set to
+# None to disable. See friends.bloom.
+BLOOM_MIN_FRIENDS = getattr(settings, 'FRIENDS_BLOOM_MIN_FRIENDS', None)
+BLOOM_ERROR_RATE = getattr(settings, 'FRIENDS_BLOOM_ERROR_RATE', 0.01)
+BLOOM_TIMEOUT = getattr(settings, 'FRIENDS_BLOOM_TIMEOUT', 24 * 60 * 60)
+# Largest pickled filter stored in the cache, below the item size limit of
+# memcached. Users whose filter is larger go without one.
+BLOOM_MAX_BYTES = getattr(settings, 'FRIENDS_BLOOM_MAX_BYTES', 1000000)
+# Seconds friends added to a filter survive its rebuilds, which must be longer
+# than the transactions making friendships.
+BLOOM_RECENT_SECONDS = getattr(settings, 'FRIENDS_BLOOM_RECENT_SECONDS', 60)
+# Rebuild missing and stale filters in a background thread when they are
+# read, otherwise only the friends_rebuild_blooms management command does.
+BLOOM_REBUILD_THREADS = getattr(settings, 'FRIENDS_BLOOM_REBUILD_THREADS',
+                                True)
@@ -0,0 +1,125 @@
+"""
+Backfill
+========
+
+Creation of the :class:`~friends.models.Friendship` and
+:class:`~friends.models.UserBlocks` rows of users that were created before
+this app was installed, or while its signal handlers were not connected. See
+the ``friends_backfill`` management command, which is also what ``syncdb``
+runs.
+
+Users are processed in ranges of primary keys found with a keyset scan of the
+user table, each range needs a single anti-join per model and its rows are
+created in one transaction. Rows created concurrently, for example by the
+``post_save`` handler of a new user, are skipped, so a backfill can run
+while the site is up and can be interrupted and restarted at any range.
+
+.. autofunction:: user_ranges
+
+.. autofunction:: backfill_range
+
+.. autofunction:: backfill
+"""
+
+
+from multiprocessing import Pool
+from django.contrib.auth.models import User
+from django.db import IntegrityError, connections, transaction
+from models import Friendship, UserBlocks
+from routers import write_database
+from utils import key_ranges
+
+
+MODELS = (
+    (Friendship, 'friendship__isnull'),
+    (UserBlocks, 'user_blocks__isnull'),
+)
+RETRIES = 3
+
+
+def user_ranges(chunk_size, start_after=0, using=None):
+    """
+    Yield ``(low, high)`` tuples such that each of the ranges
+    ``low < pk <= high`` holds ``chunk_size`` users, except the last one.
+
+    :param |int| chunk_size: Number of users per range.
+    :param |int| start_after: Optional. Primary key of the user to start
+                              after.
+    :param using: Optional. Database alias of the user table.
+    """
+    return key_ranges(User.objects.using(using).values_list('pk', flat=True),
+                      chunk_size, start_after)
+
+
+def backfill_range(low, high, using=None):
+    """
+    Create the missing rows of the users with ``low < pk <= high``.
+
+    :param using: Optional. Database alias, defaults to
+                  :func:`~friends.routers.write_database`.
+    :returns: Number of rows created.
+    :rtype: |int|
+    """
+    using = using or write_database()
+    created = 0
+    for model, lookup in MODELS:
+        for attempt in range(RETRIES):
+            user_ids = list(User.objects.using(using).filter(
+                pk__gt=low,
+                pk__lte=high,
+                **{lookup: True}
+            ).values_list('pk', flat=True))
+            if not user_ids:
+                break
+            try:
+                with transaction.commit_on_success(using=using):
+                    model.objects.using(using).bulk_create([
+                        model(user_id=user_id) for user_id in user_ids
+                    ])
+            except IntegrityError:
+                # Some rows were created concurrently, look for the missing
+                # ones again.
+                if attempt == RETRIES - 1:
+                    raise
+            else:
+                created += len(user_ids)
+                break
+    return created
+
+
+def backfill(chunk_size, start_after=0, processes=1, using=None):
+    """
+    Create the missing rows of all the users.
+
+    Yields a ``(high, created)`` tuple after each range is done, in order of
+    the ranges, so ``high`` can be saved and passed as ``start_after`` to
+    resume an interrupted backfill.
+
+    :param |int| chunk_size: Number of users per range.
+    :param |int| start_after: Optional. Primary key of the user to start
+                              after.
+    :param |int| processes: Optional. Number of worker processes backfilling
+                            ranges.
+    :param using: Optional. Database alias.
+    """
+    using = using or write_database()
+    ranges = user_ranges(chunk_size, start_after, using)
+    if processes <= 1:
+        for low, high in ranges:
+            yield high, backfill_range(low, high, using)
+        return
+    # The workers must not share the connection of this process.
+    connections[using].close()
+    pool = Pool(processes)
+    try:
+        for result in pool.imap(_backfill_range, ((low, high, using)
+                                                  for low, high in ranges)):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _backfill_range(args):
+    low, high, using = args
+    return high, backfill_range(low, high, using)
@@ -0,0 +1,101 @@
+"""
+Block Lists
+===========
+
+Imports of block lists with thousands of entries, see the
+``friends_import_blocks`` management command.
+
+Usernames are resolved with one ``IN`` query per chunk and the blocks of each
+chunk are written with
+:meth:`~friends.models.UserBlocksManager.block_many`, one ``INSERT`` ignoring
+the existing rows per chunk, so the usernames can be streamed from a file in
+constant memory.
+
+Users can also subscribe to a :class:`~friends.models.SharedBlocklist`
+instead of copying it. Its entries are evaluated along with their own blocks
+by :meth:`~friends.models.UserBlocksManager.blocked_users`.
+
+.. autofunction:: resolve_usernames
+
+.. autofunction:: import_blocks
+
+.. autofunction:: import_entries
+"""
+
+
+from django.contrib.auth.models import User
+from models import UserBlocks, SharedBlocklist
+
+
+def resolve_usernames(usernames):
+    """
+    Return the ids of the users named ``usernames`` with a single query.
+
+    :param usernames: |list| of usernames, at most a few hundreds.
+    :returns: |dict| mapping the usernames found to user ids.
+    """
+    return dict(User.objects.filter(
+        username__in=usernames,
+    ).values_list('username', 'pk'))
+
+
+def import_blocks(user, usernames, unblock=False, chunk_size=500):
+    """
+    Block, or unblock, the users named ``usernames`` on behalf of ``user``.
+
+    :param user: Blocking user.
+    :type user: |User|
+    :param usernames: Iterable of usernames.
+    :param |bool| unblock: Optional. Default ``False``. Unblock the users
+                           instead.
+    :param |int| chunk_size: Optional. Number of usernames per query.
+    :returns: |dict| with the number of users whose block was ``modified``,
+              of those ``unchanged``, and the |list| of the ``missing``
+              usernames.
+    """
+    modify = UserBlocks.objects.unblock_many if unblock else \
+        UserBlocks.objects.block_many
+    return _import(lambda ids: len(modify(user, ids, chunk_size)),
+                   usernames, chunk_size)
+
+
+def import_entries(blocklist, usernames, remove=False, chunk_size=500):
+    """
+    Add, or remove, the users named ``usernames`` to the entries of
+    ``blocklist``.
+
+    :param blocklist: Block list.
+    :type blocklist: :class:`~friends.models.SharedBlocklist`
+    :param usernames: Iterable of usernames.
+    :param |bool| remove: Optional. Default ``False``. Remove the users
+                          instead.
+    :param |int| chunk_size: Optional. Number of usernames per query.
+    :returns: |dict| like :func:`import_blocks`.
+    """
+    modify = SharedBlocklist.objects.remove_entries if remove else \
+        SharedBlocklist.objects.add_entries
+    return _import(lambda ids: modify(blocklist, ids, chunk_size),
+                   usernames, chunk_size)
+
+
+def _import(modify, usernames, chunk_size):
+    counts = {'modified': 0, 'unchanged': 0, 'missing': []}
+    for chunk in _chunks(usernames, chunk_size):
+        ids = resolve_usernames(chunk)
+        modified = modify(ids.values())
+        counts['modified'] += modified
+        counts['unchanged'] += len(ids) - modified
+        counts['missing'].extend(username for username in chunk
+                                 if username not in ids)
+    return counts
+
+
+def _chunks(usernames, chunk_size):
+    chunk = []
+    for username in usernames:
+        chunk.append(username)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,324 @@
+"""
+Bloom Filters
+=============
+
+If ``FRIENDS_BLOOM_MIN_FRIENDS`` is set, users with at least that many
+friends get a Bloom filter of their friends' ids in the default cache, and
+:meth:`~friends.models.FriendshipManager.are_friends` answers ``False``
+without querying the database when the other user isn't in the filter of the
+first one. Positives are confirmed with the usual indexed query. A filter
+takes about 10 bits per friend for a false positive rate of 1%, see
+``FRIENDS_BLOOM_ERROR_RATE``, instead of a full set of ids. Users whose
+pickled filter would exceed ``FRIENDS_BLOOM_MAX_BYTES`` go without one until
+it expires, ``FRIENDS_BLOOM_TIMEOUT``, instead of being rebuilt on every read.
+
+:meth:`~friends.models.FriendshipManager.befriend` adds the new friend to the
+filters of both users, and
+:meth:`~friends.models.FriendshipManager.unfriend` marks them stale, as Bloom
+filters can't remove items. Missing and stale filters are rebuilt from the
+database in a background thread the next time they are read, or with the
+``friends_rebuild_blooms`` management command. A rebuild keeps the friends
+added during the last ``FRIENDS_BLOOM_RECENT_SECONDS``, which are recorded
+even when the user has no filter yet, so that a friendship committed after
+the rebuild read the database isn't lost.
+
+.. important::
+
+    Friendships made without
+    :meth:`~friends.models.FriendshipManager.befriend` must be followed by
+    :func:`added` for each user concerned, once committed, as the repairs of
+    the ``friends_check`` management command are.
+
+.. autoclass:: BloomFilter
+    :members:
+
+.. autofunction:: get_filter
+
+.. autofunction:: might_be_friends
+
+.. autofunction:: rebuild
+
+.. autofunction:: rebuild_all
+
+.. autofunction:: added
+
+.. autofunction:: removed
+
+.. autofunction:: invalidate
+"""
+
+
+import cPickle as pickle
+import hashlib
+import math
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Count
+import app_settings
+from models import Friendship, FriendshipEdge
+from routers import write_database
+from utils import key_ranges
+
+
+FILTER_KEY = 'friends.bloom.%s'
+STALE_KEY = 'friends.bloom.stale.%s'
+RECENT_KEY = 'friends.bloom.recent.%s'
+LOCK_KEY = 'friends.bloom.lock.%s'
+POISON_KEY = 'friends.bloom.poison.%s'
+SCHEDULED_KEY = 'friends.bloom.scheduled.%s'
+LOCK_TIMEOUT = 5
+LOCK_ATTEMPTS = 50
+# Share of its friends that can be added to a filter before it is rebuilt.
+HEADROOM = 0.1
+
+
+class BloomFilter(object):
+    """
+    Set of user ids answering membership tests with false positives, but no
+    false negatives.
+
+    :param |int| capacity: Number of ids after which the false positive rate
+                           exceeds ``error_rate``.
+    :param error_rate: False positive rate.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = max(capacity, 1)
+        self.size = int(math.ceil(-self.capacity * math.log(error_rate) /
+                                  math.log(2) ** 2))
+        self.hashes = max(int(round(self.size / float(self.capacity) *
+                                    math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, user_id):
+        # Double hashing, see Kirsch and Mitzenmacher, "Less Hashing, Same
+        # Performance".
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(str(user_id)).digest())
+        for i in xrange(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, user_id):
+        """
+        Add ``user_id`` to the filter.
+        """
+        for position in self._positions(user_id):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, user_id):
+        for position in self._positions(user_id):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+def get_filter(user):
+    """
+    Return the filter of ``user`` from the cache.
+
+    A rebuild is scheduled if the filter is missing or stale and
+    ``FRIENDS_BLOOM_REBUILD_THREADS`` is set.
+
+    :param user: |User| instance or user id.
+    :returns: :class:`BloomFilter`, or ``None`` if there is none or if
+              ``user`` has too few friends.
+    """
+    user_id = getattr(user, 'pk', user)
+    values = cache.get_many([FILTER_KEY % user_id, STALE_KEY % user_id])
+    bloom = values.get(FILTER_KEY % user_id)
+    if bloom is None or STALE_KEY % user_id in values:
+        _schedule(user_id)
+    return bloom or None
+
+
+def might_be_friends(user1, user2):
+    """
+    Return ``False`` if ``user1`` and ``user2`` are definitely not friends,
+    ``True`` if they may be.
+
+    :param user1: |User| instance or user id whose filter is used.
+    :param user2: |User| instance or user id.
+    :rtype: |bool|
+    """
+    if app_settings.BLOOM_MIN_FRIENDS is None:
+        return True
+    bloom = get_filter(user1)
+    return bloom is None or getattr(user2, 'pk', user2) in bloom
+
+
+def rebuild(user, using=None):
+    """
+    Rebuild the filter of ``user`` from the database.
+
+    :param user: |User| instance or user id.
+    :param using: Optional. Database alias, defaults to
+                  :func:`~friends.routers.write_database` so that replication
+                  lag doesn't lose friendships.
+    :returns: The new :class:`BloomFilter`, or ``None`` if ``user`` has too
+              few friends or too many.
+    """
+    user_id = getattr(user, 'pk', user)
+    cache.delete(STALE_KEY % user_id)
+    ids = list(FriendshipEdge.objects.using(
+        using or write_database(user_id),
+    ).filter(
+        from_friendship__user=user_id,
+    ).values_list('to_friendship__user', flat=True))
+    with _locked(user_id) as locked:
+        if not locked:
+            return None
+        # Friends added since the ids were read are only in the recent list.
+        ids = set(ids).union(
+            friend_id for time_added, friend_id
+            in _recent(cache.get(RECENT_KEY % user_id), time.time()))
+        bloom = False
+        if len(ids) >= app_settings.BLOOM_MIN_FRIENDS:
+            bloom = BloomFilter(int(len(ids) * (1 + HEADROOM)),
+                                app_settings.BLOOM_ERROR_RATE)
+            for friend_id in ids:
+                bloom.add(friend_id)
+            # Protocol 0, the default of python-memcached, is the largest.
+            if len(pickle.dumps(bloom, 0)) > app_settings.BLOOM_MAX_BYTES:
+                bloom = False
+        # False is stored for users without a filter so that it isn't
+        # rebuilt on every read.
+        _store(user_id, bloom)
+    return bloom or None
+
+
+def rebuild_all(chunk_size=10000, force=False, using=None):
+    """
+    Rebuild the missing and stale filters of the users with at least
+    ``FRIENDS_BLOOM_MIN_FRIENDS`` friends.
+
+    :param |int| chunk_size: Optional. Number of users scanned per query.
+    :param |bool| force: Optional. Default ``False``. Rebuild every filter.
+    :param using: Optional. Database alias, defaults to
+                  :func:`~friends.routers.write_database`.
+    :returns: Number of filters rebuilt.
+    """
+    using = using or write_database()
+    rebuilt = 0
+    for low, high in key_ranges(Friendship.objects.using(using).values_list(
+            'pk', flat=True), chunk_size):
+        user_ids = FriendshipEdge.objects.using(using).filter(
+            from_friendship__gt=low,
+            from_friendship__lte=high,
+        ).values('from_friendship__user').annotate(
+            friends=Count('pk'),
+        ).filter(
+            friends__gte=app_settings.BLOOM_MIN_FRIENDS,
+        ).values_list('from_friendship__user', flat=True)
+        for user_id in user_ids:
+            values = cache.get_many([FILTER_KEY % user_id,
+                                     STALE_KEY % user_id])
+            if force or FILTER_KEY % user_id not in values or \
+               STALE_KEY % user_id in values:
+                rebuild(user_id, using)
+                rebuilt += 1
+    return rebuilt
+
+
+def added(user, friend):
+    """
+    Add ``friend`` to the filter of ``user``, if it has one, and to the
+    friends recently added to ``user`` that rebuilds keep.
+    """
+    if app_settings.BLOOM_MIN_FRIENDS is None:
+        return
+    user_id = getattr(user, 'pk', user)
+    friend_id = getattr(friend, 'pk', friend)
+    with _locked(user_id) as locked:
+        if not locked:
+            return
+        now = time.time()
+        values = cache.get_many([FILTER_KEY % user_id, RECENT_KEY % user_id])
+        cache.set(RECENT_KEY % user_id,
+                  _recent(values.get(RECENT_KEY % user_id), now) +
+                  [(now, friend_id)],
+                  max(app_settings.BLOOM_RECENT_SECONDS, 1))
+        bloom = values.get(FILTER_KEY % user_id)
+        if not bloom:
+            return
+        bloom.add(friend_id)
+        if bloom.count > bloom.capacity:
+            cache.set(STALE_KEY % user_id, True,
+                      app_settings.BLOOM_TIMEOUT)
+        _store(user_id, bloom)
+
+
+def removed(user):
+    """
+    Mark the filter of ``user`` stale after the removal of a friend.
+    """
+    if app_settings.BLOOM_MIN_FRIENDS is None:
+        return
+    cache.set(STALE_KEY % getattr(user, 'pk', user), True,
+              app_settings.BLOOM_TIMEOUT)
+
+
+def invalidate(*users):
+    """
+    Delete the filters of ``users``.
+
+    :param users: |User| instances or user ids.
+    """
+    cache.delete_many([FILTER_KEY % getattr(user, 'pk', user)
+                       for user in users])
+
+
+@contextmanager
+def _locked(user_id):
+    """
+    Hold the lock on the filter of ``user_id``, yielding whether it was
+    taken.
+
+    If the lock can't be taken the filter is deleted instead, and poisoned
+    so that the holder of the lock doesn't store it again.
+    """
+    for attempt in xrange(LOCK_ATTEMPTS):
+        if cache.add(LOCK_KEY % user_id, True, LOCK_TIMEOUT):
+            try:
+                yield True
+            finally:
+                cache.delete(LOCK_KEY % user_id)
+            return
+        time.sleep(0.001)
+    cache.set(POISON_KEY % user_id, True, LOCK_TIMEOUT * 2)
+    invalidate(user_id)
+    yield False
+
+
+def _recent(recent, now):
+    since = now - app_settings.BLOOM_RECENT_SECONDS
+    return [(time_added, friend_id) for time_added, friend_id
+            in recent or () if time_added >= since]
+
+
+def _store(user_id, bloom):
+    cache.set(FILTER_KEY % user_id, bloom, app_settings.BLOOM_TIMEOUT)
+    if cache.get(POISON_KEY % user_id):
+        invalidate(user_id)
+
+
+def _schedule(user_id):
+    if not app_settings.BLOOM_REBUILD_THREADS or \
+       not cache.add(SCHEDULED_KEY % user_id, True, LOCK_TIMEOUT * 12):
+        return
+    thread = threading.Thread(target=_rebuild_thread, args=(user_id,))
+    thread.daemon = True
+    thread.start()
+
+
+def _rebuild_thread(user_id):
+    try:
+        rebuild(user_id)
+    finally:
+        cache.delete(SCHEDULED_KEY % user_id)
+        for connection in connections.all():
+            connection.close()
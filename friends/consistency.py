@@ -0,0 +1,246 @@
+"""
+Consistency
+===========
+
+Checks of the invariants of the relationship tables, see the
+``friends_check`` management command:
+
+``one_sided_edges``
+    A friendship is only stored in one direction. Repaired by adding the
+    missing direction, and to the :mod:`Bloom filter <friends.bloom>` of the
+    user concerned.
+
+``requests_between_friends``
+    A pending friendship request between users who are already friends.
+    Repaired by deleting the request.
+
+``complementary_requests``
+    Pending friendship requests in both directions between the same users,
+    which :meth:`~friends.models.FriendshipRequestManager.request_friendship`
+    never creates. Repaired by deleting the newer request.
+
+``missing_rows``
+    A |User| without :class:`~friends.models.Friendship` or
+    :class:`~friends.models.UserBlocks` record. Repaired as with the
+    ``friends_backfill`` management command.
+
+Each check scans its table in ranges of primary keys (see
+:func:`~friends.utils.key_ranges`) with a single set-based query per range,
+and each range is repaired in its own transaction, so checks can run against
+a live database.
+
+.. autofunction:: run_checks
+"""
+
+
+from django.contrib.auth.models import User
+from django.db import connections, transaction
+from models import Friendship, FriendshipEdge, FriendshipRequest, \
+                   FriendshipChange, UserBlocks
+from backfill import backfill_range
+import bloom
+from routers import write_database
+from utils import key_ranges
+
+
+class Check(object):
+    """
+    Base class of the checks.
+
+    :param using: Database alias.
+    """
+
+    name = None
+    model = None
+    sql = None
+    users = 2
+
+    def __init__(self, using):
+        self.using = using
+        self.connection = connections[using]
+        qn = self.connection.ops.quote_name
+        edges = FriendshipEdge._meta
+        requests = FriendshipRequest._meta
+        self.names = {
+            'edges': qn(edges.db_table),
+            'edge_id': qn(edges.pk.column),
+            'from': qn(edges.get_field('from_friendship').column),
+            'to': qn(edges.get_field('to_friendship').column),
+            'created': qn(edges.get_field('created').column),
+            'friendship': qn(Friendship._meta.db_table),
+            'friendship_id': qn(Friendship._meta.pk.column),
+            'user': qn(Friendship._meta.get_field('user').column),
+            'requests': qn(requests.db_table),
+            'request_id': qn(requests.pk.column),
+            'request_from': qn(requests.get_field('from_user').column),
+            'request_to': qn(requests.get_field('to_user').column),
+            'accepted': qn(requests.get_field('accepted').column),
+            'users': qn(User._meta.db_table),
+            'user_id': qn(User._meta.pk.column),
+            'user_blocks': qn(UserBlocks._meta.db_table),
+            'blocks_user': qn(UserBlocks._meta.get_field('user').column),
+        }
+
+    def ranges(self, chunk_size):
+        return key_ranges(self.model.objects.using(self.using).values_list(
+            'pk', flat=True), chunk_size)
+
+    def find(self, low, high):
+        """
+        Return the rows of the problems in the range, each starting with the
+        primary key scanned and the ids of the :attr:`users` concerned.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute(self.sql.format(**self.names), [low, high] +
+                       self.params())
+        return cursor.fetchall()
+
+    def params(self):
+        return []
+
+    def repair_range(self, low, high):
+        """
+        Repair the problems in the range and return their rows.
+        """
+        with transaction.commit_on_success(using=self.using):
+            rows = self.find(low, high)
+            if rows:
+                self.repair(rows)
+        if rows:
+            Friendship.objects._changed(*set(
+                user_id for row in rows for user_id in self.user_ids(row)))
+        return rows
+
+    def user_ids(self, row):
+        return row[1:1 + self.users]
+
+    def repair(self, rows):
+        raise NotImplementedError
+
+
+class OneSidedEdges(Check):
+    name = 'one_sided_edges'
+    model = FriendshipEdge
+    sql = ('SELECT e.{edge_id}, f1.{user}, f2.{user}, e.{from}, e.{to}, '
+           'e.{created} FROM {edges} e '
+           'INNER JOIN {friendship} f1 ON f1.{friendship_id} = e.{from} '
+           'INNER JOIN {friendship} f2 ON f2.{friendship_id} = e.{to} '
+           'WHERE e.{edge_id} > %s AND e.{edge_id} <= %s AND NOT EXISTS ('
+           'SELECT 1 FROM {edges} r '
+           'WHERE r.{from} = e.{to} AND r.{to} = e.{from})')
+
+    def repair_range(self, low, high):
+        rows = super(OneSidedEdges, self).repair_range(low, high)
+        for pk, user_id, friend_id, from_, to, created in rows:
+            bloom.added(friend_id, user_id)
+        return rows
+
+    def repair(self, rows):
+        FriendshipEdge.objects.using(self.using).bulk_create([
+            FriendshipEdge(from_friendship_id=to, to_friendship_id=from_,
+                           created=created)
+            for pk, user_id, friend_id, from_, to, created in rows
+        ])
+        FriendshipChange.objects.record_many([
+            (FriendshipChange.BEFRIEND, friend_id, user_id)
+            for pk, user_id, friend_id, from_, to, created in rows
+        ], self.using)
+
+
+class RequestsBetweenFriends(Check):
+    name = 'requests_between_friends'
+    model = FriendshipRequest
+    sql = ('SELECT r.{request_id}, r.{request_from}, r.{request_to} '
+           'FROM {requests} r '
+           'WHERE r.{request_id} > %s AND r.{request_id} <= %s '
+           'AND r.{accepted} = %s AND EXISTS ('
+           'SELECT 1 FROM {edges} e '
+           'INNER JOIN {friendship} f1 ON f1.{friendship_id} = e.{from} '
+           'INNER JOIN {friendship} f2 ON f2.{friendship_id} = e.{to} '
+           'WHERE f1.{user} = r.{request_from} '
+           'AND f2.{user} = r.{request_to})')
+
+    def params(self):
+        return [False]
+
+    def repair(self, rows):
+        FriendshipRequest.objects.using(self.using).filter(
+            pk__in=[row[0] for row in rows],
+        ).delete()
+        FriendshipChange.objects.record_many([
+            (FriendshipChange.CANCEL, from_user_id, to_user_id)
+            for pk, from_user_id, to_user_id in rows
+        ], self.using)
+
+
+class ComplementaryRequests(RequestsBetweenFriends):
+    name = 'complementary_requests'
+    sql = ('SELECT r.{request_id}, r.{request_from}, r.{request_to} '
+           'FROM {requests} r '
+           'WHERE r.{request_id} > %s AND r.{request_id} <= %s '
+           'AND r.{accepted} = %s AND EXISTS ('
+           'SELECT 1 FROM {requests} o '
+           'WHERE o.{request_from} = r.{request_to} '
+           'AND o.{request_to} = r.{request_from} '
+           'AND o.{accepted} = %s AND o.{request_id} < r.{request_id})')
+
+    def params(self):
+        return [False, False]
+
+
+class MissingRows(Check):
+    name = 'missing_rows'
+    model = User
+    users = 1
+    sql = ('SELECT u.{user_id}, u.{user_id} FROM {users} u '
+           'WHERE u.{user_id} > %s AND u.{user_id} <= %s AND ('
+           'NOT EXISTS (SELECT 1 FROM {friendship} f '
+           'WHERE f.{user} = u.{user_id}) OR '
+           'NOT EXISTS (SELECT 1 FROM {user_blocks} b '
+           'WHERE b.{blocks_user} = u.{user_id}))')
+
+    def repair_range(self, low, high):
+        rows = self.find(low, high)
+        if rows:
+            backfill_range(low, high, self.using)
+        return rows
+
+
+CHECKS = (OneSidedEdges, RequestsBetweenFriends, ComplementaryRequests,
+          MissingRows)
+
+
+def run_checks(chunk_size=10000, repair=False, samples=10, using=None,
+               names=None):
+    """
+    Run the checks and optionally repair the problems found.
+
+    :param |int| chunk_size: Optional. Number of rows scanned per query.
+    :param |bool| repair: Optional. Default ``False``. Repair the problems.
+    :param |int| samples: Optional. Maximum number of samples per check.
+    :param using: Optional. Database alias, defaults to
+                  :func:`~friends.routers.write_database`.
+    :param names: Optional. Names of the checks to run, all by default.
+    :returns: |dict| mapping the name of each check to a |dict| with the
+              ``count`` of problems, ``samples`` of the user ids concerned
+              and whether they were ``repaired``.
+    """
+    using = using or write_database()
+    results = {}
+    for check in CHECKS:
+        if names is not None and check.name not in names:
+            continue
+        check = check(using)
+        result = results[check.name] = {'count': 0, 'samples': [],
+                                        'repaired': repair}
+        for low, high in check.ranges(chunk_size):
+            if repair:
+                rows = check.repair_range(low, high)
+            else:
+                rows = check.find(low, high)
+            result['count'] += len(rows)
+            result['samples'].extend(
+                check.user_ids(row)
+                for row in rows[:samples - len(result['samples'])]
+            )
+    return results
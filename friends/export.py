@@ -0,0 +1,171 @@
+"""
+Export
+======
+
+Streaming export of a user's relationship data, suitable for data portability
+requests and partner synchronization. Rows are fetched in chunks using
+:func:`~friends.utils.keyset_iterator`, so exporting a user with hundreds of
+thousands of friends uses constant memory and output starts immediately.
+
+Every record has the following fields:
+
+``type``
+    One of ``'friend'``, ``'request_sent'``, ``'request_received'`` or
+    ``'block'``.
+
+``user_id``, ``username``
+    The other |User| of the relationship.
+
+``created``
+    When the friendship or the friendship request was made, empty for blocks.
+
+``message``, ``accepted``
+    Only meaningful for friendship requests, empty otherwise.
+
+.. autofunction:: export_records
+
+.. autofunction:: export_relationships
+"""
+
+
+import csv
+import json
+from django.db import connections, transaction
+from models import FriendshipRequest, FriendshipEdge, UserBlocks
+from routers import read_database
+from utils import keyset_iterator
+from app_settings import EXPORT_CHUNK_SIZE
+
+
+EXPORT_FIELDS = ('type', 'user_id', 'username', 'message', 'created',
+                 'accepted')
+
+
+def export_records(user, chunk_size=None, using=None):
+    """
+    Yield a |dict| for each friend, friendship request and block of ``user``.
+
+    :param user: User whose relationships are exported.
+    :type user: |User|
+    :param |int| chunk_size: Optional. Number of rows fetched per query.
+                             Defaults to ``FRIENDS_EXPORT_CHUNK_SIZE``.
+    :param using: Optional. Database alias to read from, defaults to
+                  :func:`~friends.routers.read_database`.
+
+    If the connection to ``using`` is closed when the iteration starts, as it
+    is for a streamed response body, all the rows are read in a single
+    transaction and the connection is closed at the end. The records are
+    consistent if the isolation level of the database is at least
+    ``REPEATABLE READ``.
+    """
+    chunk_size = chunk_size or EXPORT_CHUNK_SIZE
+    using = using or read_database(user)
+    connection = connections[using]
+    if connection.connection is not None:
+        # Read in the caller's connection and transaction.
+        for record in _records(user, chunk_size, using):
+            yield record
+        return
+    # Streamed responses are iterated after request_finished closed the
+    # connections, read everything in one transaction of our own and close
+    # the connection we opened when done.
+    transaction.enter_transaction_management(managed=True, using=using)
+    try:
+        for record in _records(user, chunk_size, using):
+            yield record
+    finally:
+        transaction.rollback(using=using)
+        transaction.leave_transaction_management(using=using)
+        connection.close()
+
+
+def _records(user, chunk_size, using):
+    friends = FriendshipEdge.objects.using(using).filter(
+        from_friendship__user=user,
+    ).values_list('pk', 'to_friendship__user__pk',
+                  'to_friendship__user__username', 'created')
+    for pk, user_id, username, created in keyset_iterator(friends,
+                                                          chunk_size):
+        yield _record('friend', user_id, username, created=created.isoformat())
+    for record_type, direction, other in (('request_sent', 'from_user',
+                                           'to_user'),
+                                          ('request_received', 'to_user',
+                                           'from_user')):
+        requests = FriendshipRequest.objects.using(using).filter(
+            **{direction: user}
+        ).values_list('pk', other + '__pk', other + '__username', 'message',
+                      'created', 'accepted')
+        for pk, user_id, username, message, created, accepted in \
+                keyset_iterator(requests, chunk_size):
+            yield _record(record_type, user_id, username, message,
+                          created.isoformat(), accepted)
+    blocks = UserBlocks.blocks.through.objects.using(using).filter(
+        userblocks__user=user,
+    ).values_list('pk', 'user__pk', 'user__username')
+    for pk, user_id, username in keyset_iterator(blocks, chunk_size):
+        yield _record('block', user_id, username)
+
+
+def export_relationships(user, format='jsonl', chunk_size=None):
+    """
+    Yield the relationships of ``user`` serialized line by line.
+
+    :param user: User whose relationships are exported.
+    :type user: |User|
+    :param format: Optional. Default ``'jsonl'``. Either ``'jsonl'`` for
+                   one JSON object per line or ``'csv'`` for comma separated
+                   values with a header row.
+    :param |int| chunk_size: Optional. Number of rows fetched per query.
+    :returns: Iterator over UTF-8 encoded lines.
+    """
+    records = export_records(user, chunk_size)
+    if format == 'jsonl':
+        return (json.dumps(record) + '\n' for record in records)
+    elif format == 'csv':
+        return _csv_lines(records)
+    raise ValueError('Unknown export format: %r' % format)
+
+
+def _csv_lines(records):
+    line = _LineBuffer()
+    writer = csv.writer(line)
+    writer.writerow(EXPORT_FIELDS)
+    yield line.pop()
+    for record in records:
+        writer.writerow([_encode(record[field]) for field in EXPORT_FIELDS])
+        yield line.pop()
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _record(record_type, user_id, username, message=u'', created=None,
+            accepted=None):
+    return {
+        'type': record_type,
+        'user_id': user_id,
+        'username': username,
+        'message': message,
+        'created': created,
+        'accepted': accepted,
+    }
+
+
+class _LineBuffer(object):
+    """
+    Minimal file-like object that lets :func:`csv.writer` produce one line at
+    a time.
+    """
+
+    def __init__(self):
+        self.value = ''
+
+    def write(self, value):
+        self.value += value
+
+    def pop(self):
+        value, self.value = self.value, ''
+        return value
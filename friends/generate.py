@@ -0,0 +1,230 @@
+"""
+Synthetic graphs
+================
+
+Generation of realistic test data for profiling and capacity planning, see
+the ``friends_generate`` management command.
+
+Friendships follow the Chung-Lu model: every user gets an expected degree
+drawn from a power law, and a fraction of its friendships are made within its
+community (a block of consecutive users) while the others are made across the
+whole graph. Each
+user only draws friends with a higher index, from cumulative weights with
+:func:`~bisect.bisect_left`, so edges are generated as a stream in memory
+proportional to the number of users. The same seed always generates the
+same graph.
+
+.. autofunction:: generate_graph
+
+.. autofunction:: write_graph
+"""
+
+
+import datetime
+import random
+from array import array
+from bisect import bisect_left
+from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.db import connections, transaction
+from models import Friendship, FriendshipEdge, FriendshipRequest, UserBlocks
+from routers import write_database
+
+
+def generate_graph(users, seed=None, exponent=2.5, min_degree=2,
+                   max_degree=None, community_size=100, intra=0.8,
+                   requests=0.1, blocks=0.02):
+    """
+    Generate the relationships of ``users`` users, identified by their index.
+
+    :param |int| users: Number of users.
+    :param seed: Optional. Seed of the random generator.
+    :param exponent: Optional. Default ``2.5``. Exponent of the power law of
+                     the degrees.
+    :param |int| min_degree: Optional. Default ``2``. Minimum expected degree.
+    :param |int| max_degree: Optional. Maximum expected degree, defaults to
+                             the square root of ``users`` times 10.
+    :param |int| community_size: Optional. Default ``100``. Number of users
+                                 per community.
+    :param intra: Optional. Default ``0.8``. Fraction of the friendships
+                  made within communities.
+    :param requests: Optional. Default ``0.1``. Average number of pending
+                     friendship requests sent per user.
+    :param blocks: Optional. Default ``0.02``. Average number of blocks
+                   per user.
+    :returns: ``(edges, requests, blocks)`` tuple of an iterator over
+              ``(user, friend)`` pairs, with ``user < friend``, and lists of
+              ``(from_user, to_user)`` and ``(user, blocked_user)`` pairs.
+    """
+    rng = random.Random(seed)
+    if max_degree is None:
+        max_degree = int(users ** 0.5 * 10)
+    max_degree = min(max_degree, users - 1)
+    weights = array('d', (
+        min(min_degree * (1.0 - rng.random()) ** (-1.0 / (exponent - 1)),
+            max_degree)
+        for i in xrange(users)
+    ))
+    cumulative = array('d', weights)
+    for i in xrange(1, users):
+        cumulative[i] += cumulative[i - 1]
+    pairs = set()
+    request_pairs = _pick_pairs(rng, users, cumulative, community_size,
+                                int(users * requests), pairs)
+    block_pairs = _pick_pairs(rng, users, cumulative, community_size,
+                              int(users * blocks), pairs)
+    edges = _edges(rng, users, weights, cumulative, community_size, intra,
+                   pairs)
+    return edges, request_pairs, block_pairs
+
+
+def _pick_pairs(rng, users, cumulative, community_size, count, pairs):
+    # Popular users receive more requests and blocks. Each pair of users is
+    # only used once, so that there are no complementary requests and
+    # requests or blocks between friends.
+    picked = []
+    for attempt in xrange(count * 10):
+        if len(picked) == count:
+            break
+        user = rng.randrange(users)
+        if rng.random() < 0.5:
+            start = user - user % community_size
+            end = min(start + community_size, users) - 1
+        else:
+            start, end = 0, users - 1
+        other = _pick(rng, cumulative, start, end)
+        pair = (min(user, other), max(user, other))
+        if user != other and pair not in pairs:
+            pairs.add(pair)
+            picked.append((user, other))
+    return picked
+
+
+def _pick(rng, cumulative, start, end):
+    """
+    Pick an index in ``start..end`` with a probability proportional to its
+    weight.
+    """
+    low = cumulative[start - 1] if start else 0.0
+    target = low + rng.random() * (cumulative[end] - low)
+    return min(bisect_left(cumulative, target, start, end + 1), end)
+
+
+def _edges(rng, users, weights, cumulative, community_size, intra, pairs):
+    total = cumulative[-1] if users else 0.0
+    for user in xrange(users):
+        start = user - user % community_size
+        end = min(start + community_size, users) - 1
+        community = cumulative[end] - (cumulative[start - 1] if start else 0.0)
+        friends = set()
+        for fraction, last, last_weight in ((intra, end, community),
+                                            (1 - intra, users - 1, total)):
+            if last <= user:
+                continue
+            expected = fraction * weights[user] * \
+                (cumulative[last] - cumulative[user]) / last_weight
+            count = len(friends) + min(
+                int(expected) + (rng.random() < expected % 1),
+                last - user,
+            )
+            for attempt in xrange(count * 2):
+                if len(friends) >= count:
+                    break
+                friends.add(_pick(rng, cumulative, user + 1, last))
+        for friend in sorted(friends):
+            if (user, friend) not in pairs:
+                yield user, friend
+
+
+def write_graph(users, edges, requests, blocks, prefix='user', seed=None,
+                chunk_size=10000, using=None):
+    """
+    Create ``users`` users and the relationships generated by
+    :func:`generate_graph` with chunked ``bulk_create()``\ s.
+
+    Primary keys are assigned after the largest existing ones, so that
+    existing data is kept, and the sequences of the tables are reset
+    afterwards. Users are named ``prefix`` followed by their primary key.
+
+    :param seed: Optional. Seed of the random creation times.
+    :param |int| chunk_size: Optional. Number of rows per ``INSERT``.
+    :param using: Optional. Database alias.
+    :returns: |dict| with the number of rows created per model.
+    """
+    using = using or write_database()
+    rng = random.Random(seed)
+    now = datetime.datetime.now()
+    through = UserBlocks.blocks.through
+    starts = dict((model, _next_pk(model, using)) for model in (
+        User, Friendship, UserBlocks, FriendshipEdge, FriendshipRequest,
+        through,
+    ))
+    user_pk, friendship_pk = starts[User], starts[Friendship]
+
+    def created():
+        return now - datetime.timedelta(seconds=rng.randrange(365 * 86400))
+
+    def friendship_edges():
+        for user, friend in edges:
+            time = created()
+            yield user, friend, time
+            yield friend, user, time
+
+    counts = {}
+    rows = (
+        (User, (User(pk=user_pk + i,
+                     username='%s%d' % (prefix, user_pk + i),
+                     password='!', date_joined=now, last_login=now)
+                for i in xrange(users))),
+        (Friendship, (Friendship(pk=friendship_pk + i, user_id=user_pk + i)
+                      for i in xrange(users))),
+        (UserBlocks, (UserBlocks(pk=starts[UserBlocks] + i,
+                                 user_id=user_pk + i)
+                      for i in xrange(users))),
+        (FriendshipEdge, (FriendshipEdge(pk=starts[FriendshipEdge] + i,
+                                         from_friendship_id=friendship_pk + u,
+                                         to_friendship_id=friendship_pk + v,
+                                         created=time)
+                          for i, (u, v, time)
+                          in enumerate(friendship_edges()))),
+        (FriendshipRequest, (FriendshipRequest(
+            pk=starts[FriendshipRequest] + i,
+            from_user_id=user_pk + u,
+            to_user_id=user_pk + v,
+            created=created(),
+        ) for i, (u, v) in enumerate(requests))),
+        (through, (through(pk=starts[through] + i,
+                           userblocks_id=starts[UserBlocks] + u,
+                           user_id=user_pk + v)
+                   for i, (u, v) in enumerate(blocks))),
+    )
+    for model, objs in rows:
+        counts[model.__name__] = 0
+        chunk = []
+        for obj in objs:
+            chunk.append(obj)
+            if len(chunk) == chunk_size:
+                counts[model.__name__] += _insert(model, chunk, using)
+                chunk = []
+        counts[model.__name__] += _insert(model, chunk, using)
+    connection = connections[using]
+    with transaction.commit_on_success(using=using):
+        cursor = connection.cursor()
+        for sql in connection.ops.sequence_reset_sql(no_style(),
+                                                     starts.keys()):
+            cursor.execute(sql)
+        transaction.set_dirty(using=using)
+    return counts
+
+
+def _next_pk(model, using):
+    pk = model.objects.using(using).order_by('-pk').values_list(
+        'pk', flat=True)[:1]
+    return pk[0] + 1 if pk else 1
+
+
+def _insert(model, chunk, using):
+    if chunk:
+        with transaction.commit_on_success(using=using):
+            model.objects.using(using).bulk_create(chunk)
+    return len(chunk)
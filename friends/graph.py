@@ -0,0 +1,419 @@
+"""
+Graph Analytics
+===============
+
+Offline statistics of the friendship graph. The ``Friendship.friends`` through
+table is streamed once, without instantiating any models, into compact integer
+arrays in `CSR <https://en.wikipedia.org/wiki/Sparse_matrix>`_ layout:
+
+- ``nodes`` holds the sorted user ids that have at least one friend,
+- ``indptr[i]:indptr[i + 1]`` is the slice of ``indices`` containing the
+  (sorted) node indexes of the friends of ``nodes[i]``.
+
+Friendships stored in one direction only (see :mod:`friends.consistency`)
+are loaded in both directions.
+
+`NumPy <http://www.numpy.org/>`_ is used to build the arrays, to compute
+the degree histogram and the connected components and to count the
+triangles if it is installed, which is strongly recommended for graphs with
+more than a few million edges. See the ``friends_graph_stats`` management
+command.
+
+.. autoclass:: CSRGraph
+    :members:
+
+.. autofunction:: iter_edges
+
+.. autofunction:: load_graph
+
+.. autofunction:: degree_histogram
+
+.. autofunction:: top_degree
+
+.. autofunction:: connected_components
+
+.. autofunction:: triangle_counts
+
+.. autofunction:: clustering
+"""
+
+
+import heapq
+from array import array
+from itertools import izip
+from multiprocessing import Pool
+from django.db import connections
+from models import Friendship, FriendshipEdge
+from routers import read_database
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def iter_edges(chunk_size=100000, using=None):
+    """
+    Yield lists of ``(user_id, friend_id)`` tuples, one list per chunk.
+
+    Each friendship appears twice, once in each direction, as it is stored.
+    Rows are read with keyset pagination on the through table's primary key.
+
+    :param |int| chunk_size: Optional. Number of rows fetched per query.
+    :param using: Optional. Database alias, defaults to
+                  :func:`~friends.routers.read_database`.
+    """
+    for rows in _edge_rows(chunk_size, using):
+        yield [(user_id, friend_id) for edge_id, user_id, friend_id in rows]
+
+
+def _edge_rows(chunk_size, using):
+    # Chunks of raw ``(edge_id, user_id, friend_id)`` rows.
+    connection = connections[using or read_database()]
+    qn = connection.ops.quote_name
+    through = FriendshipEdge._meta
+    sql = ('SELECT e.{id}, f1.{user}, f2.{user} FROM {edges} e '
+           'INNER JOIN {friendship} f1 ON f1.{pk} = e.{from_} '
+           'INNER JOIN {friendship} f2 ON f2.{pk} = e.{to} '
+           'WHERE e.{id} > %s ORDER BY e.{id} LIMIT %s').format(
+        id=qn(through.pk.column),
+        user=qn(Friendship._meta.get_field('user').column),
+        pk=qn(Friendship._meta.pk.column),
+        edges=qn(through.db_table),
+        friendship=qn(Friendship._meta.db_table),
+        from_=qn(through.get_field('from_friendship').column),
+        to=qn(through.get_field('to_friendship').column),
+    )
+    cursor = connection.cursor()
+    last = 0
+    while True:
+        cursor.execute(sql, [last, chunk_size])
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        last = rows[-1][0]
+        yield rows
+        if len(rows) < chunk_size:
+            break
+
+
+class CSRGraph(object):
+    """
+    Undirected graph in compressed sparse row layout.
+
+    :param nodes: Sorted user ids.
+    :param indptr: Row offsets into ``indices``, ``len(nodes) + 1`` items.
+    :param indices: Node indexes of the neighbours, sorted within each row.
+    """
+
+    def __init__(self, nodes, indptr, indices):
+        self.nodes = nodes
+        self.indptr = indptr
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def edge_count(self):
+        """
+        Number of undirected edges.
+        """
+        return len(self.indices) // 2
+
+    def degree(self, node):
+        """
+        Return the number of neighbours of the node at index ``node``.
+        """
+        return self.indptr[node + 1] - self.indptr[node]
+
+    def neighbours(self, node):
+        """
+        Return the node indexes of the neighbours of the node at index
+        ``node``.
+        """
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+
+def load_graph(chunk_size=100000, using=None):
+    """
+    Stream the friendship graph into a :class:`CSRGraph`.
+
+    :param |int| chunk_size: Optional. Number of rows fetched per query.
+    :param using: Optional. Database alias.
+    :rtype: :class:`CSRGraph`
+    """
+    if numpy is not None:
+        sources, targets = [], []
+        for rows in _edge_rows(chunk_size, using):
+            rows = numpy.array(rows, dtype=numpy.int_)
+            sources.append(rows[:, 1])
+            targets.append(rows[:, 2])
+        if not sources:
+            return CSRGraph(array('l'), array('l', [0]), array('l'))
+        return _build_numpy(numpy.concatenate(sources),
+                            numpy.concatenate(targets))
+    sources, targets = array('l'), array('l')
+    for rows in _edge_rows(chunk_size, using):
+        edge_ids, user_ids, friend_ids = zip(*rows)
+        sources.extend(user_ids)
+        targets.extend(friend_ids)
+    return _build_array(sources, targets)
+
+
+def _build_numpy(sources, targets):
+    nodes = numpy.unique(numpy.concatenate((sources, targets)))
+    if not len(nodes):
+        return CSRGraph(array('l'), array('l', [0]), array('l'))
+    sources = numpy.searchsorted(nodes, sources).astype(numpy.int64)
+    targets = numpy.searchsorted(nodes, targets).astype(numpy.int64)
+    # Both directions of every edge, sorted and without duplicates.
+    pairs = numpy.unique(numpy.concatenate((sources * len(nodes) + targets,
+                                            targets * len(nodes) + sources)))
+    del sources, targets
+    indptr = numpy.zeros(len(nodes) + 1, dtype=numpy.int_)
+    numpy.cumsum(numpy.bincount(pairs // len(nodes), minlength=len(nodes)),
+                 out=indptr[1:])
+    return CSRGraph(_to_array(nodes), _to_array(indptr),
+                    _to_array(pairs % len(nodes)))
+
+
+def _build_array(sources, targets):
+    nodes = array('l', sorted(set(sources).union(targets)))
+    index = dict((user_id, i) for i, user_id in enumerate(nodes))
+    indptr = array('l', [0]) * (len(nodes) + 1)
+    for user_id, friend_id in izip(sources, targets):
+        indptr[index[user_id] + 1] += 1
+        indptr[index[friend_id] + 1] += 1
+    for i in xrange(len(nodes)):
+        indptr[i + 1] += indptr[i]
+    position = array('l', indptr[:-1])
+    indices = array('l', [0]) * indptr[-1]
+    for user_id, friend_id in izip(sources, targets):
+        for node, other in ((index[user_id], index[friend_id]),
+                            (index[friend_id], index[user_id])):
+            indices[position[node]] = other
+            position[node] += 1
+    del sources, targets, index, position
+    # Each direction was added twice if both were stored, keep it once.
+    end = 0
+    for i in xrange(len(nodes)):
+        row = sorted(set(indices[indptr[i]:indptr[i + 1]]))
+        indices[end:end + len(row)] = array('l', row)
+        indptr[i] = end
+        end += len(row)
+    indptr[len(nodes)] = end
+    del indices[end:]
+    return CSRGraph(nodes, indptr, indices)
+
+
+def _to_array(values):
+    result = array('l')
+    result.fromstring(values.astype(numpy.int_).tostring())
+    return result
+
+
+def degree_histogram(graph):
+    """
+    Return a |dict| mapping degrees to the number of nodes with that degree.
+    """
+    if numpy is not None:
+        counts = numpy.bincount(numpy.diff(
+            numpy.frombuffer(graph.indptr, dtype=numpy.int_)))
+        return dict((int(degree), int(counts[degree]))
+                    for degree in numpy.flatnonzero(counts))
+    histogram = {}
+    indptr = graph.indptr
+    for i in xrange(len(graph)):
+        degree = indptr[i + 1] - indptr[i]
+        histogram[degree] = histogram.get(degree, 0) + 1
+    return histogram
+
+
+def top_degree(graph, count=10):
+    """
+    Return ``count`` ``(user_id, degree)`` tuples with the highest degrees.
+    """
+    return heapq.nlargest(count,
+                          ((graph.nodes[i], graph.degree(i))
+                           for i in xrange(len(graph))),
+                          key=lambda item: item[1])
+
+
+def connected_components(graph):
+    """
+    Return the sizes of the connected components in descending order.
+
+    With NumPy every node is labelled with the smallest node index of its
+    component by min-label propagation with pointer jumping, otherwise a
+    union-find is used.
+    """
+    if numpy is not None:
+        return _components_numpy(graph)
+    parent = array('l', xrange(len(graph)))
+
+    def find(node):
+        root = node
+        while parent[root] != root:
+            root = parent[root]
+        while parent[node] != root:
+            parent[node], node = root, parent[node]
+        return root
+
+    for u in xrange(len(graph)):
+        for v in graph.neighbours(u):
+            if v > u:
+                root_u, root_v = find(u), find(v)
+                if root_u != root_v:
+                    parent[max(root_u, root_v)] = min(root_u, root_v)
+    sizes = {}
+    for u in xrange(len(graph)):
+        root = find(u)
+        sizes[root] = sizes.get(root, 0) + 1
+    return sorted(sizes.values(), reverse=True)
+
+
+def _components_numpy(graph):
+    indptr = numpy.frombuffer(graph.indptr, dtype=numpy.int_)
+    indices = numpy.frombuffer(graph.indices, dtype=numpy.int_)
+    sources = numpy.repeat(numpy.arange(len(graph)), numpy.diff(indptr))
+    labels = numpy.arange(len(graph))
+    while True:
+        new = labels.copy()
+        numpy.minimum.at(new, sources, labels[indices])
+        new = new[new]
+        if numpy.array_equal(new, labels):
+            break
+        labels = new
+    counts = numpy.bincount(labels, minlength=len(graph))
+    return sorted((int(size) for size in counts[counts > 0]), reverse=True)
+
+
+# Graph shared with the worker processes of triangle_counts(). Workers are
+# forked, so the arrays are shared copy-on-write instead of being pickled.
+_forward = None
+
+
+def triangle_counts(graph, processes=1):
+    """
+    Return an array with the number of triangles each node is part of.
+
+    Edges are oriented from lower to higher ``(degree, index)`` so that every
+    triangle is found exactly once and high degree nodes have short forward
+    lists. Node ranges are counted in ``processes`` worker processes, with
+    NumPy the forward lists are intersected with ``searchsorted()``.
+    """
+    global _forward
+    _forward = _orient(graph)
+    try:
+        if processes > 1:
+            step = len(graph) // (processes * 8) + 1
+            ranges = [(start, min(start + step, len(graph)))
+                      for start in xrange(0, len(graph), step)]
+            pool = Pool(processes)
+            try:
+                partials = pool.map(_count_triangles, ranges)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            partials = [_count_triangles((0, len(graph)))]
+    finally:
+        _forward = None
+    if numpy is not None:
+        return _to_array(sum(partials))
+    triangles = array('l', [0]) * len(graph)
+    for partial in partials:
+        for node, count in partial.iteritems():
+            triangles[node] += count
+    return triangles
+
+
+def _orient(graph):
+    if numpy is not None:
+        return _orient_numpy(graph)
+    indptr = array('l', [0])
+    indices = array('l')
+    for u in xrange(len(graph)):
+        rank = (graph.degree(u), u)
+        indices.extend(v for v in graph.neighbours(u)
+                       if (graph.degree(v), v) > rank)
+        indptr.append(len(indices))
+    return indptr, indices
+
+
+def _orient_numpy(graph):
+    indptr = numpy.frombuffer(graph.indptr, dtype=numpy.int_)
+    indices = numpy.frombuffer(graph.indices, dtype=numpy.int_)
+    degree = numpy.diff(indptr)
+    sources = numpy.repeat(numpy.arange(len(graph)), degree)
+    forward = ((degree[indices] > degree[sources]) |
+               ((degree[indices] == degree[sources]) & (indices > sources)))
+    indptr = numpy.zeros(len(graph) + 1, dtype=numpy.int_)
+    numpy.cumsum(numpy.bincount(sources[forward], minlength=len(graph)),
+                 out=indptr[1:])
+    return indptr, indices[forward]
+
+
+def _count_triangles(node_range):
+    if numpy is not None:
+        return _count_triangles_numpy(node_range)
+    indptr, indices = _forward
+    triangles = {}
+    for u in xrange(*node_range):
+        forward_u = indices[indptr[u]:indptr[u + 1]]
+        if len(forward_u) < 2:
+            continue
+        members = set(forward_u)
+        for v in forward_u:
+            for w in indices[indptr[v]:indptr[v + 1]]:
+                if w in members:
+                    for node in (u, v, w):
+                        triangles[node] = triangles.get(node, 0) + 1
+    return triangles
+
+
+def _count_triangles_numpy(node_range):
+    # The forward lists of all the forward neighbours v of u are searched
+    # for the members of the (sorted) forward list of u at once, each hit w
+    # closes the triangle (u, v, w).
+    indptr, indices = _forward
+    triangles = numpy.zeros(len(indptr) - 1, dtype=numpy.int_)
+    for u in xrange(*node_range):
+        forward_u = indices[indptr[u]:indptr[u + 1]]
+        if len(forward_u) < 2:
+            continue
+        lengths = indptr[forward_u + 1] - indptr[forward_u]
+        if not lengths.any():
+            continue
+        ends = numpy.cumsum(lengths)
+        positions = (numpy.arange(ends[-1]) +
+                     numpy.repeat(indptr[forward_u] - ends + lengths, lengths))
+        candidates = indices[positions]
+        found = numpy.searchsorted(forward_u, candidates)
+        found[found == len(forward_u)] = 0
+        hits = forward_u[found] == candidates
+        triangles[u] += numpy.count_nonzero(hits)
+        numpy.add.at(triangles, numpy.repeat(forward_u, lengths)[hits], 1)
+        numpy.add.at(triangles, candidates[hits], 1)
+    return triangles
+
+
+def clustering(graph, triangles):
+    """
+    Return the average local clustering coefficient and the global
+    clustering coefficient (transitivity) of ``graph``.
+
+    :param triangles: Result of :func:`triangle_counts`.
+    :returns: ``(average, transitivity)`` tuple.
+    """
+    local_sum = 0.0
+    triples = 0
+    for u in xrange(len(graph)):
+        degree = graph.degree(u)
+        pairs = degree * (degree - 1) // 2
+        if pairs:
+            local_sum += triangles[u] / float(pairs)
+            triples += pairs
+    average = local_sum / len(graph) if len(graph) else 0.0
+    transitivity = sum(triangles) / float(triples) if triples else 0.0
+    return average, transitivity
@@ -0,0 +1,163 @@
+"""
+Load testing
+============
+
+Drives the :ref:`action views <class-based-views>` with many concurrent
+clients to find out how they behave under contention, see the
+``friends_loadtest`` management command. Requests are built with
+:class:`~django.test.client.RequestFactory` and handed to the view functions
+directly, so neither sessions nor the project's urlconf are involved and the
+numbers reflect the views and the database.
+
+Operations are ``(action, actor, target)`` tuples of indexes into the list of
+users, where action is one of :data:`VIEWS`. They are generated with one of
+the :data:`PATTERNS`:
+
+``uniform``
+    Random users acting on each other.
+
+``celebrity``
+    Everybody befriending and unfriending one user, who accepts and blocks
+    them at the same time.
+
+``mutual``
+    Pairs of users requesting each other's friendship at the same time.
+
+.. autofunction:: generate_operations
+
+.. autofunction:: run_load
+"""
+
+
+import random
+import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from django.db import connections
+from django.test.client import RequestFactory
+from consistency import run_checks
+import views
+
+
+VIEWS = {
+    'request': views.friendship_request,
+    'accept': views.friendship_accept,
+    'delete': views.friendship_delete,
+    'block': views.user_block,
+}
+WEIGHTS = (('request', 50), ('accept', 30), ('delete', 15), ('block', 5))
+PATTERNS = ('uniform', 'celebrity', 'mutual')
+
+
+def generate_operations(pattern, users, count, seed=None):
+    """
+    Return ``count`` operations between ``users`` users following
+    ``pattern``.
+
+    :param pattern: One of :data:`PATTERNS`.
+    :param |int| users: Number of users, at least 2.
+    :param |int| count: Number of operations.
+    :param seed: Optional. Seed of the random generator.
+    :returns: |list| of ``(action, actor, target)`` tuples.
+    """
+    rng = random.Random(seed)
+    actions = [action for action, weight in WEIGHTS
+               for i in xrange(weight)]
+    operations = []
+    while len(operations) < count:
+        action = rng.choice(actions)
+        if pattern == 'uniform':
+            actor, target = rng.sample(xrange(users), 2)
+        elif pattern == 'celebrity':
+            actor, target = rng.randrange(1, users), 0
+            if action in ('accept', 'block'):
+                actor, target = target, actor
+        elif pattern == 'mutual':
+            actor = rng.randrange(users // 2) * 2
+            operations.append(('request', actor, actor + 1))
+            action, actor, target = 'request', actor + 1, actor
+        else:
+            raise ValueError('Unknown pattern: %r' % pattern)
+        operations.append((action, actor, target))
+    return operations[:count]
+
+
+def run_load(users, operations, clients=1, processes=1):
+    """
+    Run ``operations`` with ``clients`` concurrent clients in each of
+    ``processes`` processes.
+
+    :param users: |list| of |User|'s the operations refer to.
+    :param operations: Operations from :func:`generate_operations`.
+    :returns: |dict| with the ``operations`` count, elapsed ``seconds``,
+              ``throughput`` per second, ``latency`` percentiles in
+              milliseconds, number of ``outcomes`` by response status or
+              exception class, and the problem counts of the
+              :mod:`~friends.consistency` checks in ``invariants``.
+    """
+    started = time.time()
+    if processes > 1:
+        for connection in connections.all():
+            connection.close()
+        pool = Pool(processes)
+        try:
+            parts = pool.map(_run_part, [
+                (users, operations[i::processes], clients)
+                for i in xrange(processes)
+            ])
+        finally:
+            pool.close()
+            pool.join()
+        results = [result for part in parts for result in part]
+    else:
+        results = _run_part((users, operations, clients))
+    seconds = time.time() - started
+    latencies = sorted(latency for latency, outcome in results)
+    outcomes = {}
+    for latency, outcome in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    return {
+        'operations': len(results),
+        'seconds': seconds,
+        'throughput': len(results) / seconds if seconds else 0.0,
+        'latency': dict(
+            ('p%d' % (q * 100), _percentile(latencies, q) * 1000)
+            for q in (0.5, 0.9, 0.99, 1)
+        ),
+        'outcomes': outcomes,
+        'invariants': dict((name, result['count']) for name, result
+                           in run_checks().iteritems()),
+    }
+
+
+def _run_part(args):
+    users, operations, clients = args
+    factory = RequestFactory()
+
+    def run(operation):
+        action, actor, target = operation
+        request = factory.get('/')
+        request.user = users[actor]
+        started = time.time()
+        try:
+            response = VIEWS[action](request, username=users[target].username)
+        except Exception, e:
+            outcome = e.__class__.__name__
+        else:
+            outcome = 'status %d' % response.status_code
+        return time.time() - started, outcome
+
+    if clients <= 1:
+        return map(run, operations)
+    pool = ThreadPool(clients)
+    try:
+        return pool.map(run, operations, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    return values[int(round(q * (len(values) - 1)))]
@@ -0,0 +1,27 @@
+from django.db.models.signals import post_syncdb
+from django.core.exceptions import ImproperlyConfigured
+from friends import models
+from friends.backfill import backfill
+from friends.app_settings import FRIENDS_SYNCDB_BATCH_SIZE
+
+
+def post_syncdb_handler(sender, app, created_models, verbosity, **kwargs):
+    if FRIENDS_SYNCDB_BATCH_SIZE < 1:
+        raise ImproperlyConfigured("FRIENDS_SYNCDB_BATCH_SIZE must be > 0")
+    if verbosity >= 1:
+        print "Creating Friendship and UserBlocks models for existing users..."
+    # Users that already have the records, such as a superuser account
+    # created interactively during syncdb, are skipped. Large sites should
+    # rather run the friends_backfill command, which can run in parallel and
+    # be resumed.
+    total = sum(created for high, created in
+                backfill(FRIENDS_SYNCDB_BATCH_SIZE))
+    if verbosity >= 2 and total:
+        print "Created {0} new record(s).".format(total)
+
+
+post_syncdb.connect(
+    post_syncdb_handler,
+    sender=models,
+    dispatch_uid='friends.signals.post_syncdb',
+)
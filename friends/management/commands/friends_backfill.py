@@ -0,0 +1,68 @@
+import os
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from friends.backfill import backfill
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=10000,
+                    help='Number of users per transaction.'),
+        make_option('--processes', dest='processes', type='int', default=1,
+                    help='Number of worker processes.'),
+        make_option('--start-after', dest='start_after', type='int',
+                    default=None,
+                    help='Primary key of the user to start after.'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+                    help='File keeping the primary key of the last user '
+                         'done, the backfill resumes from it when it '
+                         'exists.'),
+        make_option('--database', dest='database', default=None,
+                    help='Database alias of the friends tables.'),
+    )
+    help = ('Create the missing Friendship and UserBlocks records of '
+            'existing users.')
+
+    def handle(self, **options):
+        if options['chunk_size'] < 1 or options['processes'] < 1:
+            raise CommandError('--chunk-size and --processes must be > 0')
+        verbosity = int(options['verbosity'])
+        checkpoint = options['checkpoint']
+        start_after = options['start_after']
+        if start_after is None:
+            start_after = 0
+            if checkpoint and os.path.exists(checkpoint):
+                with open(checkpoint) as f:
+                    start_after = int(f.read().strip() or 0)
+        if verbosity >= 1 and start_after:
+            self.stdout.write('Resuming after user #%d.\n' % start_after)
+        started = reported = time.time()
+        users, total = 0, 0
+        for high, created in backfill(options['chunk_size'], start_after,
+                                      options['processes'],
+                                      options['database']):
+            # Only the last range may hold fewer users, which is close
+            # enough for the throughput.
+            users += options['chunk_size']
+            total += created
+            if checkpoint:
+                self.write_checkpoint(checkpoint, high)
+            now = time.time()
+            if verbosity >= 2 or verbosity >= 1 and now - reported >= 10:
+                reported = now
+                self.stdout.write(
+                    'Done up to user #{0}: created {1} record(s), '
+                    '{2:.0f} users/s\n'.format(high, total,
+                                               users / (now - started)),
+                )
+        if verbosity >= 1:
+            self.stdout.write('Created {0} record(s) in {1:.1f}s\n'.format(
+                total, time.time() - started))
+
+    def write_checkpoint(self, path, high):
+        temporary = '%s.tmp' % path
+        with open(temporary, 'w') as f:
+            f.write('%d\n' % high)
+        os.rename(temporary, path)
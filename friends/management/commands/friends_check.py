@@ -0,0 +1,54 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from friends.consistency import CHECKS, run_checks
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--repair', action='store_true', dest='repair',
+                    default=False,
+                    help='Repair the problems found.'),
+        make_option('--check', action='append', dest='checks', default=None,
+                    help='Name of a check to run, can be repeated. All the '
+                         'checks are run by default.'),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=10000,
+                    help='Number of rows scanned per query.'),
+        make_option('--samples', dest='samples', type='int', default=10,
+                    help='Maximum number of problems shown per check.'),
+        make_option('--database', dest='database', default=None,
+                    help='Database alias of the friends tables.'),
+    )
+    help = ('Check the consistency of the friendships, friendship requests '
+            'and blocks, and optionally repair it.')
+
+    def handle(self, **options):
+        if options['chunk_size'] < 1 or options['samples'] < 0:
+            raise CommandError('--chunk-size must be > 0 and --samples >= 0')
+        names = [check.name for check in CHECKS]
+        for name in options['checks'] or ():
+            if name not in names:
+                raise CommandError('Unknown check: %s, choose from %s' %
+                                   (name, ', '.join(names)))
+        started = time.time()
+        results = run_checks(options['chunk_size'], options['repair'],
+                             options['samples'], options['database'],
+                             options['checks'])
+        verbosity = int(options['verbosity'])
+        for name in names:
+            if name not in results:
+                continue
+            result = results[name]
+            if verbosity >= 1:
+                self.stdout.write('%s: %d %s\n' % (
+                    name,
+                    result['count'],
+                    'repaired' if result['repaired'] else 'found',
+                ))
+                for sample in result['samples']:
+                    self.stdout.write('    users %s\n' % ', '.join(
+                        str(user_id) for user_id in sample))
+        if verbosity >= 1:
+            self.stdout.write('Checked in {0:.1f}s\n'.format(
+                time.time() - started))
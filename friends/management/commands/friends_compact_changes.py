@@ -0,0 +1,50 @@
+import datetime
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from friends.models import FriendshipChange
+from friends.routers import write_database
+from friends.snapshot import get_snapshot
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--days', dest='days', type='int', default=30,
+                    help='Number of days of changes to retain.'),
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=10000,
+                    help='Number of changes deleted per transaction.'),
+        make_option('--database', dest='database', default=None,
+                    help='Database alias of the friends tables.'),
+    )
+    help = ('Delete the friendship changes older than --days days, except '
+            'those made after the snapshot at FRIENDS_SNAPSHOT_PATH.')
+
+    def handle(self, **options):
+        if options['days'] < 0 or options['batch_size'] < 1:
+            raise CommandError('--days must be >= 0 and --batch-size > 0')
+        verbosity = int(options['verbosity'])
+        db = options['database'] or write_database()
+        cutoff = datetime.datetime.now() - \
+            datetime.timedelta(days=options['days'])
+        changes = FriendshipChange.objects.using(db)
+        snapshot = get_snapshot(db)
+        if snapshot is not None:
+            # Readers of the snapshot apply the changes made after it.
+            changes = changes.filter(id__lte=snapshot.seq)
+        total = 0
+        while True:
+            # Changes are appended in order, so the oldest ones are a prefix
+            # of the primary key and each batch is a range scan.
+            ids = list(changes.filter(created__lt=cutoff).order_by(
+                'id').values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            with transaction.commit_on_success(using=db):
+                changes.filter(id__gte=ids[0], id__lte=ids[-1],
+                               created__lt=cutoff).delete()
+            total += len(ids)
+            if verbosity >= 2:
+                self.stdout.write('Deleted changes up to #%d.\n' % ids[-1])
+        if verbosity >= 1:
+            self.stdout.write('Deleted %d change(s).\n' % total)
@@ -0,0 +1,67 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from friends.generate import generate_graph, write_graph
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--users', dest='users', type='int', default=1000,
+                    help='Number of users to create.'),
+        make_option('--exponent', dest='exponent', type='float', default=2.5,
+                    help='Exponent of the power law of the degrees.'),
+        make_option('--min-degree', dest='min_degree', type='int',
+                    default=2,
+                    help='Minimum expected number of friends.'),
+        make_option('--max-degree', dest='max_degree', type='int',
+                    default=None,
+                    help='Maximum expected number of friends.'),
+        make_option('--community-size', dest='community_size', type='int',
+                    default=100,
+                    help='Number of users per community.'),
+        make_option('--intra', dest='intra', type='float', default=0.8,
+                    help='Fraction of the friendships made within '
+                         'communities.'),
+        make_option('--requests', dest='requests', type='float',
+                    default=0.1,
+                    help='Average number of pending friendship requests '
+                         'per user.'),
+        make_option('--blocks', dest='blocks', type='float', default=0.02,
+                    help='Average number of blocks per user.'),
+        make_option('--seed', dest='seed', type='int', default=None,
+                    help='Seed of the random generator.'),
+        make_option('--prefix', dest='prefix', default='user',
+                    help='Prefix of the usernames.'),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=10000,
+                    help='Number of rows per INSERT.'),
+        make_option('--database', dest='database', default=None,
+                    help='Database alias of the friends tables.'),
+    )
+    help = ('Create users with a synthetic graph of friendships, friendship '
+            'requests and blocks.')
+
+    def handle(self, **options):
+        if options['users'] < 2 or options['min_degree'] < 1 or \
+           options['community_size'] < 1 or options['chunk_size'] < 1:
+            raise CommandError('--users must be > 1, --min-degree, '
+                               '--community-size and --chunk-size > 0')
+        if options['exponent'] <= 1:
+            raise CommandError('--exponent must be > 1')
+        if not 0 <= options['intra'] <= 1:
+            raise CommandError('--intra must be between 0 and 1')
+        started = time.time()
+        edges, requests, blocks = generate_graph(
+            options['users'], options['seed'], options['exponent'],
+            options['min_degree'], options['max_degree'],
+            options['community_size'], options['intra'],
+            options['requests'], options['blocks'],
+        )
+        counts = write_graph(options['users'], edges, requests, blocks,
+                             options['prefix'], options['seed'],
+                             options['chunk_size'], options['database'])
+        if int(options['verbosity']) >= 1:
+            for name, count in sorted(counts.items()):
+                self.stdout.write('%s: %d\n' % (name, count))
+            self.stdout.write('Generated in {0:.1f}s\n'.format(
+                time.time() - started))
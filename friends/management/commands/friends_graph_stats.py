@@ -0,0 +1,57 @@
+import json
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from friends import graph
+from friends.models import Friendship
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--output', dest='output',
+                    default='friends_graph_stats.json',
+                    help='File to write the JSON report to.'),
+        make_option('--processes', dest='processes', type='int', default=1,
+                    help='Number of worker processes for triangle counting.'),
+        make_option('--top', dest='top', type='int', default=10,
+                    help='Number of top-degree users to report.'),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=100000,
+                    help='Number of edges fetched per query.'),
+        make_option('--database', dest='database', default=None,
+                    help='Database alias to read the friendship graph from.'),
+    )
+    help = ('Compute degree, connectivity, triangle and clustering statistics '
+            'of the friendship graph.')
+
+    def handle(self, **options):
+        if options['processes'] < 1 or options['chunk_size'] < 1:
+            raise CommandError('--processes and --chunk-size must be > 0')
+        verbosity = int(options['verbosity'])
+        started = time.time()
+        g = graph.load_graph(options['chunk_size'], options['database'])
+        if verbosity >= 1:
+            self.stdout.write('Loaded {0} users and {1} friendships in '
+                              '{2:.1f}s\n'.format(len(g), g.edge_count,
+                                                  time.time() - started))
+        users = Friendship.objects.using(options['database']).count()
+        components = graph.connected_components(g)
+        triangles = graph.triangle_counts(g, options['processes'])
+        average_clustering, transitivity = graph.clustering(g, triangles)
+        report = {
+            'users': users,
+            'users_with_friends': len(g),
+            'friendships': g.edge_count,
+            'degree_histogram': sorted(graph.degree_histogram(g).items()),
+            'top_degree': graph.top_degree(g, options['top']),
+            'components': len(components) + users - len(g),
+            'largest_component': components[0] if components else 0,
+            'triangles': sum(triangles) // 3,
+            'average_clustering': average_clustering,
+            'transitivity': transitivity,
+        }
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2)
+        if verbosity >= 1:
+            self.stdout.write('Wrote report to {0} in {1:.1f}s\n'.format(
+                options['output'], time.time() - started))
@@ -0,0 +1,68 @@
+import sys
+import time
+from optparse import make_option
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from friends.blocklists import import_blocks, import_entries
+from friends.models import SharedBlocklist
+
+
+class Command(BaseCommand):
+    args = '[username] <file>'
+    option_list = BaseCommand.option_list + (
+        make_option('--unblock', action='store_true', dest='unblock',
+                    default=False,
+                    help='Unblock the users, or remove them from the shared '
+                         'block list, instead.'),
+        make_option('--blocklist', dest='blocklist', default=None,
+                    help='Name of a shared block list to import the users '
+                         'into instead of the blocks of a user. The list is '
+                         'created if it doesn\'t exist.'),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=500,
+                    help='Number of usernames resolved and blocked per '
+                         'query.'),
+    )
+    help = ('Block the users listed in a file, one username per line, on '
+            'behalf of a user or in a shared block list. Use - to read '
+            'the usernames from the standard input.')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be > 0')
+        if len(args) != (1 if options['blocklist'] else 2):
+            raise CommandError('Give a username and a file, or a file and '
+                               '--blocklist.')
+        path = args[-1]
+        lines = sys.stdin if path == '-' else open(path)
+        usernames = (line.strip().decode('utf-8') for line in lines
+                     if line.strip())
+        started = time.time()
+        try:
+            if options['blocklist']:
+                blocklist, created = SharedBlocklist.objects.get_or_create(
+                    name=options['blocklist'])
+                counts = import_entries(blocklist, usernames,
+                                        options['unblock'],
+                                        options['chunk_size'])
+            else:
+                try:
+                    user = User.objects.get(username=args[0])
+                except User.DoesNotExist:
+                    raise CommandError('User %s does not exist.' % args[0])
+                counts = import_blocks(user, usernames, options['unblock'],
+                                       options['chunk_size'])
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+        verbosity = int(options['verbosity'])
+        if verbosity >= 1:
+            self.stdout.write(
+                '{0} {1[modified]} user(s), {1[unchanged]} unchanged, '
+                '{2} missing in {3:.1f}s\n'.format(
+                    'Unblocked' if options['unblock'] else 'Blocked',
+                    counts, len(counts['missing']), time.time() - started),
+            )
+        if verbosity >= 2:
+            for username in counts['missing']:
+                self.stdout.write(u'Missing: %s\n' % username)
@@ -0,0 +1,76 @@
+import json
+from optparse import make_option
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from friends.backfill import backfill
+from friends.loadtest import PATTERNS, generate_operations, run_load
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--users', dest='users', type='int', default=100,
+                    help='Number of users taking part, created if needed.'),
+        make_option('--operations', dest='operations', type='int',
+                    default=1000,
+                    help='Number of requests made.'),
+        make_option('--clients', dest='clients', type='int', default=10,
+                    help='Number of concurrent clients per process.'),
+        make_option('--processes', dest='processes', type='int', default=1,
+                    help='Number of processes.'),
+        make_option('--pattern', dest='pattern', default='uniform',
+                    choices=PATTERNS,
+                    help='One of: %s.' % ', '.join(PATTERNS)),
+        make_option('--seed', dest='seed', type='int', default=None,
+                    help='Seed of the random operations.'),
+        make_option('--output', dest='output', default=None,
+                    help='File to write the JSON report to.'),
+    )
+    help = ('Load test the friendship action views against the configured '
+            'database. Users named loadtest<n> are created and befriended, '
+            'never run it against a production database.')
+
+    def handle(self, **options):
+        if options['users'] < 2:
+            raise CommandError('--users must be > 1')
+        if min(options['operations'], options['clients'],
+               options['processes']) < 1:
+            raise CommandError('--operations, --clients and --processes '
+                               'must be > 0')
+        users = self.get_users(options['users'])
+        operations = generate_operations(options['pattern'], len(users),
+                                         options['operations'],
+                                         options['seed'])
+        report = run_load(users, operations, options['clients'],
+                          options['processes'])
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+        if int(options['verbosity']) >= 1:
+            self.stdout.write(
+                '{operations} operations in {seconds:.1f}s, '
+                '{throughput:.1f}/s\n'.format(**report))
+            self.stdout.write('Latency (ms): %s\n' % ', '.join(
+                '%s %.1f' % (name, value) for name, value
+                in sorted(report['latency'].items(),
+                          key=lambda item: int(item[0][1:]))))
+            for outcome, count in sorted(report['outcomes'].items()):
+                self.stdout.write('%s: %d\n' % (outcome, count))
+            for name, count in sorted(report['invariants'].items()):
+                self.stdout.write('Invariant %s: %d problem(s)\n' % (name,
+                                                                     count))
+
+    def get_users(self, count):
+        usernames = ['loadtest%d' % i for i in xrange(count)]
+        existing = set(User.objects.filter(
+            username__in=usernames).values_list('username', flat=True))
+        missing = [username for username in usernames
+                   if username not in existing]
+        if missing:
+            User.objects.bulk_create([User(username=username)
+                                      for username in missing])
+            # bulk_create() doesn't send post_save.
+            for high, created in backfill(1000):
+                pass
+        users = dict((user.username, user) for user in
+                     User.objects.filter(username__in=usernames))
+        return [users[username] for username in usernames]
@@ -0,0 +1,180 @@
+import datetime
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import DatabaseError, connections, transaction
+from friends.models import Friendship, FriendshipEdge, FriendshipRequest
+from friends.routers import write_database
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=10000,
+                    help='Number of edges updated per transaction.'),
+        make_option('--database', dest='database', default=None,
+                    help='Database alias of the friends tables.'),
+    )
+    help = ('Add the created column and its index to an existing '
+            'Friendship.friends table, fill it in and make it NOT NULL.')
+
+    def handle(self, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be > 0')
+        self.verbosity = int(options['verbosity'])
+        self.db = options['database'] or write_database()
+        self.connection = connections[self.db]
+        qn = self.connection.ops.quote_name
+        self.names = {
+            'edges': qn(FriendshipEdge._meta.db_table),
+            'id': qn(FriendshipEdge._meta.pk.column),
+            'from': qn(FriendshipEdge._meta.get_field(
+                'from_friendship').column),
+            'to': qn(FriendshipEdge._meta.get_field('to_friendship').column),
+            'created': qn('created'),
+            'friendship': qn(Friendship._meta.db_table),
+            'friendship_id': qn(Friendship._meta.pk.column),
+            'user': qn(Friendship._meta.get_field('user').column),
+            'requests': qn(FriendshipRequest._meta.db_table),
+            'request_created': qn(FriendshipRequest._meta.get_field(
+                'created').column),
+            'request_from': qn(FriendshipRequest._meta.get_field(
+                'from_user').column),
+            'request_to': qn(FriendshipRequest._meta.get_field(
+                'to_user').column),
+            'index': qn('friends_friendship_friends_created'),
+            'old_edges': qn(FriendshipEdge._meta.db_table + '_old'),
+        }
+        self.now = datetime.datetime.now()
+        self.add_column()
+        self.fill_column(batch_size)
+        self.set_not_null()
+        self.add_index()
+
+    def execute_sql(self, sql, params=()):
+        with transaction.commit_on_success(using=self.db):
+            cursor = self.connection.cursor()
+            cursor.execute(sql % self.names, params)
+            transaction.set_dirty(using=self.db)
+            return cursor.rowcount
+
+    def describe_column(self):
+        """
+        Return the description of the created column, ``None`` if it is
+        missing.
+        """
+        cursor = self.connection.cursor()
+        for column in self.connection.introspection.get_table_description(
+                cursor, FriendshipEdge._meta.db_table):
+            if column[0] == 'created':
+                return column
+        return None
+
+    def add_column(self):
+        if self.describe_column() is not None:
+            return
+        self.execute_sql(
+            'ALTER TABLE %%(edges)s ADD COLUMN %%(created)s %s NULL' %
+            self.connection.creation.data_types['DateTimeField'],
+        )
+        if self.verbosity >= 1:
+            self.stdout.write('Added the created column.\n')
+
+    def fill_column(self, batch_size):
+        # Friendships made by accepting a request get the time of the
+        # request, others the time of the migration.
+        sql = ('UPDATE %(edges)s SET %(created)s = COALESCE(('
+               'SELECT MAX(r.%(request_created)s) '
+               'FROM %(requests)s r, %(friendship)s f1, %(friendship)s f2 '
+               'WHERE f1.%(friendship_id)s = %(edges)s.%(from)s '
+               'AND f2.%(friendship_id)s = %(edges)s.%(to)s '
+               'AND ((r.%(request_from)s = f1.%(user)s '
+               'AND r.%(request_to)s = f2.%(user)s) '
+               'OR (r.%(request_from)s = f2.%(user)s '
+               'AND r.%(request_to)s = f1.%(user)s))), %%s) '
+               'WHERE %(id)s > %%s AND %(id)s <= %%s '
+               'AND %(created)s IS NULL')
+        ids = FriendshipEdge.objects.using(self.db).order_by('pk')
+        last, total = 0, 0
+        while True:
+            batch = list(ids.filter(pk__gt=last).values_list(
+                'pk', flat=True)[batch_size - 1:batch_size])
+            if batch:
+                end = batch[0]
+            else:
+                end = ids.filter(pk__gt=last).order_by('-pk').values_list(
+                    'pk', flat=True)[:1]
+                if not end:
+                    break
+                end = end[0]
+            total += self.execute_sql(sql, [self.now, last, end])
+            last = end
+            if self.verbosity >= 2:
+                self.stdout.write('Filled in edges up to #%d.\n' % last)
+        if self.verbosity >= 1:
+            self.stdout.write('Filled in %d edge(s).\n' % total)
+
+    def set_not_null(self):
+        # null_ok, as in the DB-API cursor.description.
+        if not self.describe_column()[6]:
+            return
+        # Edges inserted by processes running the previous version since
+        # the column was filled in.
+        self.execute_sql('UPDATE %(edges)s SET %(created)s = %%s '
+                         'WHERE %(created)s IS NULL', [self.now])
+        vendor = self.connection.vendor
+        if vendor == 'postgresql':
+            self.execute_sql('ALTER TABLE %(edges)s '
+                             'ALTER COLUMN %(created)s SET NOT NULL')
+        elif vendor == 'mysql':
+            self.execute_sql(
+                'ALTER TABLE %%(edges)s MODIFY %%(created)s %s NOT NULL' %
+                self.connection.creation.data_types['DateTimeField'],
+            )
+        elif vendor == 'oracle':
+            self.execute_sql('ALTER TABLE %(edges)s '
+                             'MODIFY %(created)s NOT NULL')
+        elif vendor == 'sqlite':
+            self.rebuild_table()
+        else:
+            if self.verbosity >= 1:
+                self.stdout.write('Make the created column NOT NULL by '
+                                  'hand on %s.\n' % vendor)
+            return
+        if self.verbosity >= 1:
+            self.stdout.write('Made the created column NOT NULL.\n')
+
+    def rebuild_table(self):
+        # SQLite can't alter columns, the table is created again as syncdb
+        # does and the edges are copied over.
+        style = no_style()
+        creation = self.connection.creation
+        qn = self.connection.ops.quote_name
+        columns = ', '.join(qn(field.column)
+                            for field in FriendshipEdge._meta.local_fields)
+        with transaction.commit_on_success(using=self.db):
+            cursor = self.connection.cursor()
+            cursor.execute('ALTER TABLE %(edges)s RENAME TO %(old_edges)s' %
+                           self.names)
+            for sql in creation.sql_create_model(FriendshipEdge, style)[0]:
+                cursor.execute(sql)
+            cursor.execute(('INSERT INTO %%(edges)s (%s) SELECT %s '
+                            'FROM %%(old_edges)s' % (columns, columns)) %
+                           self.names)
+            cursor.execute('DROP TABLE %(old_edges)s' % self.names)
+            for sql in creation.sql_indexes_for_model(FriendshipEdge, style):
+                cursor.execute(sql)
+            transaction.set_dirty(using=self.db)
+
+    def add_index(self):
+        try:
+            self.execute_sql('CREATE INDEX %(index)s '
+                             'ON %(edges)s (%(from)s, %(created)s)')
+        except DatabaseError:
+            # The index already exists.
+            pass
+        else:
+            if self.verbosity >= 1:
+                self.stdout.write('Added the (from_friendship_id, created) '
+                                  'index.\n')
@@ -0,0 +1,43 @@
+from optparse import make_option
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from friends.purge import purge_user
+
+
+class Command(BaseCommand):
+    args = '<username username ...>'
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=1000,
+                    help='Number of rows deleted per transaction.'),
+        make_option('--delete-user', action='store_true', dest='delete_user',
+                    default=False,
+                    help='Delete the users as well.'),
+        make_option('--database', dest='database', default=None,
+                    help='Database alias of the friends tables. Defaults '
+                         'to all the shards if sharding is enabled.'),
+    )
+    help = ('Delete all the friendships, friendship requests and blocks of '
+            'the given users.')
+
+    def handle(self, *usernames, **options):
+        if not usernames:
+            raise CommandError('Give at least one username.')
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be > 0')
+        verbosity = int(options['verbosity'])
+        for username in usernames:
+            try:
+                user = User.objects.get(username=username)
+            except User.DoesNotExist:
+                raise CommandError('User %s does not exist.' % username)
+            counts = purge_user(user, options['chunk_size'],
+                                options['database'])
+            if options['delete_user']:
+                user.delete()
+            if verbosity >= 1:
+                self.stdout.write(
+                    'Purged {0}: {1[friends]} friend(s), {1[requests]} '
+                    'request(s), {1[blocks]} block(s)\n'.format(
+                        username, counts),
+                )
@@ -0,0 +1,32 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from friends import app_settings
+from friends.bloom import rebuild_all
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--force', action='store_true', dest='force',
+                    default=False,
+                    help='Rebuild the filters that are up to date too.'),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=10000,
+                    help='Number of users scanned per query.'),
+        make_option('--database', dest='database', default=None,
+                    help='Database alias of the friends tables.'),
+    )
+    help = ('Rebuild the missing and stale Bloom filters of the users with '
+            'at least FRIENDS_BLOOM_MIN_FRIENDS friends.')
+
+    def handle(self, **options):
+        if app_settings.BLOOM_MIN_FRIENDS is None:
+            raise CommandError('FRIENDS_BLOOM_MIN_FRIENDS is not set')
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be > 0')
+        started = time.time()
+        rebuilt = rebuild_all(options['chunk_size'], options['force'],
+                              options['database'])
+        if int(options['verbosity']) >= 1:
+            self.stdout.write('Rebuilt {0} filter(s) in {1:.1f}s\n'.format(
+                rebuilt, time.time() - started))
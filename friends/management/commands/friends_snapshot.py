@@ -0,0 +1,39 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from friends import app_settings
+from friends.snapshot import snapshot_path, write_snapshot
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--output', dest='output',
+                    default=app_settings.SNAPSHOT_PATH,
+                    help='Snapshot file to write. Defaults to the '
+                         'FRIENDS_SNAPSHOT_PATH setting. If sharding is '
+                         'enabled %(database)s is replaced by the alias of '
+                         'each shard.'),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=100000,
+                    help='Number of edges fetched per query.'),
+        make_option('--database', dest='database', default=None,
+                    help='Database alias to read the friendship graph from. '
+                         'Defaults to all the shards if sharding is '
+                         'enabled.'),
+    )
+    help = 'Build a memory-mappable snapshot of the friendship graph.'
+
+    def handle(self, **options):
+        if not options['output']:
+            raise CommandError('Either --output or FRIENDS_SNAPSHOT_PATH '
+                               'must be set')
+        databases = [options['database']] if options['database'] else \
+            app_settings.SHARDS or [None]
+        for database in databases:
+            started = time.time()
+            path = snapshot_path(options['output'], database)
+            seq = write_snapshot(path, database, options['chunk_size'])
+            if int(options['verbosity']) >= 1:
+                self.stdout.write('Wrote snapshot at change #{0} to {1} in '
+                                  '{2:.1f}s\n'.format(seq, path,
+                                                      time.time() - started))
@@ -5,22 +5,119 @@ Models
 .. autoclass:: FriendshipRequest
     :members:
 
+.. autoclass:: FriendshipRequestManager
+    :members:
+
 .. autoclass:: FriendshipManager
     :members:
 
 .. autoclass:: Friendship
     :members:
 
+.. autoclass:: FriendshipEdge
+    :members:
+
+.. autoclass:: UserBlocksManager
+    :members:
+
 .. autoclass:: UserBlocks
     :members:
+
+.. autoclass:: SharedBlocklistManager
+    :members:
+
+.. autoclass:: SharedBlocklist
+    :members:
+
+.. autoclass:: FriendshipChangeManager
+    :members:
+
+.. autoclass:: FriendshipChange
+    :members:
 """
 
 
 import datetime
-from django.db import models
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+from django.core.cache import cache
+from django.db import connections, models, transaction
+from django.db.models import Q
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.models import User
 import signals
+from routers import read_database, write_database, write_databases, \
+                    shard_database, pin_users
+from utils import execute, insert_ignore
+import app_settings
+from app_settings import SEARCH_CACHE_MIN_FRIENDS, SEARCH_CACHE_TIMEOUT
+
+
+class FriendshipRequestManager(models.Manager):
+    REQUESTED = 'requested'
+    ACCEPTED = 'accepted'
+    ALREADY_REQUESTED = 'already_requested'
+    ALREADY_FRIENDS = 'already_friends'
+
+    def request_friendship(self, from_user, to_user, message=u''):
+        """
+        Request friendship from ``from_user`` to ``to_user``, or accept the
+        pending request of ``to_user`` if there is one.
+
+        This is done in a single transaction that first locks the
+        :class:`Friendship` rows of both users, in primary key order, so
+        that concurrent requests between the same users are serialized and
+        complementary requests can't be created. Besides the writes it makes
+        three queries. With :ref:`sharding <sharding>` the request is created
+        in the shards of both users.
+
+        .. seealso::
+
+            :class:`~friends.views.FriendshipRequestView`
+
+        :param from_user: User requesting friendship.
+        :type from_user: |User|
+        :param to_user: User whose friendship is requested.
+        :type to_user: |User|
+        :param message: Optional. Message of the request.
+        :type message: |unicode|
+        :returns: One of :attr:`REQUESTED`, :attr:`ACCEPTED`,
+                  :attr:`ALREADY_REQUESTED` or :attr:`ALREADY_FRIENDS`.
+        """
+        databases = write_databases(from_user, to_user)
+        db = write_database(from_user)
+        with _atomic(*databases):
+            for each in databases:
+                _lock_users(each, from_user, to_user)
+            if FriendshipEdge.objects.using(db).filter(
+                from_friendship__user=from_user,
+                to_friendship__user=to_user,
+            ).exists():
+                return self.ALREADY_FRIENDS
+            requests = dict(
+                (request.from_user_id, request)
+                for request in self.using(db).filter(
+                    Q(from_user=from_user, to_user=to_user) |
+                    Q(from_user=to_user, to_user=from_user)
+                )
+            )
+            received = requests.get(to_user.pk)
+            if received is not None and not received.accepted:
+                received.accept()
+                return self.ACCEPTED
+            if from_user.pk in requests:
+                return self.ALREADY_REQUESTED
+            created = datetime.datetime.now()
+            for each in databases:
+                self.using(each).create(from_user=from_user,
+                                        to_user=to_user,
+                                        message=message,
+                                        created=created)
+                FriendshipChange.objects.record(FriendshipChange.REQUEST,
+                                                from_user, to_user, each)
+        pin_users(from_user, to_user)
+        return self.REQUESTED
 
 
 class FriendshipRequest(models.Model):
@@ -32,8 +129,9 @@ class FriendshipRequest(models.Model):
         There should never be complementary :class:`FriendshipRequest`\ 's,
         as in ``user1`` requests to be friends with ``user2`` when ``user2``
         has been requested to be friends with ``user1``. See how
-        :class:`~friends.views.FriendshipRequestView` checks the existence of
-        a :class:`FriendshipRequest` from ``to_user`` to ``from_user``.
+        :meth:`FriendshipRequestManager.request_friendship` accepts the
+        :class:`FriendshipRequest` from ``to_user`` to ``from_user`` if it
+        exists.
     """
 
     from_user = models.ForeignKey(User, related_name="friendshiprequests_from")
@@ -61,17 +159,19 @@ class FriendshipRequest(models.Model):
     """
 
     created = models.DateTimeField(default=datetime.datetime.now,
-                                   editable=False)
+                                   editable=False, db_index=True)
     """
     :class:`~django.db.models.DateTimeField` set when the object is created.
     """
 
-    accepted = models.BooleanField(default=False)
+    accepted = models.BooleanField(default=False, db_index=True)
     """
     :class:`~django.db.models.BooleanField` indicates whether the request is
     accepted or still pending.
     """
 
+    objects = FriendshipRequestManager()
+
     class Meta:
         verbose_name = _(u'friendship request')
         verbose_name_plural = _(u'friendship requests')
@@ -96,9 +196,25 @@ class FriendshipRequest(models.Model):
 
             :class:`~friends.views.FriendshipAcceptView`
         """
-        Friendship.objects.befriend(self.from_user, self.to_user)
-        self.accepted = True
-        self.save()
+        databases = write_databases(self.from_user_id, self.to_user_id)
+        own = self._own_database(databases)
+        with _atomic(*databases):
+            Friendship.objects.befriend(self.from_user, self.to_user)
+            self.accepted = True
+            for db in databases:
+                if db == own:
+                    self.save(using=db)
+                else:
+                    FriendshipRequest.objects.using(db).create(
+                        from_user_id=self.from_user_id,
+                        to_user_id=self.to_user_id,
+                        message=self.message,
+                        created=self.created,
+                        accepted=True,
+                    )
+                FriendshipChange.objects.record(FriendshipChange.ACCEPT,
+                                                self.to_user_id,
+                                                self.from_user_id, db)
         signals.friendship_accepted.send(sender=self)
 
     def decline(self):
@@ -112,7 +228,8 @@ class FriendshipRequest(models.Model):
             :class:`~friends.views.FriendshipDeclineView`
         """
         signals.friendship_declined.send(sender=self)
-        self.delete()
+        self._delete(FriendshipChange.DECLINE, self.to_user_id,
+                     self.from_user_id)
 
     def cancel(self):
         """
@@ -125,10 +242,51 @@ class FriendshipRequest(models.Model):
             :class:`~friends.views.FriendshipCancelView`
         """
         signals.friendship_cancelled.send(sender=self)
-        self.delete()
+        self._delete(FriendshipChange.CANCEL, self.from_user_id,
+                     self.to_user_id)
+
+    def _delete(self, action, user_id, other_id):
+        databases = write_databases(user_id, other_id)
+        own = self._own_database(databases)
+        with _atomic(*databases):
+            for db in databases:
+                if db == own:
+                    self.delete(using=db)
+                else:
+                    FriendshipRequest.objects.using(db).filter(
+                        from_user=self.from_user_id,
+                        to_user=self.to_user_id,
+                    ).delete()
+                FriendshipChange.objects.record(action, user_id, other_id, db)
+        pin_users(user_id, other_id)
+
+    def _own_database(self, databases):
+        # The copy of a sharded request in the other shard has another
+        # primary key.
+        if self._state.db in databases:
+            return self._state.db
+        return databases[0]
 
 
 class FriendshipManager(models.Manager):
+    """
+    Query methods read from the database returned by
+    :func:`~friends.routers.read_database` and modifying methods pin the
+    affected users with :func:`~friends.routers.pin_users`.
+
+    If ``FRIENDS_SNAPSHOT_PATH`` is set :meth:`are_friends` and
+    :meth:`friend_ids` are answered from a :mod:`snapshot <friends.snapshot>`.
+    Otherwise, if ``FRIENDS_BLOOM_MIN_FRIENDS`` is set, :meth:`are_friends`
+    answers most negatives from a :mod:`Bloom filter <friends.bloom>`.
+
+    With :ref:`sharding <sharding>` the friends of a user are read from its
+    shard only, and :meth:`befriend` and :meth:`unfriend` modify the shards of
+    both users.
+    """
+
+    SEARCH_KEY = 'friends.search.%s'
+    BATCH_SIZE = 500
+
     def friends_of(self, user, shuffle=False):
         """
         List friends of ``user``.
@@ -140,7 +298,9 @@ class FriendshipManager(models.Manager):
         :returns: :class:`~django.db.models.query.QuerySet` containing friends
                   of ``user``.
         """
-        qs = User.objects.filter(friendship__friends__user=user)
+        qs = User.objects.using(read_database(user)).filter(
+            friendship__friends__user=user,
+        )
         if shuffle:
             qs = qs.order_by('?')
         return qs
@@ -155,13 +315,362 @@ class FriendshipManager(models.Manager):
         :type user2: |User|
         :rtype: |bool|
         """
-        friendship = Friendship.objects.get(user=user1)
-        return bool(friendship.friends.filter(user=user2).exists())
+        from snapshot import get_snapshot, are_friends
+        from bloom import might_be_friends
+        snapshot = get_snapshot(shard_database(user1))
+        if snapshot is not None:
+            return are_friends(snapshot, getattr(user1, 'pk', user1),
+                               getattr(user2, 'pk', user2))
+        if not might_be_friends(user1, user2):
+            return False
+        return FriendshipEdge.objects.using(
+            read_database(user1, user2),
+        ).filter(
+            from_friendship__user=user1,
+            to_friendship__user=user2,
+        ).exists()
+
+    def filter_friends(self, user, candidates):
+        """
+        Return which of ``candidates`` are friends of ``user``, to answer
+        many :meth:`are_friends` questions of a page at once.
+
+        Candidates ruled out by the :mod:`Bloom filter <friends.bloom>` of
+        ``user`` aren't queried, the others are checked with one query per
+        :attr:`BATCH_SIZE` candidates.
+
+        :param user: User to query friends.
+        :type user: |User|
+        :param candidates: Iterable of |User| instances or user ids.
+        :returns: |set| of the user ids of the candidates who are friends
+                  with ``user``.
+        """
+        from snapshot import get_snapshot, friend_ids
+        from bloom import get_filter
+        user_id = getattr(user, 'pk', user)
+        ids = set(getattr(candidate, 'pk', candidate)
+                  for candidate in candidates)
+        snapshot = get_snapshot(shard_database(user_id))
+        if snapshot is not None:
+            return ids.intersection(friend_ids(snapshot, user_id))
+        if app_settings.BLOOM_MIN_FRIENDS is not None:
+            bloom = get_filter(user_id)
+            if bloom is not None:
+                ids = set(candidate for candidate in ids if candidate in bloom)
+        friends = set()
+        ids = sorted(ids)
+        for i in xrange(0, len(ids), self.BATCH_SIZE):
+            friends.update(FriendshipEdge.objects.using(
+                read_database(user_id),
+            ).filter(
+                from_friendship__user=user_id,
+                to_friendship__user__in=ids[i:i + self.BATCH_SIZE],
+            ).values_list('to_friendship__user', flat=True))
+        return friends
+
+    def friend_ids(self, user, as_array=False):
+        """
+        List the ids of the friends of ``user``.
+
+        The ids are read from the through table and the
+        ``(id, user_id)`` index of :class:`Friendship`, without joining
+        ``auth_user``, which is enough for fan-outs and permission checks.
+
+        :param user: User to query friends.
+        :type user: |User|
+        :param |bool| as_array: Optional. Default ``False``. Return an
+                                :class:`~array.array` of C ``long``\ 's,
+                                which takes 8 bytes per friend instead of
+                                about 32 for a |list|.
+        :returns: Sorted |list| of |int|\ 's.
+        """
+        from snapshot import get_snapshot, friend_ids
+        snapshot = get_snapshot(shard_database(user))
+        if snapshot is not None:
+            ids = friend_ids(snapshot, getattr(user, 'pk', user))
+            return array('l', ids) if as_array else ids
+        ids = FriendshipEdge.objects.using(
+            read_database(user),
+        ).filter(
+            from_friendship__user=user,
+        ).order_by('to_friendship__user').values_list('to_friendship__user',
+                                                      flat=True)
+        if as_array:
+            return array('l', ids.iterator())
+        return list(ids)
+
+    def friend_rows(self, user, fields=('id', 'username')):
+        """
+        List some fields of the friends of ``user`` as tuples, for JSON APIs
+        and notifications that don't need |User| instances.
+
+        :param user: User to query friends.
+        :type user: |User|
+        :param fields: Optional. Default ``('id', 'username')``. Names of
+                       |User| fields, ``'id'`` alone doesn't join
+                       ``auth_user``.
+        :returns: ``values_list()`` :class:`~django.db.models.query.QuerySet`
+                  ordered by id.
+        """
+        return FriendshipEdge.objects.using(
+            read_database(user),
+        ).filter(
+            from_friendship__user=user,
+        ).order_by('to_friendship__user').values_list(*[
+            'to_friendship__user' if field in ('id', 'pk')
+            else 'to_friendship__user__%s' % field
+            for field in fields
+        ])
+
+    def mutual_friends(self, user1, user2):
+        """
+        List the friends ``user1`` and ``user2`` have in common.
+
+        This is a single query, unless the users belong to different shards,
+        in which case the friend ids read from both shards are intersected.
+
+        :param user1: User to compare with ``user2``.
+        :type user1: |User|
+        :param user2: User to compare with ``user1``.
+        :type user2: |User|
+        :returns: :class:`~django.db.models.query.QuerySet` of |User|\ 's.
+        """
+        shard = shard_database(user1)
+        if shard != shard_database(user2):
+            ids = set(self.friend_ids(user1)).intersection(
+                self.friend_ids(user2))
+            return User.objects.using(shard).filter(pk__in=ids)
+        return User.objects.using(read_database(user1, user2)).filter(
+            friendship__friends__user=user1,
+        ).filter(
+            friendship__friends__user=user2,
+        )
+
+    def relationship_summary(self, user, viewer=None):
+        """
+        Count the friends, pending friendship requests and blocks of
+        ``user``, for profile pages.
+
+        The counts are read with a single statement of scalar subqueries
+        instead of a query for each of the ``friends``,
+        ``friendshiprequests`` and ``blocks`` filters. With
+        :ref:`sharding <sharding>` the mutual friends of users of different
+        shards are counted with the queries of :meth:`mutual_friends`.
+
+        Blocks include those of the :class:`SharedBlocklist`\ 's, as
+        enforced by :meth:`UserBlocksManager.is_blocked`. They are counted
+        by the same statement unless sharding is enabled, in which case the
+        users subscribing to or listed in shared block lists take up to two
+        more queries each.
+
+        :param user: User whose relationships are counted.
+        :type user: |User|
+        :param viewer: Optional. User viewing the profile of ``user``, whose
+                       mutual friends with ``user`` are counted.
+        :type viewer: |User|
+        :returns: |dict| with the |int| ``friends``, ``requests_sent``,
+                  ``requests_received``, ``blocks_applied`` and
+                  ``blocks_received`` counts, and ``mutual_friends``, which
+                  is ``None`` without ``viewer``.
+        """
+        user_id = getattr(user, 'pk', user)
+        viewer_id = getattr(viewer, 'pk', viewer)
+        mutual = viewer_id is not None and viewer_id != user_id
+        using = read_database(*([user_id, viewer_id] if mutual
+                                else [user_id]))
+        subqueries = [
+            ('friends', 'SELECT COUNT(*) FROM {edges} e '
+             'INNER JOIN {friendship} f ON f.{friendship_id} = e.{from} '
+             'WHERE f.{user} = %s', [user_id]),
+            ('requests_sent', 'SELECT COUNT(*) FROM {requests} '
+             'WHERE {request_from} = %s AND {accepted} = %s',
+             [user_id, False]),
+            ('requests_received', 'SELECT COUNT(*) FROM {requests} '
+             'WHERE {request_to} = %s AND {accepted} = %s', [user_id, False]),
+        ]
+        if app_settings.SHARDS:
+            # Shared block lists are in FRIENDS_DATABASE, see below.
+            subqueries.extend([
+                ('blocks_applied', 'SELECT COUNT(*) FROM {blocks} b '
+                 'INNER JOIN {user_blocks} ub '
+                 'ON ub.{user_blocks_id} = b.{userblocks} '
+                 'WHERE ub.{blocks_user} = %s', [user_id]),
+                ('blocks_received', 'SELECT COUNT(*) FROM {blocks} '
+                 'WHERE {blocked} = %s', [user_id]),
+            ])
+        else:
+            subqueries.extend([
+                ('blocks_applied', 'SELECT COUNT(*) FROM ('
+                 'SELECT b.{blocked} AS u FROM {blocks} b '
+                 'INNER JOIN {user_blocks} ub '
+                 'ON ub.{user_blocks_id} = b.{userblocks} '
+                 'WHERE ub.{blocks_user} = %s UNION '
+                 'SELECT e.{entry} FROM {entries} e '
+                 'INNER JOIN {subscribers} s ON s.{subscriber_list} = '
+                 'e.{entry_list} WHERE s.{subscriber} = %s) t',
+                 [user_id, user_id]),
+                ('blocks_received', 'SELECT COUNT(*) FROM ('
+                 'SELECT ub.{blocks_user} AS u FROM {blocks} b '
+                 'INNER JOIN {user_blocks} ub '
+                 'ON ub.{user_blocks_id} = b.{userblocks} '
+                 'WHERE b.{blocked} = %s UNION '
+                 'SELECT s.{subscriber} FROM {subscribers} s '
+                 'INNER JOIN {entries} e ON e.{entry_list} = '
+                 's.{subscriber_list} WHERE e.{entry} = %s) t',
+                 [user_id, user_id]),
+            ])
+        if mutual and shard_database(user_id) == shard_database(viewer_id):
+            subqueries.append((
+                'mutual_friends', 'SELECT COUNT(*) FROM {edges} e1 '
+                'INNER JOIN {friendship} f1 ON f1.{friendship_id} = e1.{from} '
+                'INNER JOIN {edges} e2 ON e2.{to} = e1.{to} '
+                'INNER JOIN {friendship} f2 ON f2.{friendship_id} = e2.{from} '
+                'WHERE f1.{user} = %s AND f2.{user} = %s',
+                [user_id, viewer_id],
+            ))
+        cursor = connections[using].cursor()
+        cursor.execute(
+            'SELECT ' + ', '.join('(%s)' % sql for name, sql, params
+                                  in subqueries).format(**_sql_names(using)),
+            [param for name, sql, params in subqueries for param in params],
+        )
+        summary = dict(zip([name for name, sql, params in subqueries],
+                           cursor.fetchone()))
+        if not mutual:
+            summary['mutual_friends'] = None
+        elif 'mutual_friends' not in summary:
+            friends = set(self.friend_ids(user_id))
+            summary['mutual_friends'] = len(friends.intersection(
+                self.friend_ids(viewer_id)))
+        if app_settings.SHARDS:
+            self._count_shared_blocks(summary, user_id, using)
+        return summary
+
+    def _count_shared_blocks(self, summary, user_id, using):
+        """
+        Add the blocks of the shared block lists to the counts of
+        :meth:`relationship_summary`, with sharding.
+        """
+        lists = SharedBlocklist.objects.using(read_database())
+        if lists.filter(subscribers=user_id).exists():
+            summary['blocks_applied'] = UserBlocks.objects.blocked_users(
+                user_id).count()
+        subscribers = set(lists.filter(entries=user_id).values_list(
+            'subscribers', flat=True))
+        subscribers.discard(None)
+        if subscribers:
+            summary['blocks_received'] = len(subscribers.union(
+                UserBlocks.objects.using(using).filter(
+                    blocks=user_id,
+                ).values_list('user', flat=True)))
+
+    def search_friends(self, user, prefix, limit=10):
+        """
+        Find friends of ``user`` whose usernames start with ``prefix``,
+        ignoring case.
+
+        Friends of users with at least ``FRIENDS_SEARCH_CACHE_MIN_FRIENDS``
+        friends are kept in the cache as a sorted list and searched with
+        :func:`~bisect.bisect_left`. The lists are deleted when a friendship
+        changes and when a friend's username changes. Other users are
+        searched in the database starting from their own rows of the
+        ``friends`` through table.
+
+        :param user: User whose friends are searched.
+        :type user: |User|
+        :param prefix: Beginning of the usernames.
+        :type prefix: |unicode|
+        :param limit: Optional. Default ``10``. Maximum number of results.
+        :type limit: |int|
+        :returns: |list| of ``{'id': ..., 'username': ...}`` |dict|\ 's
+                  ordered by username. Cached lists are ordered ignoring
+                  case, database results using the database's collation.
+        """
+        prefix = prefix.lower()
+        key = self.SEARCH_KEY % getattr(user, 'pk', user)
+        names = cache.get(key) if SEARCH_CACHE_MIN_FRIENDS else False
+        rows = FriendshipEdge.objects.using(
+            read_database(user),
+        ).filter(
+            from_friendship__user=user,
+        ).values_list('to_friendship__user__username',
+                      'to_friendship__user__pk')
+        if names is False:
+            rows = rows.filter(
+                to_friendship__user__username__istartswith=prefix,
+            ).order_by('to_friendship__user__username')[:limit]
+            return [{'id': pk, 'username': username}
+                    for username, pk in rows]
+        if names is None:
+            names = sorted((username.lower(), username, pk)
+                           for username, pk in rows)
+            cache.set(key,
+                      names if len(names) >= SEARCH_CACHE_MIN_FRIENDS
+                      else False,
+                      SEARCH_CACHE_TIMEOUT)
+        result = []
+        for i in xrange(bisect_left(names, (prefix,)), len(names)):
+            if len(result) == limit or not names[i][0].startswith(prefix):
+                break
+            result.append({'id': names[i][2], 'username': names[i][1]})
+        return result
+
+    def recent_friends(self, user, limit=10):
+        """
+        List the most recently made friends of ``user``.
+
+        :param user: User to query friends.
+        :type user: |User|
+        :param limit: Optional. Default ``10``. Maximum number of friends.
+        :type limit: |int|
+        :returns: |list| of |User|\ 's, newest first, with a
+                  ``friends_since`` attribute set to the time the friendship
+                  was made.
+        """
+        return self._edge_users(FriendshipEdge.objects.using(
+            read_database(user),
+        ).filter(
+            from_friendship__user=user,
+        ).order_by('-created')[:limit])
+
+    def friends_since(self, user, since):
+        """
+        List the friends ``user`` made at or after ``since``.
+
+        :param user: User to query friends.
+        :type user: |User|
+        :param since: Earliest friendship time.
+        :type since: :class:`~datetime.datetime`
+        :returns: |list| of |User|\ 's, oldest first, with a
+                  ``friends_since`` attribute set to the time the friendship
+                  was made.
+        """
+        return self._edge_users(FriendshipEdge.objects.using(
+            read_database(user),
+        ).filter(
+            from_friendship__user=user,
+            created__gte=since,
+        ).order_by('created'))
+
+    def _edge_users(self, edges):
+        users = []
+        for edge in edges.select_related('to_friendship__user'):
+            friend = edge.to_friendship.user
+            friend.friends_since = edge.created
+            users.append(friend)
+        return users
 
     def befriend(self, user1, user2):
         """
         Establish friendship between ``user1`` and ``user2``.
 
+        Both directions of the friendship are inserted with a single
+        ``INSERT`` ignoring the existing ones (see
+        :func:`~friends.utils.insert_ignore`), followed by the ``DELETE`` of
+        the friendship request of ``user1`` to ``user2``. No model is
+        instantiated and :class:`FriendshipChange`\ 's are only recorded if a
+        direction was missing.
+
         .. important::
 
             Instead of calling this method directly,
@@ -170,34 +679,87 @@ class FriendshipManager(models.Manager):
             this method, should be used.
 
         :param user1: User to make friends with ``user2``.
-        :type user1: |User|
+        :type user1: |User| or user id
         :param user2: User to make friends with ``user1``.
-        :type user2: |User|
+        :type user2: |User| or user id
         """
-        friendship = Friendship.objects.get(user=user1)
-        friendship.friends.add(Friendship.objects.get(user=user2))
-        # Now that user1 accepted user2's friend request we should delete any
-        # request by user1 to user2 so that we don't have ambiguous data
-        FriendshipRequest.objects.filter(from_user=user1,
-                                         to_user=user2).delete()
+        user1, user2 = getattr(user1, 'pk', user1), getattr(user2, 'pk', user2)
+        databases = write_databases(user1, user2)
+        now = datetime.datetime.now()
+        with _atomic(*databases):
+            for db in databases:
+                names = _sql_names(db)
+                if shard_database(user1) is not None:
+                    # The Friendship records of the users of other shards.
+                    insert_ignore(db, Friendship, ['user_id'],
+                                  'SELECT %s AS {0} UNION ALL SELECT %s'
+                                  .format(names['user']),
+                                  [user1, user2], ['user_id'])
+                created = insert_ignore(
+                    db, FriendshipEdge,
+                    ['from_friendship_id', 'to_friendship_id', 'created'],
+                    'SELECT f1.{friendship_id} AS {from}, '
+                    'f2.{friendship_id} AS {to}, %s AS {created} '
+                    'FROM {friendship} f1, {friendship} f2 '
+                    'WHERE f1.{user} IN (%s, %s) AND f2.{user} IN (%s, %s) '
+                    'AND f1.{user} <> f2.{user}'.format(**names),
+                    [now, user1, user2, user1, user2],
+                    ['from_friendship_id', 'to_friendship_id'],
+                )
+                # Now that user1 accepted user2's friend request we should
+                # delete any request by user1 to user2 so that we don't have
+                # ambiguous data
+                execute(db, 'DELETE FROM {requests} WHERE {request_from} = %s '
+                        'AND {request_to} = %s', [user1, user2], **names)
+                if created:
+                    FriendshipChange.objects.record(FriendshipChange.BEFRIEND,
+                                                    user1, user2, db)
+        self._changed(user1, user2)
+        from bloom import added
+        added(user1, user2)
+        added(user2, user1)
 
     def unfriend(self, user1, user2):
         """
         Break friendship between ``user1`` and ``user2``.
 
+        Both directions of the friendship and the friendship requests between
+        the users are deleted with one ``DELETE`` each.
+
         :param user1: User to unfriend with ``user2``.
-        :type user1: |User|
+        :type user1: |User| or user id
         :param user2: User to unfriend with ``user1``.
-        :type user2: |User|
+        :type user2: |User| or user id
         """
-        # Break friendship link between users
-        friendship = Friendship.objects.get(user=user1)
-        friendship.friends.remove(Friendship.objects.get(user=user2))
-        # Delete FriendshipRequest's as well
-        FriendshipRequest.objects.filter(from_user=user1,
-                                         to_user=user2).delete()
-        FriendshipRequest.objects.filter(from_user=user2,
-                                         to_user=user1).delete()
+        user1, user2 = getattr(user1, 'pk', user1), getattr(user2, 'pk', user2)
+        databases = write_databases(user1, user2)
+        with _atomic(*databases):
+            for db in databases:
+                names = _sql_names(db)
+                # Break friendship link between users
+                friendships = ('SELECT {friendship_id} FROM {friendship} '
+                               'WHERE {user} IN (%s, %s)')
+                deleted = execute(db, 'DELETE FROM {edges} WHERE {from} IN (' +
+                                  friendships + ') AND {to} IN (' +
+                                  friendships + ')',
+                                  [user1, user2, user1, user2], **names)
+                # Delete FriendshipRequest's as well
+                execute(db, 'DELETE FROM {requests} '
+                        'WHERE ({request_from} = %s AND {request_to} = %s) '
+                        'OR ({request_from} = %s AND {request_to} = %s)',
+                        [user1, user2, user2, user1], **names)
+                if deleted:
+                    FriendshipChange.objects.record(FriendshipChange.UNFRIEND,
+                                                    user1, user2, db)
+        self._changed(user1, user2)
+        from bloom import removed
+        removed(user1)
+        removed(user2)
+
+    def _changed(self, *users):
+        pin_users(*users)
+        cache.delete_many([self.SEARCH_KEY % getattr(user, 'pk', user)
+                           for user in users])
 
 
 class Friendship(models.Model):
@@ -210,9 +772,12 @@ class Friendship(models.Model):
     |OneToOneField| to |User| whose friends are stored.
     """
 
-    friends = models.ManyToManyField('self', symmetrical=True)
+    friends = models.ManyToManyField('self', symmetrical=False,
+                                     through='FriendshipEdge')
     """
-    Symmetrical |ManyToManyField| to :class:`Friendship`.
+    |ManyToManyField| to :class:`Friendship` through :class:`FriendshipEdge`.
+
+    Friendships are symmetrical, an edge is stored in both directions.
 
     .. seealso::
 
@@ -233,11 +798,15 @@ class Friendship(models.Model):
     def friend_count(self):
         """
         Return the count of :attr:`~Friendship.friends`.
-        This method is used in :class:`~friends.admin.FriendshipAdmin`.
+        This method is used in :class:`~friends.admin.FriendshipAdmin`, which
+        selects the count along with the :class:`Friendship`.
 
         :rtype: |int|
         """
-        return self.friends.count()
+        count = getattr(self, '_friend_count', None)
+        if count is None:
+            count = self.friends.count()
+        return count
     friend_count.short_description = _(u'Friends count')
 
     def friend_summary(self, count=7):
@@ -249,12 +818,215 @@ class Friendship(models.Model):
         :param |int| count: Maximum number of friends to include in the output.
         :rtype: |unicode|
         """
-        friend_list = self.friends.all().select_related(depth=1)[:count]
-        return u'[%s%s]' % (u', '.join(unicode(f.user) for f in friend_list),
+        names = getattr(self, '_friend_names', None)
+        if names is None:
+            names = [unicode(f.user) for f in
+                     self.friends.all().select_related(depth=1)[:count]]
+        return u'[%s%s]' % (u', '.join(names[:count]),
                             u', ...' if self.friend_count() > count else u'')
     friend_summary.short_description = _(u'Summary of friends')
 
 
+class FriendshipEdge(models.Model):
+    """
+    One direction of a friendship, the intermediary model of
+    :attr:`Friendship.friends`.
+
+    The table is the one Django used to create for the symmetrical
+    :attr:`Friendship.friends`, with the addition of
+    :attr:`~FriendshipEdge.created` and an index on
+    ``(from_friendship_id, created)``. Run the ``friends_migrate_edges``
+    management command to upgrade an existing table.
+    """
+
+    from_friendship = models.ForeignKey(Friendship, related_name='+')
+    """
+    :class:`~django.db.models.ForeignKey` to the :class:`Friendship` of the
+    user whose friend is stored.
+    """
+
+    to_friendship = models.ForeignKey(Friendship, related_name='+')
+    """
+    :class:`~django.db.models.ForeignKey` to the :class:`Friendship` of the
+    friend.
+    """
+
+    created = models.DateTimeField(default=datetime.datetime.now,
+                                   editable=False)
+    """
+    :class:`~django.db.models.DateTimeField` set when the friendship is made.
+    """
+
+    class Meta:
+        db_table = 'friends_friendship_friends'
+        unique_together = (('from_friendship', 'to_friendship'),)
+        verbose_name = _(u'friendship edge')
+        verbose_name_plural = _(u'friendship edges')
+
+    def __unicode__(self):
+        return u'%s -> %s' % (self.from_friendship_id, self.to_friendship_id)
+
+
+class UserBlocksManager(models.Manager):
+    def block(self, user, target):
+        """
+        Add ``target`` to the blocks of ``user``.
+
+        .. seealso::
+
+            :class:`~friends.views.UserBlockView`
+
+        :param user: Blocking user.
+        :type user: |User|
+        :param target: User to block.
+        :type target: |User|
+        :returns: ``False`` if ``target`` was already blocked.
+        :rtype: |bool|
+        """
+        databases = write_databases(user, target)
+        with _atomic(*databases):
+            blocks = [_get_or_create(UserBlocks, db, user) for db in databases]
+            if blocks[0].blocks.filter(pk=target.pk).exists():
+                return False
+            for user_blocks in blocks:
+                user_blocks.blocks.add(target)
+                FriendshipChange.objects.record(FriendshipChange.BLOCK, user,
+                                                target, user_blocks._state.db)
+        pin_users(user, target)
+        return True
+
+    def unblock(self, user, target):
+        """
+        Remove ``target`` from the blocks of ``user``.
+
+        .. seealso::
+
+            :class:`~friends.views.UserUnblockView`
+
+        :param user: Blocking user.
+        :type user: |User|
+        :param target: User to unblock.
+        :type target: |User|
+        :returns: ``False`` if ``target`` wasn't blocked.
+        :rtype: |bool|
+        """
+        databases = write_databases(user, target)
+        with _atomic(*databases):
+            blocks = [_get_or_create(UserBlocks, db, user) for db in databases]
+            if not blocks[0].blocks.filter(pk=target.pk).exists():
+                return False
+            for user_blocks in blocks:
+                user_blocks.blocks.remove(target)
+                FriendshipChange.objects.record(FriendshipChange.UNBLOCK, user,
+                                                target, user_blocks._state.db)
+        pin_users(user, target)
+        return True
+
+    def block_many(self, user, targets, batch_size=500):
+        """
+        Add ``targets`` to the blocks of ``user`` with one ``INSERT`` per
+        ``batch_size`` targets, ignoring those already blocked (see
+        :func:`~friends.utils.insert_ignore`). Each batch is written in its
+        own transaction.
+
+        .. seealso::
+
+            :func:`~friends.blocklists.import_blocks`
+
+        :param user: Blocking user.
+        :type user: |User|
+        :param targets: Iterable of |User| instances or user ids.
+        :param |int| batch_size: Optional. Number of targets per batch.
+        :returns: |list| of the ids of the users who weren't blocked yet.
+        """
+        return self._modify_many(user, targets, batch_size, True)
+
+    def unblock_many(self, user, targets, batch_size=500):
+        """
+        Remove ``targets`` from the blocks of ``user`` with one ``DELETE``
+        per ``batch_size`` targets.
+
+        :param user: Blocking user.
+        :type user: |User|
+        :param targets: Iterable of |User| instances or user ids.
+        :param |int| batch_size: Optional. Number of targets per batch.
+        :returns: |list| of the ids of the users who were blocked.
+        """
+        return self._modify_many(user, targets, batch_size, False)
+
+    def blocked_users(self, user):
+        """
+        List the users blocked by ``user``, directly or through the
+        :class:`SharedBlocklist`\ 's it subscribes to.
+
+        Subscriptions aren't copied to :attr:`UserBlocks.blocks`, both are
+        evaluated by the same query with ``IN`` subqueries. With
+        :ref:`sharding <sharding>` the entries of the shared block lists,
+        which are stored in ``FRIENDS_DATABASE``, are read first.
+
+        :param user: Blocking user.
+        :type user: |User|
+        :returns: :class:`~django.db.models.query.QuerySet` of |User|\ 's.
+        """
+        db = read_database(user)
+        shared = SharedBlocklist.entries.through.objects.filter(
+            sharedblocklist__subscribers=user,
+        ).values_list('user', flat=True)
+        if app_settings.SHARDS:
+            shared = list(shared.using(read_database()))
+        else:
+            shared = shared.using(db)
+        return User.objects.using(db).filter(
+            Q(pk__in=UserBlocks.blocks.through.objects.using(db).filter(
+                userblocks__user=user,
+            ).values_list('user', flat=True)) |
+            Q(pk__in=shared)
+        )
+
+    def is_blocked(self, user, target):
+        """
+        Indicate if ``user`` blocks ``target``, directly or through a
+        :class:`SharedBlocklist`, see :meth:`blocked_users`.
+
+        :param user: Blocking user.
+        :type user: |User|
+        :param target: |User| instance or user id.
+        :rtype: |bool|
+        """
+        return self.blocked_users(user).filter(
+            pk=getattr(target, 'pk', target),
+        ).exists()
+
+    def _modify_many(self, user, targets, batch_size, block):
+        through = UserBlocks.blocks.through
+        ids = sorted(set(getattr(target, 'pk', target) for target in targets))
+        ids = [target_id for target_id in ids if target_id != user.pk]
+        modified = []
+        for i in xrange(0, len(ids), batch_size):
+            batch = ids[i:i + batch_size]
+            databases = write_databases(user, *batch)
+            own = write_database(user)
+            with _atomic(*databases):
+                blocks = dict((db, _get_or_create(UserBlocks, db, user).pk)
+                              for db in databases)
+                existing = set(through.objects.using(own).filter(
+                    userblocks=blocks[own],
+                    user__in=batch,
+                ).values_list('user', flat=True))
+                batch = [target_id for target_id in batch
+                         if (target_id in existing) != block]
+                if not batch:
+                    continue
+                for db in databases:
+                    _modify_blocks(db, user, blocks[db], [
+                        target_id for target_id in batch
+                        if db == own or write_database(target_id) == db
+                    ], block)
+            modified.extend(batch)
+        pin_users(user, *modified)
+        return modified
+
+
 class UserBlocks(models.Model):
     """
     |User|'s blocked by :attr:`~UserBlocks.user`.
@@ -270,6 +1042,8 @@ class UserBlocks(models.Model):
     |ManyToManyField| to containing blocked |User|'s.
     """
 
+    objects = UserBlocksManager()
+
     class Meta:
         verbose_name = verbose_name_plural = _(u'user blocks')
 
@@ -279,11 +1053,15 @@ class UserBlocks(models.Model):
     def block_count(self):
         """
         Return the count of :attr:`~UserBlocks.blocks`.
-        This method is used in :class:`~friends.admin.UserBlocksAdmin`.
+        This method is used in :class:`~friends.admin.UserBlocksAdmin`, which
+        selects the count along with the :class:`UserBlocks`.
 
         :rtype: |int|
         """
-        return self.blocks.count()
+        count = getattr(self, '_block_count', None)
+        if count is None:
+            count = self.blocks.count()
+        return count
     block_count.short_description = _(u'Blocks count')
 
     def block_summary(self, count=7):
@@ -296,12 +1074,423 @@ class UserBlocks(models.Model):
                             the output.
         :rtype: |unicode|
         """
-        block_list = self.blocks.all()[:count]
-        return u'[%s%s]' % (u', '.join(unicode(user) for user in block_list),
+        names = getattr(self, '_block_names', None)
+        if names is None:
+            names = [unicode(user) for user in self.blocks.all()[:count]]
+        return u'[%s%s]' % (u', '.join(names[:count]),
                             u', ...' if self.block_count() > count else u'')
     block_summary.short_description = _(u'Summary of blocks')
 
 
+class SharedBlocklistManager(models.Manager):
+    def add_entries(self, blocklist, users, batch_size=500):
+        """
+        Add ``users`` to the entries of ``blocklist`` with one ``INSERT``
+        per ``batch_size`` users, ignoring those already in it.
+
+        :param blocklist: Block list.
+        :type blocklist: :class:`SharedBlocklist`
+        :param users: Iterable of |User| instances or user ids.
+        :param |int| batch_size: Optional. Number of users per ``INSERT``.
+        :returns: Number of entries added.
+        """
+        using = blocklist._state.db or write_database()
+        qn = connections[using].ops.quote_name
+        through = SharedBlocklist.entries.through
+        columns = [through._meta.get_field('sharedblocklist').column,
+                   through._meta.get_field('user').column]
+        ids = sorted(set(getattr(user, 'pk', user) for user in users))
+        added = 0
+        for i in xrange(0, len(ids), batch_size):
+            batch = ids[i:i + batch_size]
+            with _atomic(using):
+                added += insert_ignore(
+                    using, through, columns,
+                    'SELECT %s AS {0}, u.{1} AS {2} FROM {3} u '
+                    'WHERE u.{1} IN ({4})'.format(
+                        qn(columns[0]), qn(User._meta.pk.column),
+                        qn(columns[1]), qn(User._meta.db_table),
+                        ', '.join(['%s'] * len(batch)),
+                    ),
+                    [blocklist.pk] + batch, columns,
+                )
+        return added
+
+    def remove_entries(self, blocklist, users, batch_size=500):
+        """
+        Remove ``users`` from the entries of ``blocklist`` with one
+        ``DELETE`` per ``batch_size`` users.
+
+        :param blocklist: Block list.
+        :type blocklist: :class:`SharedBlocklist`
+        :param users: Iterable of |User| instances or user ids.
+        :param |int| batch_size: Optional. Number of users per ``DELETE``.
+        :returns: Number of entries removed.
+        """
+        using = blocklist._state.db or write_database()
+        qn = connections[using].ops.quote_name
+        through = SharedBlocklist.entries.through._meta
+        ids = sorted(set(getattr(user, 'pk', user) for user in users))
+        removed = 0
+        for i in xrange(0, len(ids), batch_size):
+            batch = ids[i:i + batch_size]
+            with _atomic(using):
+                removed += execute(
+                    using, 'DELETE FROM {table} WHERE {blocklist} = %s '
+                    'AND {user} IN ({ids})', [blocklist.pk] + batch,
+                    table=qn(through.db_table),
+                    blocklist=qn(through.get_field('sharedblocklist').column),
+                    user=qn(through.get_field('user').column),
+                    ids=', '.join(['%s'] * len(batch)),
+                )
+        return removed
+
+
+class SharedBlocklist(models.Model):
+    """
+    A list of users blocked by every subscriber of the list, for block lists
+    maintained by trust and safety staff or shared between users.
+
+    Entries aren't copied to the :attr:`UserBlocks.blocks` of the
+    subscribers, see :meth:`UserBlocksManager.blocked_users`. Shared block
+    lists are stored in ``FRIENDS_DATABASE``, even when
+    :ref:`sharding <sharding>` is enabled.
+    """
+
+    name = models.CharField(max_length=100, unique=True)
+    """
+    :class:`~django.db.models.CharField` containing the unique name of the
+    list.
+    """
+
+    owner = models.ForeignKey(User, related_name='owned_blocklists',
+                              null=True, blank=True,
+                              on_delete=models.SET_NULL)
+    """
+    :class:`~django.db.models.ForeignKey` to the |User| maintaining the list,
+    if any. The list is kept, without an owner, when the |User| is deleted.
+    """
+
+    entries = models.ManyToManyField(User, related_name='blocklist_entries',
+                                     blank=True)
+    """
+    |ManyToManyField| to the blocked |User|'s.
+    """
+
+    subscribers = models.ManyToManyField(
+        User,
+        related_name='blocklist_subscriptions',
+        blank=True,
+    )
+    """
+    |ManyToManyField| to the |User|'s blocking the :attr:`entries`.
+    """
+
+    created = models.DateTimeField(default=datetime.datetime.now,
+                                   editable=False)
+    """
+    :class:`~django.db.models.DateTimeField` set when the object is created.
+    """
+
+    objects = SharedBlocklistManager()
+
+    class Meta:
+        verbose_name = _(u'shared block list')
+        verbose_name_plural = _(u'shared block lists')
+
+    def __unicode__(self):
+        return self.name
+
+
+class FriendshipChangeManager(models.Manager):
+    def record(self, action, user, other, using=None):
+        """
+        Record ``action`` made by ``user`` on its relationship with
+        ``other``.
+
+        This should be called in the same transaction as the modification.
+
+        :param user: |User| instance or id.
+        :param other: |User| instance or id.
+        :param using: Optional. Database alias, defaults to
+                      :func:`~friends.routers.write_database`.
+        """
+        self.record_many([(action, user, other)], using)
+
+    def record_many(self, changes, using=None, batch_size=500):
+        """
+        Record many changes with batched inserts, for bulk operations.
+
+        :param changes: Iterable of ``(action, user, other)`` tuples.
+        :param using: Optional. Database alias.
+        :param |int| batch_size: Optional. Number of rows per ``INSERT``.
+        """
+        now = datetime.datetime.now()
+        objs = []
+        for action, user, other in changes:
+            user = getattr(user, 'pk', user)
+            other = getattr(other, 'pk', other)
+            objs.append(FriendshipChange(user_id=user, other_id=other,
+                                         action=action, outgoing=True,
+                                         created=now))
+            objs.append(FriendshipChange(user_id=other, other_id=user,
+                                         action=action, outgoing=False,
+                                         created=now))
+        self.using(using or write_database()).bulk_create(
+            objs,
+            batch_size=batch_size,
+        )
+
+    def committed_seq(self, using=None):
+        """
+        Return the id of the latest change recorded at least
+        ``FRIENDS_CHANGE_COMMIT_LAG`` seconds ago.
+
+        Ids are handed out when changes are inserted, not when their
+        transaction commits, so on databases running concurrent transactions
+        a change can become visible after changes with higher ids. Every
+        change up to the returned id is assumed to be committed.
+
+        :param using: Optional. Database alias, defaults to
+                      :func:`~friends.routers.read_database`.
+        :rtype: |int|
+        """
+        cutoff = datetime.datetime.now() - datetime.timedelta(
+            seconds=app_settings.CHANGE_COMMIT_LAG)
+        seq = self.using(using or read_database()).filter(
+            created__lt=cutoff,
+        ).order_by('-id').values_list('id', flat=True)[:1]
+        return seq[0] if seq else 0
+
+    def read_changes(self, after=0, limit=100, user=None):
+        """
+        Read the changes recorded after the change with id ``after``.
+
+        Use the :attr:`~FriendshipChange.id` of the last change returned as
+        ``after`` to read the next page.
+
+        :param |int| after: Optional. Default ``0``. Cursor.
+        :param |int| limit: Optional. Default ``100``. Maximum number of
+                            changes.
+        :param user: Optional. If given only the changes of this user are
+                     read, otherwise every change is read once, from the
+                     perspective of the user who made it.
+        :returns: |list| of :class:`FriendshipChange`\ 's in sequence order.
+        """
+        if user is None:
+            changes = self.filter(outgoing=True).using(read_database())
+        else:
+            changes = self.filter(user_id=getattr(user, 'pk', user)).using(
+                read_database(user))
+        return list(changes.filter(
+            id__gt=after,
+        ).order_by('id')[:limit])
+
+
+class FriendshipChange(models.Model):
+    """
+    A modification of the friendship graph, friendship requests or blocks.
+
+    Changes are written in the same transaction as the modification and only
+    ever appended, their :attr:`~FriendshipChange.id` is therefore a
+    monotonically increasing sequence number, see
+    :meth:`FriendshipChangeManager.read_changes`. Read mode snapshots (see
+    :mod:`friends.snapshot`) use it to overlay modifications made after they
+    were built. Old changes are removed with the ``friends_compact_changes``
+    management command, which keeps those made after the current snapshot.
+
+    Every change is recorded once for each user whose relationships it
+    modifies, so that the changes of a single user can be read with the
+    ``(user_id, id)`` index.
+    """
+
+    BEFRIEND = 'befriend'
+    UNFRIEND = 'unfriend'
+    REQUEST = 'request'
+    ACCEPT = 'accept'
+    DECLINE = 'decline'
+    CANCEL = 'cancel'
+    BLOCK = 'block'
+    UNBLOCK = 'unblock'
+    ACTION_CHOICES = (
+        (BEFRIEND, _(u'befriend')),
+        (UNFRIEND, _(u'unfriend')),
+        (REQUEST, _(u'request friendship')),
+        (ACCEPT, _(u'accept friendship')),
+        (DECLINE, _(u'decline friendship')),
+        (CANCEL, _(u'cancel friendship request')),
+        (BLOCK, _(u'block')),
+        (UNBLOCK, _(u'unblock')),
+    )
+
+    user_id = models.IntegerField()
+    """
+    Id of the |User| whose relationships are modified.
+
+    Plain integers are stored instead of foreign keys so that changes outlive
+    the users they refer to.
+    """
+
+    other_id = models.IntegerField()
+    """
+    Id of the other |User| of the relationship.
+    """
+
+    action = models.CharField(max_length=16, choices=ACTION_CHOICES)
+    """
+    Type of the modification.
+    """
+
+    outgoing = models.BooleanField(default=True)
+    """
+    ``True`` if the modification is made by :attr:`~FriendshipChange.user_id`,
+    such as a sent friendship request or a block, ``False`` if it is made by
+    :attr:`~FriendshipChange.other_id`.
+    """
+
+    created = models.DateTimeField(default=datetime.datetime.now,
+                                   editable=False)
+    """
+    :class:`~django.db.models.DateTimeField` set when the object is created.
+    """
+
+    objects = FriendshipChangeManager()
+
+    class Meta:
+        verbose_name = _(u'friendship change')
+        verbose_name_plural = _(u'friendship changes')
+
+    def __unicode__(self):
+        return u'#%d %s %d %d' % (self.pk, self.action, self.user_id,
+                                  self.other_id)
+
+
+@contextmanager
+def _atomic(*databases):
+    """
+    Run the block in a transaction on each of ``databases``, unless a
+    transaction is already being managed on it, in which case the block
+    becomes a part of it.
+
+    The transactions are committed in the reverse order of ``databases``
+    and all of them are rolled back if the block raises an exception.
+    """
+    if not databases:
+        yield
+    elif transaction.is_managed(using=databases[0]):
+        with _atomic(*databases[1:]):
+            yield
+    else:
+        with transaction.commit_on_success(using=databases[0]):
+            with _atomic(*databases[1:]):
+                yield
+
+
+def _sql_names(using):
+    """
+    Return the quoted table and column names of the raw SQL statements.
+    """
+    qn = connections[using].ops.quote_name
+    edges = FriendshipEdge._meta
+    requests = FriendshipRequest._meta
+    blocks = UserBlocks.blocks.through._meta
+    entries = SharedBlocklist.entries.through._meta
+    subscribers = SharedBlocklist.subscribers.through._meta
+    return {
+        'edges': qn(edges.db_table),
+        'from': qn(edges.get_field('from_friendship').column),
+        'to': qn(edges.get_field('to_friendship').column),
+        'created': qn(edges.get_field('created').column),
+        'friendship': qn(Friendship._meta.db_table),
+        'friendship_id': qn(Friendship._meta.pk.column),
+        'user': qn(Friendship._meta.get_field('user').column),
+        'requests': qn(requests.db_table),
+        'request_from': qn(requests.get_field('from_user').column),
+        'request_to': qn(requests.get_field('to_user').column),
+        'accepted': qn(requests.get_field('accepted').column),
+        'blocks': qn(blocks.db_table),
+        'userblocks': qn(blocks.get_field('userblocks').column),
+        'blocked': qn(blocks.get_field('user').column),
+        'user_blocks': qn(UserBlocks._meta.db_table),
+        'user_blocks_id': qn(UserBlocks._meta.pk.column),
+        'blocks_user': qn(UserBlocks._meta.get_field('user').column),
+        'entries': qn(entries.db_table),
+        'entry_list': qn(entries.get_field('sharedblocklist').column),
+        'entry': qn(entries.get_field('user').column),
+        'subscribers': qn(subscribers.db_table),
+        'subscriber_list': qn(subscribers.get_field('sharedblocklist').column),
+        'subscriber': qn(subscribers.get_field('user').column),
+    }
+
+
+def _get_or_create(model, using, user):
+    """
+    Return the :class:`Friendship` or :class:`UserBlocks` record of ``user``,
+    creating it if it is missing, as it is in the shards of other users until
+    they make a relationship with ``user``.
+    """
+    try:
+        return model.objects.using(using).get(user=user)
+    except model.DoesNotExist:
+        return model.objects.using(using).create(user=user)
+
+
+def _modify_blocks(using, user, blocks_id, target_ids, block):
+    """
+    Insert, or delete, the rows of ``target_ids`` in the blocks of ``user``,
+    whose :class:`UserBlocks` record is ``blocks_id``, and record the
+    changes.
+    """
+    if not target_ids:
+        return
+    qn = connections[using].ops.quote_name
+    through = UserBlocks.blocks.through
+    columns = [through._meta.get_field('userblocks').column,
+               through._meta.get_field('user').column]
+    names = {
+        'blocks': qn(through._meta.db_table),
+        'userblocks': qn(columns[0]),
+        'user': qn(columns[1]),
+        'users': qn(User._meta.db_table),
+        'user_id': qn(User._meta.pk.column),
+        'ids': ', '.join(['%s'] * len(target_ids)),
+    }
+    if block:
+        insert_ignore(using, through, columns,
+                      'SELECT %s AS {userblocks}, u.{user_id} AS {user} '
+                      'FROM {users} u WHERE u.{user_id} IN ({ids})'
+                      .format(**names),
+                      [blocks_id] + target_ids, columns)
+        action = FriendshipChange.BLOCK
+    else:
+        execute(using, 'DELETE FROM {blocks} WHERE {userblocks} = %s '
+                'AND {user} IN ({ids})', [blocks_id] + target_ids, **names)
+        action = FriendshipChange.UNBLOCK
+    FriendshipChange.objects.record_many([
+        (action, user, target_id) for target_id in target_ids
+    ], using)
+
+
+def _lock_users(using, *users):
+    """
+    Lock the :class:`Friendship` rows of ``users`` until the end of the
+    current transaction.
+
+    Backends without ``SELECT ... FOR UPDATE`` support, such as SQLite, take
+    their write lock with a no-op ``UPDATE`` instead.
+    """
+    queryset = Friendship.objects.using(using).filter(
+        user__in=[getattr(user, 'pk', user) for user in users],
+    ).order_by('pk')
+    if connections[using].features.has_select_for_update:
+        list(queryset.select_for_update().values_list('pk', flat=True))
+    else:
+        queryset.update(user=models.F('user'))
+    # Make sure the transaction is committed, releasing the locks, even if
+    # nothing else is written.
+    transaction.set_dirty(using=using)
+
+
 # Signal connections
 models.signals.post_save.connect(
     signals.create_friendship_instance,
@@ -313,3 +1502,13 @@ models.signals.post_save.connect(
     sender=User,
     dispatch_uid='friends.signals.create_userblocks_instance',
 )
+models.signals.pre_save.connect(
+    signals.remember_username,
+    sender=User,
+    dispatch_uid='friends.signals.remember_username',
+)
+models.signals.post_save.connect(
+    signals.invalidate_friend_search,
+    sender=User,
+    dispatch_uid='friends.signals.invalidate_friend_search',
+)
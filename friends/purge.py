@@ -0,0 +1,165 @@
+"""
+Purge
+=====
+
+Removal of all the relationship data of a |User|, for account deletion. See
+the ``friends_purge_user`` management command.
+
+Deleting a |User| with :meth:`~django.db.models.Model.delete` makes Django
+load every related friendship, friendship request and block into memory
+before deleting them in one long transaction. :func:`purge_user` deletes
+them in chunks of primary keys instead, one short transaction per chunk,
+without instantiating any models. The friends and blockers of the user get
+their :class:`~friends.models.FriendshipChange`\ 's, read-your-writes pins and
+search cache invalidations in bulk, once per chunk. The |User| can then be
+deleted cheaply.
+
+When :ref:`sharding <sharding>` is enabled the rows of the user are deleted
+from every shard, the shard of the user last so that a purge that fails can
+be run again.
+
+.. autofunction:: purge_user
+"""
+
+
+from django.db import connections, transaction
+from models import Friendship, FriendshipEdge, FriendshipRequest, \
+                   FriendshipChange, UserBlocks
+from routers import write_database, pin_users
+from utils import keyset_iterator
+import app_settings
+
+
+def purge_user(user, chunk_size=1000, using=None):
+    """
+    Delete the friendships, friendship requests, blocks and changes of
+    ``user`` along with its :class:`~friends.models.Friendship` and
+    :class:`~friends.models.UserBlocks` records.
+
+    :param user: User being deleted.
+    :type user: |User|
+    :param |int| chunk_size: Optional. Number of rows deleted per
+                             transaction.
+    :param using: Optional. Database alias, defaults to
+                  :func:`~friends.routers.write_database`, or to all the
+                  shards if sharding is enabled.
+    :returns: |dict| with the number of ``friends``, ``requests`` and
+              ``blocks`` deleted.
+    """
+    if using is not None or not app_settings.SHARDS:
+        return _purge(user, chunk_size, using or write_database())
+    own = write_database(user)
+    for shard in app_settings.SHARDS:
+        if shard != own:
+            _purge(user, chunk_size, shard)
+    # Every relationship of the user is stored in its shard as well.
+    return _purge(user, chunk_size, own)
+
+
+def _purge(user, chunk_size, using):
+    counts = {'friends': 0, 'requests': 0, 'blocks': 0}
+    edges = FriendshipEdge.objects.using(using)
+    friendship = list(Friendship.objects.using(using).filter(
+        user=user).values_list('pk', flat=True))
+    if friendship:
+        friendship = friendship[0]
+        for chunk in _chunks(edges.filter(from_friendship=friendship)
+                             .values_list('pk', 'to_friendship',
+                                          'to_friendship__user'), chunk_size):
+            with transaction.commit_on_success(using=using):
+                _delete(using, FriendshipEdge, [row[0] for row in chunk])
+                _execute(using, 'DELETE FROM {table} WHERE {to} = %s AND '
+                         '{from_} IN ({ids})', FriendshipEdge,
+                         [friendship] + [row[1] for row in chunk],
+                         ids=len(chunk),
+                         to=FriendshipEdge._meta.get_field(
+                             'to_friendship').column,
+                         from_=FriendshipEdge._meta.get_field(
+                             'from_friendship').column)
+                _record(using, FriendshipChange.UNFRIEND, user,
+                        [row[2] for row in chunk])
+            counts['friends'] += len(chunk)
+        # Friendships only stored in the other direction.
+        for chunk in _chunks(edges.filter(to_friendship=friendship)
+                             .values_list('pk', 'from_friendship__user'),
+                             chunk_size):
+            with transaction.commit_on_success(using=using):
+                _delete(using, FriendshipEdge, [row[0] for row in chunk])
+                _record(using, FriendshipChange.UNFRIEND, user,
+                        [row[1] for row in chunk])
+            counts['friends'] += len(chunk)
+    requests = FriendshipRequest.objects.using(using)
+    for action, queryset, other in (
+        (FriendshipChange.CANCEL, requests.filter(from_user=user), 'to_user'),
+        (FriendshipChange.DECLINE, requests.filter(to_user=user),
+         'from_user'),
+    ):
+        for chunk in _chunks(queryset.values_list('pk', other, 'accepted'),
+                             chunk_size):
+            with transaction.commit_on_success(using=using):
+                _delete(using, FriendshipRequest, [row[0] for row in chunk])
+                _record(using, action, user,
+                        [row[1] for row in chunk if not row[2]])
+            counts['requests'] += len(chunk)
+    blocks = UserBlocks.blocks.through.objects.using(using)
+    for chunk in _chunks(blocks.filter(userblocks__user=user).values_list(
+            'pk', 'user'), chunk_size):
+        with transaction.commit_on_success(using=using):
+            _delete(using, UserBlocks.blocks.through,
+                    [row[0] for row in chunk])
+            _record(using, FriendshipChange.UNBLOCK, user,
+                    [row[1] for row in chunk])
+        counts['blocks'] += len(chunk)
+    for chunk in _chunks(blocks.filter(user=user).values_list(
+            'pk', 'userblocks__user'), chunk_size):
+        with transaction.commit_on_success(using=using):
+            _delete(using, UserBlocks.blocks.through,
+                    [row[0] for row in chunk])
+            FriendshipChange.objects.record_many([
+                (FriendshipChange.UNBLOCK, row[1], user.pk) for row in chunk
+            ], using)
+        pin_users(*[row[1] for row in chunk])
+        counts['blocks'] += len(chunk)
+    with transaction.commit_on_success(using=using):
+        for model in (Friendship, UserBlocks):
+            _execute(using, 'DELETE FROM {table} WHERE {user} = %s', model,
+                     [user.pk], user=model._meta.get_field('user').column)
+    for chunk in _chunks(FriendshipChange.objects.using(using).filter(
+            user_id=user.pk).values_list('pk'), chunk_size):
+        with transaction.commit_on_success(using=using):
+            _delete(using, FriendshipChange, [row[0] for row in chunk])
+    return counts
+
+
+def _chunks(queryset, chunk_size):
+    chunk = []
+    for row in keyset_iterator(queryset, chunk_size):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _record(using, action, user, other_ids):
+    if other_ids:
+        FriendshipChange.objects.record_many([
+            (action, user.pk, other_id) for other_id in other_ids
+        ], using)
+        Friendship.objects._changed(*other_ids)
+
+
+def _delete(using, model, pks):
+    _execute(using, 'DELETE FROM {table} WHERE {pk} IN ({ids})', model, pks,
+             ids=len(pks), pk=model._meta.pk.column)
+
+
+def _execute(using, sql, model, params, ids=0, **columns):
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    names = dict((name, qn(column)) for name, column in columns.iteritems())
+    cursor = connection.cursor()
+    cursor.execute(sql.format(table=qn(model._meta.db_table),
+                              ids=', '.join(['%s'] * ids), **names), params)
+    transaction.set_dirty(using=using)
@@ -0,0 +1,214 @@
+"""
+Database Routing
+================
+
+:class:`FriendsRouter` sends the models of :mod:`friends` to a dedicated
+database alias and spreads their reads over replicas. Enable it in your
+settings::
+
+    DATABASE_ROUTERS = ['friends.routers.FriendsRouter']
+    FRIENDS_DATABASE = 'friends'
+    FRIENDS_READ_DATABASES = ['friends_replica1', 'friends_replica2']
+
+.. important::
+
+    Some queries, such as
+    :meth:`~friends.models.FriendshipManager.friends_of`, join the tables of
+    this app with ``auth_user``. Every alias used here must therefore carry
+    (a replica of) the ``auth`` tables as well.
+
+To avoid showing stale relationships because of replication lag, users are
+pinned to ``FRIENDS_DATABASE`` for ``FRIENDS_READ_STICKINESS`` seconds after
+a friendship or block of theirs is modified. Pins are stored in the default
+cache, so they are shared by all processes.
+
+.. _sharding:
+
+Sharding
+--------
+
+The relationships can instead be spread over several databases keyed by user
+id, each user belonging to ``FRIENDS_SHARDS[user_id % len(FRIENDS_SHARDS)]``::
+
+    FRIENDS_SHARDS = ['friends_shard0', 'friends_shard1', 'friends_shard2']
+
+Every row is stored in the shard of each user it concerns: a friendship is
+written in both directions, along with the :class:`~friends.models.Friendship`
+records it refers to, to the shards of both friends, and so are friendship
+requests, blocks and their :class:`~friends.models.FriendshipChange`\ 's. All
+the relationships of a user can therefore be read from a single shard, which
+is what :func:`read_database` returns, while modifications open a transaction
+on both shards and commit them one after the other.
+
+.. warning::
+
+    This is not a two-phase commit. If the second commit fails, for instance
+    because its database went away, the modification is only stored in the
+    shard committed first and the two users see different relationships.
+    ``friends_check`` can't detect it as each shard is consistent by itself.
+    Repeating the modification repairs it, as the methods of the managers
+    skip the rows that already exist.
+
+When sharding is enabled ``FRIENDS_DATABASE`` and ``FRIENDS_READ_DATABASES``
+are only used by the operations that aren't about a particular user, and the
+management commands work on one shard at a time, see their ``--database``
+option. Every shard has its own :mod:`~friends.snapshot`. Changing the number
+of shards requires moving the data of the users whose shard changes.
+
+.. autoclass:: FriendsRouter
+    :members:
+
+.. autofunction:: read_database
+
+.. autofunction:: write_database
+
+.. autofunction:: write_databases
+
+.. autofunction:: shard_database
+
+.. autofunction:: pin_users
+"""
+
+
+import random
+from django.contrib.auth.models import User
+from django.core.cache import cache
+import app_settings
+
+
+APP_LABEL = 'friends'
+PIN_KEY = 'friends.pin.%s'
+
+
+def read_database(*users):
+    """
+    Return the database alias to read the relationships of ``users`` from.
+
+    If sharding is enabled this is the shard of the first of ``users``.
+    Otherwise ``FRIENDS_DATABASE`` is returned if no replicas are configured
+    or if any of ``users`` is pinned, and a random replica from
+    ``FRIENDS_READ_DATABASES`` if not.
+
+    :param users: |User| instances or user ids.
+    :rtype: |unicode|
+    """
+    if app_settings.SHARDS and users:
+        return shard_database(users[0])
+    replicas = app_settings.READ_DATABASES
+    if not replicas:
+        return app_settings.DATABASE
+    if users and cache.get_many([PIN_KEY % _user_id(user)
+                                 for user in users]):
+        return app_settings.DATABASE
+    return random.choice(replicas)
+
+
+def write_database(user=None):
+    """
+    Return the database alias relationship changes are written to.
+
+    :param user: Optional. |User| instance or user id, if sharding is enabled
+                 the shard of this user is returned.
+    :rtype: |unicode|
+    """
+    if app_settings.SHARDS and user is not None:
+        return shard_database(user)
+    return app_settings.DATABASE
+
+
+def write_databases(*users):
+    """
+    Return the database aliases a relationship between ``users`` is written
+    to, in a consistent order so that concurrent modifications lock them in
+    the same order.
+
+    :param users: |User| instances or user ids.
+    :returns: |list| of one alias if sharding is disabled or if ``users``
+              belong to the same shard, otherwise of the shards of
+              ``users``.
+    """
+    return sorted(set(write_database(user) for user in users))
+
+
+def shard_database(user):
+    """
+    Return the shard of ``user``, or ``None`` if sharding is disabled.
+
+    :param user: |User| instance or user id.
+    :rtype: |unicode|
+    """
+    shards = app_settings.SHARDS
+    if not shards:
+        return None
+    return shards[_user_id(user) % len(shards)]
+
+
+def pin_users(*users):
+    """
+    Read relationships of ``users`` from :func:`write_database` for the next
+    ``FRIENDS_READ_STICKINESS`` seconds.
+
+    This is a no-op if no replicas are configured or if sharding is enabled.
+
+    :param users: |User| instances or user ids.
+    """
+    if app_settings.READ_DATABASES and app_settings.READ_STICKINESS > 0 \
+            and not app_settings.SHARDS:
+        cache.set_many(dict((PIN_KEY % _user_id(user), True)
+                            for user in users),
+                       app_settings.READ_STICKINESS)
+
+
+def _user_id(user):
+    return getattr(user, 'pk', user)
+
+
+def _instance_database(hints):
+    # With sharding, rows are written to the shard they were read from, or
+    # to the shard of their user when they are created.
+    instance = hints.get('instance')
+    if not app_settings.SHARDS or instance is None:
+        return None
+    if isinstance(instance, User):
+        return shard_database(instance)
+    if instance._state.db in app_settings.SHARDS:
+        return instance._state.db
+    user_id = getattr(instance, 'user_id', None)
+    if user_id is not None:
+        return shard_database(user_id)
+    return None
+
+
+class FriendsRouter(object):
+    """
+    Route reads and writes of :mod:`friends` models.
+
+    Other apps' models are left to the next router in ``DATABASE_ROUTERS``.
+    Reads made through this router are not aware of pinned users, use the
+    :class:`~friends.models.FriendshipManager` methods or pass
+    :func:`read_database` to ``using()`` for read-your-writes consistency.
+
+    The router is required for sharding: related managers and records created
+    for new users, such as :class:`~friends.models.Friendship`, are routed to
+    the shard of their instance.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == APP_LABEL:
+            return _instance_database(hints) or read_database()
+        return None
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label == APP_LABEL:
+            return _instance_database(hints) or write_database()
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if APP_LABEL in (obj1._meta.app_label, obj2._meta.app_label):
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if model._meta.app_label == APP_LABEL:
+            return db == write_database() or db in app_settings.SHARDS
+        return None
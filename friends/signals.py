@@ -49,9 +49,14 @@ Signal Handlers
 .. automethod:: friends.signals.create_friendship_instance
 
 .. automethod:: friends.signals.create_userblocks_instance
+
+.. automethod:: friends.signals.remember_username
+
+.. automethod:: friends.signals.invalidate_friend_search
 """
 
 
+from django.core.cache import cache
 from django.dispatch import Signal
 
 
@@ -72,8 +77,10 @@ def create_friendship_instance(sender, instance, created, raw, **kwargs):
         :data:`~django.db.models.signals.post_save` built-in signal.
     """
     from friends.models import Friendship
+    from friends.routers import write_database
     if created and not raw:
-        Friendship.objects.create(user=instance)
+        Friendship.objects.using(write_database(instance)).create(
+            user=instance)
 
 
 def create_userblocks_instance(sender, instance, created, raw, **kwargs):
@@ -84,5 +91,40 @@ def create_userblocks_instance(sender, instance, created, raw, **kwargs):
         :data:`~django.db.models.signals.post_save` built-in signal.
     """
     from friends.models import UserBlocks
+    from friends.routers import write_database
     if created and not raw:
-        UserBlocks.objects.create(user=instance)
+        UserBlocks.objects.using(write_database(instance)).create(
+            user=instance)
+
+
+def remember_username(sender, instance, raw, **kwargs):
+    """
+    Remember the stored username of a |User| that is about to be saved, for
+    :func:`invalidate_friend_search`.
+
+    .. seealso::
+        :data:`~django.db.models.signals.pre_save` built-in signal.
+    """
+    if instance.pk and not raw:
+        usernames = sender._default_manager.filter(
+            pk=instance.pk,
+        ).values_list('username', flat=True)[:1]
+        instance._friends_username = usernames[0] if usernames else None
+
+
+def invalidate_friend_search(sender, instance, created, raw, **kwargs):
+    """
+    Delete the cached
+    :meth:`~friends.models.FriendshipManager.search_friends` name lists
+    that contain a |User| whose username changed.
+
+    .. seealso::
+        :data:`~django.db.models.signals.post_save` built-in signal.
+    """
+    from friends.models import Friendship
+    username = instance.__dict__.pop('_friends_username', None)
+    if created or raw or username in (None, instance.username):
+        return
+    cache.delete_many([Friendship.objects.SEARCH_KEY % friend_id
+                       for friend_id in
+                       Friendship.objects.friend_ids(instance)])
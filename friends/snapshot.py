@@ -0,0 +1,277 @@
+"""
+Snapshots
+=========
+
+A snapshot is a read-only file containing the friendship graph in CSR layout
+(see :mod:`friends.graph`), built by the ``friends_snapshot`` management
+command. Processes open it with :mod:`mmap`, so all the workers on a machine
+share the same pages of the operating system's cache and nothing is copied
+into the Python heap.
+
+If ``FRIENDS_SNAPSHOT_PATH`` is set
+:meth:`~friends.models.FriendshipManager.are_friends` and
+:meth:`~friends.models.FriendshipManager.friend_ids` are answered from the
+snapshot. The :class:`~friends.models.FriendshipChange`\ 's recorded after the
+snapshot is built are applied on top of it, which costs a single indexed
+query, so results stay correct between rebuilds. As change ids are handed out
+before their transactions commit, those of the last
+``FRIENDS_CHANGE_COMMIT_LAG`` seconds before the build are applied as well,
+see :meth:`~friends.models.FriendshipChangeManager.committed_seq`. The
+snapshot file is reopened when it is replaced, which is checked every
+``FRIENDS_SNAPSHOT_RELOAD_INTERVAL`` seconds. The database is used while the
+file is missing.
+
+Change ids are only comparable within a database, so with
+:ref:`sharding <sharding>` every shard has its own snapshot, and the friends
+of a user are read from the snapshot of its shard. ``FRIENDS_SNAPSHOT_PATH``
+must then contain ``%(database)s``, which is replaced by the alias of the
+shard::
+
+    FRIENDS_SNAPSHOT_PATH = '/var/lib/friends/%(database)s.snapshot'
+
+File format, all integers are native C ``long``\ 's::
+
+    header     magic, version, item size, byte order, created, sequence,
+               node count, entry count (padded to 64 bytes)
+    nodes      sorted user ids having at least one friend
+    indptr     node count + 1 offsets into entries
+    entries    sorted user ids of the friends of each node
+
+.. autoclass:: GraphSnapshot
+    :members:
+
+.. autofunction:: write_snapshot
+
+.. autofunction:: get_snapshot
+
+.. autofunction:: snapshot_path
+"""
+
+
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from django.core.exceptions import ImproperlyConfigured
+import app_settings
+import graph
+from models import FriendshipChange
+from routers import read_database
+
+
+MAGIC = 'FRNDSNAP'
+VERSION = 1
+HEADER = struct.Struct('<8sIIIdqqq')
+DATA_OFFSET = 64
+ITEM = struct.Struct('@l')
+
+
+def write_snapshot(path, using=None, chunk_size=100000):
+    """
+    Build a snapshot of the friendship graph and atomically replace ``path``
+    with it.
+
+    :param path: File name of the snapshot.
+    :param using: Optional. Database alias to read the graph from.
+    :param |int| chunk_size: Optional. Number of edges fetched per query.
+    :returns: The :class:`~friends.models.FriendshipChange` sequence number
+              the snapshot is consistent with.
+    """
+    using = using or read_database()
+    # Changes recorded while the graph is being read are applied again by
+    # the readers, so the sequence must be taken before reading.
+    seq = FriendshipChange.objects.committed_seq(using)
+    g = graph.load_graph(chunk_size, using)
+    if graph.numpy is not None:
+        nodes = graph.numpy.frombuffer(g.nodes, dtype=graph.numpy.int_)
+        indices = graph.numpy.frombuffer(g.indices, dtype=graph.numpy.int_)
+        entries = graph._to_array(nodes[indices])
+    else:
+        entries = array('l', (g.nodes[i] for i in g.indices))
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+    with open(temporary, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, ITEM.size,
+                            int(sys.byteorder == 'big'), time.time(), seq,
+                            len(g.nodes), len(entries)).ljust(DATA_OFFSET,
+                                                              '\0'))
+        g.nodes.tofile(f)
+        g.indptr.tofile(f)
+        entries.tofile(f)
+    os.rename(temporary, path)
+    return seq
+
+
+class GraphSnapshot(object):
+    """
+    Memory-mapped snapshot file.
+
+    Lookups are binary searches over the mapped file, a lookup touches
+    ``O(log n)`` pages.
+
+    :param path: File name of the snapshot.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, item_size, big_endian, self.created, self.seq,
+         self.node_count, self.entry_count) = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a friends snapshot' % path)
+        if item_size != ITEM.size or big_endian != (sys.byteorder == 'big'):
+            raise ValueError('%s was built on an incompatible platform' % path)
+        self._nodes = DATA_OFFSET
+        self._indptr = self._nodes + self.node_count * ITEM.size
+        self._entries = self._indptr + (self.node_count + 1) * ITEM.size
+
+    def close(self):
+        self._mmap.close()
+
+    def are_friends(self, user1_id, user2_id):
+        """
+        Indicate if the users are friends according to this snapshot.
+
+        :rtype: |bool|
+        """
+        start, end = self._row(user1_id)
+        return self._search(self._entries, start, end, user2_id) >= 0
+
+    def friend_ids(self, user_id):
+        """
+        Return the sorted ids of the friends of the user according to this
+        snapshot.
+        """
+        start, end = self._row(user_id)
+        return list(struct.unpack_from(
+            '@%dl' % (end - start),
+            self._mmap,
+            self._entries + start * ITEM.size,
+        ))
+
+    def _get(self, offset, index):
+        return ITEM.unpack_from(self._mmap, offset + index * ITEM.size)[0]
+
+    def _row(self, user_id):
+        node = self._search(self._nodes, 0, self.node_count, user_id)
+        if node < 0:
+            return 0, 0
+        return (self._get(self._indptr, node),
+                self._get(self._indptr, node + 1))
+
+    def _search(self, offset, low, high, value):
+        while low < high:
+            middle = (low + high) // 2
+            item = self._get(offset, middle)
+            if item < value:
+                low = middle + 1
+            elif item > value:
+                high = middle
+            else:
+                return middle
+        return -1
+
+
+_lock = threading.Lock()
+# Snapshots opened by this process, by path.
+_loaded = {}
+
+
+def snapshot_path(path, using=None):
+    """
+    Return the snapshot file of database ``using``.
+
+    :param path: ``FRIENDS_SNAPSHOT_PATH`` or another path, containing
+                 ``%(database)s`` if sharding is enabled.
+    :param using: Optional. Alias of a shard, ignored if sharding is
+                  disabled.
+    :raises ImproperlyConfigured: if sharding is enabled and ``path`` doesn't
+                                  contain ``%(database)s``.
+    """
+    if not app_settings.SHARDS:
+        return path
+    if '%(database)s' not in path:
+        raise ImproperlyConfigured('FRIENDS_SNAPSHOT_PATH must contain '
+                                   '%(database)s when sharding is enabled.')
+    return path % {'database': using}
+
+
+def get_snapshot(using=None):
+    """
+    Return the :class:`GraphSnapshot` at ``FRIENDS_SNAPSHOT_PATH`` or
+    ``None`` if snapshots are not enabled or the file can't be read.
+
+    The snapshot is opened once per process and reopened after it is
+    rebuilt.
+
+    :param using: Optional. If sharding is enabled, alias of the shard whose
+                  snapshot is returned, ``None`` is returned for other
+                  aliases.
+    """
+    path = app_settings.SNAPSHOT_PATH
+    if not path:
+        return None
+    path = snapshot_path(path, using)
+    if app_settings.SHARDS and using not in app_settings.SHARDS:
+        return None
+    now = time.time()
+    loaded = _loaded.get(path)
+    if loaded is not None and \
+       now - loaded['checked'] < app_settings.SNAPSHOT_RELOAD_INTERVAL:
+        return loaded['snapshot']
+    with _lock:
+        loaded = _loaded.setdefault(path, {'mtime': None, 'checked': 0,
+                                           'snapshot': None})
+        try:
+            mtime = os.stat(path).st_mtime
+            if loaded['mtime'] != mtime:
+                # The previous mapping is left to the garbage collector as
+                # other threads may still be reading it.
+                loaded.update(mtime=mtime, snapshot=GraphSnapshot(path))
+        except EnvironmentError:
+            # Not built yet.
+            loaded.update(mtime=None, snapshot=None)
+        loaded['checked'] = now
+    return loaded['snapshot']
+
+
+def are_friends(snapshot, user1_id, user2_id):
+    """
+    :meth:`GraphSnapshot.are_friends` with the changes recorded after the
+    snapshot applied.
+    """
+    action = FriendshipChange.objects.using(
+        read_database(user1_id, user2_id),
+    ).filter(
+        user_id=user1_id,
+        other_id=user2_id,
+        action__in=(FriendshipChange.BEFRIEND, FriendshipChange.UNFRIEND),
+        id__gt=snapshot.seq,
+    ).order_by('-id').values_list('action', flat=True)[:1]
+    if action:
+        return action[0] == FriendshipChange.BEFRIEND
+    return snapshot.are_friends(user1_id, user2_id)
+
+
+def friend_ids(snapshot, user_id):
+    """
+    :meth:`GraphSnapshot.friend_ids` with the changes recorded after the
+    snapshot applied.
+    """
+    changes = FriendshipChange.objects.using(read_database(user_id)).filter(
+        user_id=user_id,
+        action__in=(FriendshipChange.BEFRIEND, FriendshipChange.UNFRIEND),
+        id__gt=snapshot.seq,
+    ).order_by('id').values_list('other_id', 'action')
+    ids = snapshot.friend_ids(user_id)
+    if not changes:
+        return ids
+    ids = set(ids)
+    for other_id, action in changes:
+        if action == FriendshipChange.BEFRIEND:
+            ids.add(other_id)
+        else:
+            ids.discard(other_id)
+    return sorted(ids)
@@ -0,0 +1,4 @@
+-- Lets friend_ids() and friend_rows() map the Friendship records of friends
+-- to user ids from the index alone.
+CREATE INDEX friends_friendship_id_user_id
+    ON friends_friendship (id, user_id);
@@ -0,0 +1,3 @@
+-- Serves the changes of a single user in sequence order.
+CREATE INDEX friends_friendshipchange_user_id_id
+    ON friends_friendshipchange (user_id, id);
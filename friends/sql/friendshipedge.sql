@@ -0,0 +1,3 @@
+-- Serves recent_friends() and friends_since().
+CREATE INDEX friends_friendship_friends_created
+    ON friends_friendship_friends (from_friendship_id, created);
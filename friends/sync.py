@@ -0,0 +1,177 @@
+"""
+Delta sync
+==========
+
+Lets clients keep a local copy of a user's friends, pending friendship
+requests and blocks up to date by downloading only what changed since their
+last sync. Deltas are computed from the user's
+:class:`~friends.models.FriendshipChange`\ 's, so a sync costs one indexed
+query over the changes made since the previous one.
+
+Every sync returns an opaque, signed ``token`` that is passed to the next
+one. A full snapshot is returned instead of a delta when there is no token or
+it is invalid, when the changes it refers to were compacted, or when more
+than ``FRIENDS_SYNC_MAX_CHANGES`` changes were made since.
+
+Both kinds of responses have the same shape, a full snapshot just has
+``full`` set and nothing removed::
+
+    {
+        "full": false,
+        "token": "...",
+        "friends": {"added": [{"id": 2, "username": "bob"}], "removed": []},
+        "requests_sent": {"added": [], "removed": [3]},
+        "requests_received": {"added": [], "removed": []},
+        "blocks": {"added": [], "removed": []}
+    }
+
+Applying the same delta twice is harmless, clients should apply the lists in
+order: removals, then additions. Tokens only move up to the changes recorded
+``FRIENDS_CHANGE_COMMIT_LAG`` seconds ago, see
+:meth:`~friends.models.FriendshipChangeManager.committed_seq`, and the more
+recent ones are sent again by the next sync, so a change committed after
+others with higher ids isn't skipped.
+
+.. autofunction:: sync_relationships
+"""
+
+
+from django.core import signing
+from django.contrib.auth.models import User
+from models import FriendshipChange
+from export import export_records
+from routers import read_database
+import app_settings
+
+
+SALT = 'friends.sync'
+CATEGORIES = ('friends', 'requests_sent', 'requests_received', 'blocks')
+
+# Effect of a change on the viewer's lists, by action and by whether the
+# viewer made it: (category, added) tuples. Removing a relationship the
+# client doesn't have is a no-op, so unambiguous removals err on the side of
+# being sent.
+EFFECTS = {
+    (FriendshipChange.BEFRIEND, True): (('friends', True),
+                                        ('requests_sent', False)),
+    (FriendshipChange.BEFRIEND, False): (('friends', True),
+                                         ('requests_received', False)),
+    (FriendshipChange.UNFRIEND, True): (('friends', False),
+                                        ('requests_sent', False),
+                                        ('requests_received', False)),
+    (FriendshipChange.UNFRIEND, False): (('friends', False),
+                                         ('requests_sent', False),
+                                         ('requests_received', False)),
+    (FriendshipChange.REQUEST, True): (('requests_sent', True),),
+    (FriendshipChange.REQUEST, False): (('requests_received', True),),
+    (FriendshipChange.ACCEPT, True): (('requests_received', False),),
+    (FriendshipChange.ACCEPT, False): (('requests_sent', False),),
+    (FriendshipChange.DECLINE, True): (('requests_received', False),),
+    (FriendshipChange.DECLINE, False): (('requests_sent', False),),
+    (FriendshipChange.CANCEL, True): (('requests_sent', False),),
+    (FriendshipChange.CANCEL, False): (('requests_received', False),),
+    (FriendshipChange.BLOCK, True): (('blocks', True),),
+    (FriendshipChange.UNBLOCK, True): (('blocks', False),),
+}
+RECORD_CATEGORIES = {
+    'friend': 'friends',
+    'request_sent': 'requests_sent',
+    'request_received': 'requests_received',
+    'block': 'blocks',
+}
+
+
+def sync_relationships(user, token=None):
+    """
+    Return the changes to the relationships of ``user`` since ``token``.
+
+    :param user: Syncing user.
+    :type user: |User|
+    :param token: Optional. ``token`` of the previous sync.
+    :returns: |dict| as described above.
+    """
+    using = read_database(user)
+    seq = _load_token(user, token)
+    if seq is not None:
+        changes = _read_changes(user, seq, using)
+        if changes is not None:
+            head, changes = changes
+            return _delta(user, head, changes, using)
+    return _full(user, using)
+
+
+def _load_token(user, token):
+    if not token:
+        return None
+    try:
+        user_id, seq = signing.loads(token, salt=SALT)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+    if user_id != user.pk:
+        return None
+    return seq
+
+
+def _make_token(user, seq):
+    return signing.dumps([user.pk, seq], salt=SALT)
+
+
+def _read_changes(user, seq, using):
+    """
+    Return the sequence number of the latest committed change and the
+    ``(id, other_id, action, outgoing)`` changes of ``user`` after ``seq``, or
+    ``None`` if they can't all be read.
+    """
+    changes = FriendshipChange.objects.using(using)
+    oldest = changes.order_by('id').values_list('id', flat=True)[:1]
+    if oldest and oldest[0] > seq + 1 or not oldest and seq:
+        # Changes after seq may have been compacted.
+        return None
+    # The token moves to the latest committed change even if the user has
+    # none, so it doesn't fall behind compaction.
+    head = max(FriendshipChange.objects.committed_seq(using), seq)
+    limit = app_settings.SYNC_MAX_CHANGES
+    rows = list(changes.filter(user_id=user.pk, id__gt=seq).order_by(
+        'id').values_list('id', 'other_id', 'action', 'outgoing')[:limit + 1])
+    if len(rows) > limit:
+        return None
+    return head, rows
+
+
+def _delta(user, seq, changes, using):
+    states = dict((category, {}) for category in CATEGORIES)
+    for id, other_id, action, outgoing in changes:
+        for category, added in EFFECTS.get((action, outgoing), ()):
+            states[category][other_id] = added
+    added_ids = set(other_id for state in states.itervalues()
+                    for other_id, added in state.iteritems() if added)
+    usernames = dict(User.objects.using(using).filter(
+        pk__in=added_ids).values_list('pk', 'username')) if added_ids else {}
+    result = {'full': False, 'token': _make_token(user, seq)}
+    for category, state in states.iteritems():
+        result[category] = {
+            # Users deleted in the meantime are left out.
+            'added': [{'id': other_id, 'username': usernames[other_id]}
+                      for other_id, added in sorted(state.iteritems())
+                      if added and other_id in usernames],
+            'removed': sorted(other_id for other_id, added
+                              in state.iteritems() if not added),
+        }
+    return result
+
+
+def _full(user, using):
+    # Changes recorded while the lists are being read are sent again by the
+    # next sync, so the sequence must be taken before reading.
+    seq = FriendshipChange.objects.committed_seq(using)
+    result = {'full': True, 'token': _make_token(user, seq)}
+    for category in CATEGORIES:
+        result[category] = {'added': [], 'removed': []}
+    for record in export_records(user, using=using):
+        if record['accepted']:
+            continue
+        result[RECORD_CATEGORIES[record['type']]]['added'].append({
+            'id': record['user_id'],
+            'username': record['username'],
+        })
+    return result
@@ -1,6 +1,7 @@
 from django import template
-from django.contrib.auth.models import User
+from django.contrib.auth.models import AnonymousUser, User
 from friends.models import FriendshipRequest, Friendship, UserBlocks
+from friends.routers import read_database
 
 
 register = template.Library()
@@ -22,7 +23,8 @@ class AddToFriendsNode(template.Node):
             if not target_user is current_user:
                 ctx['are_friends'] = Friendship.objects.are_friends(
                                                     target_user, current_user)
-                ctx['is_invited'] = bool(FriendshipRequest.objects.filter(
+                ctx['is_invited'] = bool(FriendshipRequest.objects.using(
+                                        read_database(current_user)).filter(
                                                     from_user=current_user,
                                                     to_user=target_user,
                                                     accepted=False).count())
@@ -47,7 +49,8 @@ class BlockUserLinkNode(template.Node):
             ctx = {'target_user': target_user,
                    'current_user': current_user}
             if not target_user is current_user:
-                ctx['is_blocked'] = bool(UserBlocks.objects.filter(
+                ctx['is_blocked'] = bool(UserBlocks.objects.using(
+                                        read_database(current_user)).filter(
                          user=current_user, blocks__pk=target_user.pk).count())
             return template.loader.render_to_string(self.template_name,
                                                     ctx,
@@ -76,9 +79,10 @@ def add_to_friends(parser, token):
 
 def blocks(value):
     user = _get_user_from_value('friends', value)
+    users = User.objects.using(read_database(user))
     return {
-        'applied': User.objects.filter(blocked_by_set__user=user),
-        'received': User.objects.filter(user_blocks__blocks=user),
+        'applied': users.filter(blocked_by_set__user=user),
+        'received': users.filter(user_blocks__blocks=user),
     }
 
 
@@ -107,16 +111,17 @@ def friends_(value):
 
 def friendship_requests(value):
     user = _get_user_from_value('friends', value)
+    users = User.objects.using(read_database(user))
     return {
-        'sent': User.objects.filter(friendshiprequests_to__from_user=user),
-        'received': User.objects.filter(friendshiprequests_from__to_user=user),
+        'sent': users.filter(friendshiprequests_to__from_user=user),
+        'received': users.filter(friendshiprequests_from__to_user=user),
     }
 
 
 def is_blocked_by(value, arg):
     user = _get_user_from_value('isblockedby', value)
     target = _get_user_from_argument('isblockedby', arg)
-    return UserBlocks.objects.filter(user=target, blocks=user).exists()
+    return UserBlocks.objects.is_blocked(target, user)
 
 
 def is_friends_with(value, arg):
@@ -125,6 +130,14 @@ def is_friends_with(value, arg):
     return Friendship.objects.are_friends(user, target)
 
 
+def relationship_summary(value, arg=None):
+    user = _get_user_from_value('relationshipsummary', value)
+    viewer = None
+    if arg is not None and not isinstance(arg, AnonymousUser):
+        viewer = _get_user_from_argument('relationshipsummary', arg)
+    return Friendship.objects.relationship_summary(user, viewer)
+
+
 def _get_user(value):
     if isinstance(value, User):
         return value
@@ -157,5 +170,6 @@ register.filter('friends', friends_)
 register.filter('friendshiprequests', friendship_requests)
 register.filter('isblockedby', is_blocked_by)
 register.filter('isfriendswith', is_friends_with)
+register.filter('relationshipsummary', relationship_summary)
 register.tag('addtofriends', add_to_friends)
 register.tag('blockuser', block_user)
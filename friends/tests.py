@@ -1,8 +1,38 @@
-from django.test import TestCase
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from django.contrib import admin
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.template import Context, Template, loader
+from django.test.client import RequestFactory
+from django.db import connection, connections, router
+from django.test import TestCase, TransactionTestCase
+from django.utils.unittest import skipIf
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
-from friends.models import FriendshipRequest, Friendship, UserBlocks
+from friends.models import FriendshipRequest, Friendship, UserBlocks, \
+                           FriendshipChange, FriendshipEdge, SharedBlocklist
 from friends.templatetags import friends_tags
+from friends.admin import FriendshipAdmin, UserBlocksAdmin
+from friends.export import export_records, export_relationships
+from friends.sync import sync_relationships
+from friends.backfill import backfill
+from friends.consistency import run_checks
+from friends.purge import purge_user
+from friends.loadtest import generate_operations, run_load
+from friends.generate import generate_graph
+from friends import views
+from friends import app_settings, blocklists, bloom, graph, models, \
+                    routers, snapshot, throttling, utils
+
+
+SHARDS = ('shard0', 'shard1')
 
 
 class BaseTestCase(TestCase):
@@ -71,6 +101,63 @@ class FriendshipModelsTestCase(BaseTestCase):
         self.assertEqual(Friendship.objects.are_friends(self.user1,
                                                         self.user2), False)
 
+    def test_friendship_manager_friend_rows(self):
+        Friendship.objects.befriend(self.user1, self.user3)
+        with self.assertNumQueries(1):
+            ids = Friendship.objects.friend_ids(self.user1, as_array=True)
+        self.assertEqual(list(ids), [self.user2.pk, self.user3.pk])
+        with self.assertNumQueries(1):
+            rows = list(Friendship.objects.friend_rows(self.user1))
+        self.assertEqual(rows, [(self.user2.pk, 'testuser2'),
+                                (self.user3.pk, 'testuser3')])
+        self.assertEqual(list(Friendship.objects.friend_rows(
+            self.user3, fields=('username',))), [('testuser1',)])
+
+    def test_friendship_manager_filter_friends(self):
+        Friendship.objects.befriend(self.user1, self.user3)
+        candidates = [self.user2, self.user3.pk, self.user4]
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                Friendship.objects.filter_friends(self.user1, candidates),
+                set([self.user2.pk, self.user3.pk]),
+            )
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                Friendship.objects.filter_friends(self.user1, []), set())
+
+    def test_friendship_manager_relationship_summary(self):
+        Friendship.objects.befriend(self.user3, self.user2)
+        FriendshipRequest.objects.create(from_user=self.user4,
+                                         to_user=self.user1)
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                Friendship.objects.relationship_summary(self.user1,
+                                                        self.user3),
+                {'friends': 1, 'mutual_friends': 1, 'requests_sent': 0,
+                 'requests_received': 1, 'blocks_applied': 1,
+                 'blocks_received': 1},
+            )
+        self.assertEqual(friends_tags.relationship_summary(self.user4), {
+            'friends': 0, 'mutual_friends': None, 'requests_sent': 1,
+            'requests_received': 0, 'blocks_applied': 2, 'blocks_received': 2,
+        })
+        self.assertEqual(Template(
+            '{% load friends_tags %}'
+            '{% with user|relationshipsummary:viewer as summary %}'
+            '{{ summary.friends }} {{ summary.mutual_friends }}{% endwith %}'
+        ).render(Context({'user': self.user2, 'viewer': self.user1})),
+            u'2 0')
+
+    def test_friendship_manager_mutual_friends(self):
+        Friendship.objects.befriend(self.user3, self.user1)
+        Friendship.objects.befriend(self.user3, self.user2)
+        self.assertEqual(list(Friendship.objects.mutual_friends(self.user1,
+                                                                self.user2)),
+                         [self.user3])
+        self.assertEqual(list(Friendship.objects.mutual_friends(self.user1,
+                                                                self.user4)),
+                         [])
+
 
 class FriendshipRequestsFilterTestCase(BaseTestCase):
     def test_friendship_requests_filter(self):
@@ -147,6 +234,62 @@ class FriendshipViewsTestCase(BaseTestCase):
                                                         self.user3), True)
 
 
+class ActionViewsJSONTestCase(BaseTestCase):
+    urls = 'friends.urls'
+
+    def setUp(self):
+        super(ActionViewsJSONTestCase, self).setUp()
+        self.client.login(username='testuser1', password='testuser1')
+
+    def get(self, name, username, status=200, **extra):
+        response = self.client.get(reverse(name, args=(username,)), **extra)
+        self.assertEqual(response.status_code, status)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        return json.loads(response.content)
+
+    def test_relationship(self):
+        result = self.get('friendship_request', 'testuser3',
+                          HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(result, {'relationship': {
+            'friends': False, 'request_sent': True, 'request_received': False,
+            'blocked': False, 'blocked_by': False,
+        }})
+        result = self.get('user_block', 'testuser4',
+                          HTTP_ACCEPT='application/json')
+        self.assertEqual(result['relationship']['blocked'], True)
+        self.assertEqual(result['relationship']['blocked_by'], True)
+        result = self.get('friendship_delete', 'testuser2',
+                          HTTP_ACCEPT='application/json')
+        self.assertEqual(result['relationship']['friends'], False)
+
+    def test_shared_blocklist(self):
+        SharedBlocklist.objects.create(name='spam').subscribers.add(
+            self.user3)
+        SharedBlocklist.objects.get(name='spam').entries.add(self.user1)
+        result = self.get('friendship_delete', 'testuser3',
+                          HTTP_ACCEPT='application/json')
+        self.assertEqual(result['relationship']['blocked'], False)
+        self.assertEqual(result['relationship']['blocked_by'], True)
+
+    def test_errors(self):
+        for name, username, code, status in (
+            ('friendship_request', 'testuser1', 'self_action', 400),
+            ('friendship_request', 'nonexistent', 'not_found', 404),
+            ('friendship_accept', 'testuser3', 'not_found', 404),
+        ):
+            result = self.get(name, username, status,
+                              HTTP_ACCEPT='application/json')
+            self.assertEqual(result['error']['code'], code)
+        app_settings.THROTTLE_RATES['request'] = '0/m'
+        try:
+            result = self.get('friendship_request', 'testuser3', 429,
+                              HTTP_ACCEPT='application/json')
+        finally:
+            del app_settings.THROTTLE_RATES['request']
+            cache.clear()
+        self.assertEqual(result['error']['code'], 'throttled')
+
+
 class UserBlockTestCase(BaseTestCase):
     def test_blocking_info_methods(self):
         self.user1.user_blocks.blocks.add(self.user3, self.user4)
@@ -171,3 +314,1267 @@ class UserBlocksViewsTestCase(BaseTestCase):
         self.client.get(reverse('user_unblock', args=('testuser2',)))
         self.assertEqual(self.user2 in self.user1.user_blocks.blocks.all(),
                                                                         False)
+
+
+class BlocklistTestCase(BaseTestCase):
+    def blocks(self, user, using='default'):
+        return set(UserBlocks.blocks.through.objects.using(using).filter(
+            userblocks__user=user).values_list('user', flat=True))
+
+    def test_block_many(self):
+        self.assertEqual(UserBlocks.objects.block_many(
+            self.user1, [self.user2, self.user3.pk, self.user4, self.user1],
+            batch_size=2), [self.user2.pk, self.user3.pk])
+        self.assertEqual(self.blocks(self.user1),
+                         set([self.user2.pk, self.user3.pk, self.user4.pk]))
+        self.assertEqual(list(FriendshipChange.objects.filter(
+            user_id=self.user1.pk).values_list('action', 'other_id')),
+            [(FriendshipChange.BLOCK, self.user2.pk),
+             (FriendshipChange.BLOCK, self.user3.pk)])
+        self.assertEqual(UserBlocks.objects.unblock_many(
+            self.user1, [self.user2, self.user4, self.user2]),
+            [self.user2.pk, self.user4.pk])
+        self.assertEqual(self.blocks(self.user1), set([self.user3.pk]))
+
+    def test_import_blocks(self):
+        self.assertEqual(blocklists.import_blocks(
+            self.user3, ['testuser1', 'nobody', 'testuser4'], chunk_size=2),
+            {'modified': 2, 'unchanged': 0, 'missing': ['nobody']})
+        self.assertEqual(self.blocks(self.user3),
+                         set([self.user1.pk, self.user4.pk]))
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('testuser1\n\ntestuser2\n')
+            call_command('friends_import_blocks', 'testuser3', path,
+                         unblock=True, verbosity=0)
+            self.assertEqual(self.blocks(self.user3), set([self.user4.pk]))
+            call_command('friends_import_blocks', path, blocklist='spam',
+                         verbosity=0)
+        finally:
+            os.remove(path)
+        self.assertEqual(set(SharedBlocklist.objects.get(
+            name='spam').entries.all()), set([self.user1, self.user2]))
+
+    def test_shared_blocklist(self):
+        blocklist = SharedBlocklist.objects.create(name='spam')
+        self.assertEqual(SharedBlocklist.objects.add_entries(
+            blocklist, [self.user2, self.user3.pk]), 2)
+        self.assertEqual(SharedBlocklist.objects.add_entries(
+            blocklist, [self.user2]), 0)
+        self.assertFalse(UserBlocks.objects.is_blocked(self.user1,
+                                                       self.user2))
+        blocklist.subscribers.add(self.user1)
+        with self.assertNumQueries(1):
+            self.assertTrue(UserBlocks.objects.is_blocked(self.user1,
+                                                          self.user2))
+        self.assertTrue(friends_tags.is_blocked_by(self.user3, self.user1))
+        self.assertEqual(
+            set(UserBlocks.objects.blocked_users(self.user1)),
+            set([self.user2, self.user3, self.user4]),
+        )
+        self.assertEqual(self.blocks(self.user1), set([self.user4.pk]))
+        with self.assertNumQueries(1):
+            summary = Friendship.objects.relationship_summary(self.user1)
+        self.assertEqual(summary['blocks_applied'], 3)
+        self.assertEqual(
+            Friendship.objects.relationship_summary(self.user3)[
+                'blocks_received'],
+            UserBlocks.objects.filter(blocks=self.user3).count() + 1,
+        )
+        self.assertEqual(SharedBlocklist.objects.remove_entries(
+            blocklist, [self.user2, self.user4]), 1)
+        self.assertFalse(UserBlocks.objects.is_blocked(self.user1,
+                                                       self.user2))
+
+
+    def test_delete_owner(self):
+        blocklist = SharedBlocklist.objects.create(name='spam',
+                                                   owner=self.user4)
+        blocklist.entries.add(self.user2)
+        blocklist.subscribers.add(self.user1)
+        self.user4.delete()
+        self.assertEqual(SharedBlocklist.objects.get(name='spam').owner,
+                         None)
+        self.assertTrue(UserBlocks.objects.is_blocked(self.user1,
+                                                      self.user2))
+
+
+class AdminTestCase(BaseTestCase):
+    def changelist(self, model, model_admin):
+        request = RequestFactory().get('/')
+        request.user = User(username='admin', is_active=True, is_staff=True,
+                            is_superuser=True)
+        response = model_admin(model, admin.site).changelist_view(request)
+        return dict((obj.user_id, obj)
+                    for obj in response.context_data['cl'].result_list)
+
+    def test_friendship_changelist(self):
+        Friendship.objects.befriend(self.user1, self.user3)
+        with self.assertNumQueries(3):
+            friendships = self.changelist(Friendship, FriendshipAdmin)
+        with self.assertNumQueries(0):
+            self.assertEqual(friendships[self.user1.pk].friend_count(), 2)
+            self.assertEqual(friendships[self.user1.pk].friend_summary(1),
+                             u'[testuser2, ...]')
+            self.assertEqual(friendships[self.user4.pk].friend_summary(),
+                             u'[]')
+
+    def test_user_blocks_changelist(self):
+        with self.assertNumQueries(3):
+            blocks = self.changelist(UserBlocks, UserBlocksAdmin)
+        with self.assertNumQueries(0):
+            self.assertEqual(blocks[self.user4.pk].block_count(), 2)
+            self.assertEqual(blocks[self.user4.pk].block_summary(),
+                             u'[testuser1, testuser3]')
+        self.assertEqual(
+            UserBlocks.objects.get(user=self.user4).block_summary(1),
+            u'[testuser1, ...]',
+        )
+
+
+class ExportTestCase(BaseTestCase):
+    urls = 'friends.urls'
+
+    def test_export_records(self):
+        FriendshipRequest.objects.create(from_user=self.user1,
+                                         to_user=self.user3)
+        records = list(export_records(self.user1, chunk_size=1))
+        self.assertEqual(
+            sorted((r['type'], r['username']) for r in records),
+            [('block', 'testuser4'),
+             ('friend', 'testuser2'),
+             ('request_sent', 'testuser2'),
+             ('request_sent', 'testuser3')],
+        )
+
+    def test_export_formats(self):
+        lines = list(export_relationships(self.user4, 'jsonl'))
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(json.loads(lines[0])['type'], 'block')
+        lines = list(export_relationships(self.user4, 'csv'))
+        self.assertEqual(lines[0].strip(),
+                         'type,user_id,username,message,created,accepted')
+        self.assertEqual(len(lines), 3)
+        self.assertRaises(ValueError, export_relationships, self.user4, 'xml')
+
+    def test_export_view(self):
+        self.client.login(username='testuser1', password='testuser1')
+        response = self.client.get(reverse('friendship_export'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(len(response.content.splitlines()), 3)
+        response = self.client.get(reverse('friendship_export'),
+                                   {'format': 'xml'})
+        self.assertEqual(response.status_code, 400)
+
+
+@skipIf(connection.vendor == 'sqlite' and
+        connection.settings_dict.get('TEST_NAME') in (None, '', ':memory:'),
+        'Closing an in-memory SQLite database drops it, set TEST_NAME.')
+class ExportStreamingTestCase(TransactionTestCase):
+    fixtures = ['test_data.json']
+
+    def test_closed_connection(self):
+        user4 = User.objects.get(username='testuser4')
+        records = export_records(user4, using='default')
+        # As request_finished does before a streamed body is iterated.
+        connection.close()
+        self.assertEqual(len(list(records)), 2)
+        self.assertEqual(connection.connection, None)
+        connection.cursor()
+        self.assertEqual(len(list(export_records(user4, using='default'))),
+                         2)
+        self.assertNotEqual(connection.connection, None)
+
+
+class FriendsRouterTestCase(BaseTestCase):
+    def setUp(self):
+        super(FriendsRouterTestCase, self).setUp()
+        self._settings = (app_settings.DATABASE, app_settings.READ_DATABASES)
+        app_settings.DATABASE = 'friends'
+        app_settings.READ_DATABASES = ('replica',)
+        cache.clear()
+
+    def tearDown(self):
+        app_settings.DATABASE, app_settings.READ_DATABASES = self._settings
+        cache.clear()
+
+    def test_router(self):
+        router = routers.FriendsRouter()
+        self.assertEqual(router.db_for_read(Friendship), 'replica')
+        self.assertEqual(router.db_for_write(Friendship), 'friends')
+        self.assertEqual(router.db_for_read(User), None)
+        self.assertEqual(router.db_for_write(User), None)
+        self.assertEqual(router.allow_syncdb('friends', UserBlocks), True)
+        self.assertEqual(router.allow_syncdb('replica', UserBlocks), False)
+        self.assertEqual(router.allow_syncdb('replica', User), None)
+
+    def test_read_your_writes(self):
+        self.assertEqual(routers.read_database(self.user1), 'replica')
+        routers.pin_users(self.user1)
+        self.assertEqual(routers.read_database(self.user1), 'friends')
+        self.assertEqual(routers.read_database(self.user3, self.user1),
+                         'friends')
+        self.assertEqual(routers.read_database(self.user3), 'replica')
+
+    def test_default_database(self):
+        app_settings.READ_DATABASES = ()
+        routers.pin_users(self.user1)
+        self.assertEqual(routers.read_database(self.user3), 'friends')
+        self.assertEqual(cache.get(routers.PIN_KEY % self.user1.pk), None)
+
+
+@skipIf(not set(SHARDS).issubset(connections.databases),
+        'Sharding tests need the %s database aliases.' % ', '.join(SHARDS))
+class ShardingTestCase(BaseTestCase):
+    multi_db = True
+
+    def setUp(self):
+        super(ShardingTestCase, self).setUp()
+        self._shards = app_settings.SHARDS
+        self._routers = router.routers
+        app_settings.SHARDS = SHARDS
+        router.routers = [routers.FriendsRouter()] + self._routers
+
+    def tearDown(self):
+        app_settings.SHARDS = self._shards
+        router.routers = self._routers
+
+    def edges(self, using, user1, user2):
+        return FriendshipEdge.objects.using(using).filter(
+            from_friendship__user__in=(user1, user2),
+            to_friendship__user__in=(user1, user2),
+        ).count()
+
+    def test_router(self):
+        friends_router = routers.FriendsRouter()
+        self.assertEqual(routers.read_database(self.user3), 'shard1')
+        self.assertEqual(routers.read_database(self.user4.pk), 'shard0')
+        self.assertEqual(routers.write_databases(self.user1, self.user3),
+                         ['shard1'])
+        self.assertEqual(routers.write_databases(self.user3, self.user4),
+                         ['shard0', 'shard1'])
+        self.assertEqual(friends_router.db_for_write(Friendship,
+                                                     instance=self.user3),
+                         'shard1')
+        self.assertEqual(friends_router.allow_syncdb('shard0', Friendship),
+                         True)
+        user = User.objects.create_user('testuser5')
+        self.assertTrue(UserBlocks.objects.using(
+            routers.write_database(user)).filter(user=user).exists())
+
+    def test_snapshots(self):
+        directory = tempfile.mkdtemp()
+        settings = app_settings.SNAPSHOT_PATH, app_settings.CHANGE_COMMIT_LAG
+        app_settings.SNAPSHOT_PATH = os.path.join(directory, '%(database)s')
+        app_settings.CHANGE_COMMIT_LAG = 0
+        try:
+            Friendship.objects.befriend(self.user1, self.user3)
+            Friendship.objects.befriend(self.user2, self.user4)
+            call_command('friends_snapshot', output=app_settings.SNAPSHOT_PATH,
+                         verbosity=0)
+            self.assertEqual(sorted(os.listdir(directory)), list(SHARDS))
+            # Applied on top of the snapshot of each user's shard.
+            Friendship.objects.befriend(self.user3, self.user4)
+            self.assertEqual(Friendship.objects.friend_ids(self.user3),
+                             [self.user1.pk, self.user4.pk])
+            self.assertEqual(Friendship.objects.friend_ids(self.user4),
+                             [self.user2.pk, self.user3.pk])
+            FriendshipEdge.objects.using('shard1').filter(
+                from_friendship__user=self.user1).delete()
+            self.assertTrue(Friendship.objects.are_friends(self.user1,
+                                                           self.user3))
+            app_settings.SNAPSHOT_PATH = os.path.join(directory, 'snapshot')
+            self.assertRaises(ImproperlyConfigured, snapshot.get_snapshot,
+                              'shard0')
+        finally:
+            app_settings.SNAPSHOT_PATH, app_settings.CHANGE_COMMIT_LAG = \
+                settings
+            shutil.rmtree(directory)
+
+    def test_purge_user(self):
+        Friendship.objects.befriend(self.user3, self.user4)
+        UserBlocks.objects.block(self.user3, self.user4)
+        self.assertEqual(purge_user(self.user4)['friends'], 1)
+        blocks = UserBlocks.blocks.through.objects
+        for shard in SHARDS:
+            self.assertEqual(self.edges(shard, self.user3, self.user4), 0)
+            self.assertFalse(Friendship.objects.using(shard).filter(
+                user=self.user4).exists())
+            self.assertFalse(blocks.using(shard).filter(
+                user=self.user4).exists())
+
+    def test_befriend(self):
+        Friendship.objects.befriend(self.user1, self.user3)
+        self.assertEqual(self.edges('shard1', self.user1, self.user3), 2)
+        self.assertEqual(self.edges('shard0', self.user1, self.user3), 0)
+        self.assertEqual(self.edges('default', self.user1, self.user3), 0)
+        Friendship.objects.befriend(self.user3, self.user4)
+        for shard in SHARDS:
+            self.assertEqual(self.edges(shard, self.user3, self.user4), 2)
+        with self.assertNumQueries(0, using='shard0'):
+            with self.assertNumQueries(1, using='shard1'):
+                self.assertEqual(
+                    set(Friendship.objects.friends_of(self.user3)),
+                    set([self.user1, self.user4]),
+                )
+        self.assertTrue(Friendship.objects.are_friends(self.user4,
+                                                       self.user3))
+        self.assertEqual(list(Friendship.objects.mutual_friends(self.user1,
+                                                                self.user4)),
+                         [self.user3])
+        self.assertEqual(Friendship.objects.relationship_summary(
+            self.user4, self.user1)['mutual_friends'], 1)
+        Friendship.objects.unfriend(self.user4, self.user3)
+        for shard in SHARDS:
+            self.assertEqual(self.edges(shard, self.user3, self.user4), 0)
+        self.assertEqual(list(Friendship.objects.friends_of(self.user4)), [])
+
+    def test_requests_and_blocks(self):
+        FriendshipRequest.objects.request_friendship(self.user3, self.user4)
+        for shard in SHARDS:
+            self.assertTrue(FriendshipRequest.objects.using(shard).filter(
+                from_user=self.user3, to_user=self.user4,
+                accepted=False).exists())
+        FriendshipRequest.objects.using(routers.write_database(self.user4)) \
+            .get(from_user=self.user3, to_user=self.user4).accept()
+        for shard in SHARDS:
+            self.assertTrue(FriendshipRequest.objects.using(shard).filter(
+                from_user=self.user3, to_user=self.user4,
+                accepted=True).exists())
+            self.assertEqual(self.edges(shard, self.user3, self.user4), 2)
+        self.assertTrue(UserBlocks.objects.block(self.user3, self.user2))
+        self.assertTrue(self.user3 in
+                        friends_tags.blocks(self.user2)['received'])
+        self.assertTrue(self.user2 in
+                        friends_tags.blocks(self.user3)['applied'])
+        self.assertEqual(
+            [change.action for change in FriendshipChange.objects.read_changes(
+                user=self.user2)],
+            [FriendshipChange.BLOCK],
+        )
+
+    def test_shared_blocklist_summary(self):
+        blocklist = SharedBlocklist.objects.create(name='spam')
+        blocklist.entries.add(self.user3)
+        blocklist.subscribers.add(self.user1, self.user2)
+        UserBlocks.objects.block(self.user1, self.user3)
+        blocks = UserBlocks.blocks.through.objects.using('shard1')
+        blocked = set(blocks.filter(userblocks__user=self.user1).values_list(
+            'user', flat=True))
+        blockers = set(blocks.filter(user=self.user3).values_list(
+            'userblocks__user', flat=True))
+        self.assertTrue(self.user3.pk in blocked)
+        self.assertFalse(self.user2.pk in blockers)
+        self.assertEqual(Friendship.objects.relationship_summary(
+            self.user1)['blocks_applied'], len(blocked))
+        self.assertEqual(Friendship.objects.relationship_summary(
+            self.user3)['blocks_received'],
+            len(blockers.union([self.user2.pk])))
+
+    def test_block_many(self):
+        self.assertEqual(UserBlocks.objects.block_many(
+            self.user3, [self.user1, self.user2]),
+            [self.user1.pk, self.user2.pk])
+        blocks = UserBlocks.blocks.through.objects
+        self.assertEqual(set(blocks.using('shard1').filter(
+            userblocks__user=self.user3).values_list('user', flat=True)),
+            set([self.user1.pk, self.user2.pk]))
+        self.assertEqual(list(blocks.using('shard0').filter(
+            userblocks__user=self.user3).values_list('user', flat=True)),
+            [self.user2.pk])
+        self.assertTrue(UserBlocks.objects.is_blocked(self.user3,
+                                                      self.user2))
+
+
+class GraphTestCase(BaseTestCase):
+    def setUp(self):
+        super(GraphTestCase, self).setUp()
+        Friendship.objects.befriend(self.user1, self.user3)
+        Friendship.objects.befriend(self.user2, self.user3)
+        Friendship.objects.befriend(self.user3, self.user4)
+
+    def test_load_graph(self):
+        g = graph.load_graph(chunk_size=3)
+        self.assertEqual(list(g.nodes), [1, 2, 3, 4])
+        self.assertEqual(g.edge_count, 4)
+        self.assertEqual(list(g.neighbours(2)), [0, 1, 3])
+        sources, targets = graph.array('l'), graph.array('l')
+        for chunk in graph.iter_edges():
+            for user_id, friend_id in chunk:
+                sources.append(user_id)
+                targets.append(friend_id)
+        g2 = graph._build_array(sources, targets)
+        self.assertEqual((g.nodes, g.indptr, g.indices),
+                         (g2.nodes, g2.indptr, g2.indices))
+
+    def test_one_sided_edge(self):
+        FriendshipEdge.objects.filter(from_friendship__user=self.user4,
+                                      to_friendship__user=self.user3).delete()
+        g = graph._build_array(graph.array('l', [1, 2, 2]),
+                               graph.array('l', [2, 1, 3]))
+        self.assertEqual(list(g.nodes), [1, 2, 3])
+        self.assertEqual(list(g.neighbours(2)), [1])
+        g = graph.load_graph()
+        self.assertEqual(list(g.nodes), [1, 2, 3, 4])
+        self.assertEqual(list(g.neighbours(3)), [2])
+        self.assertEqual(g.edge_count, 4)
+        self.assertEqual(graph.degree_histogram(g), {1: 1, 2: 2, 3: 1})
+        self.assertEqual(graph.connected_components(g), [4])
+
+    def test_metrics(self):
+        g = graph.load_graph()
+        self.assertEqual(graph.degree_histogram(g), {1: 1, 2: 2, 3: 1})
+        self.assertEqual(graph.top_degree(g, 1), [(3, 3)])
+        self.assertEqual(graph.connected_components(g), [4])
+        for processes in (1, 2):
+            triangles = graph.triangle_counts(g, processes)
+            self.assertEqual(list(triangles), [1, 1, 1, 0])
+        average, transitivity = graph.clustering(g, triangles)
+        self.assertAlmostEqual(average, (1 + 1 + 1 / 3.0) / 4)
+        self.assertAlmostEqual(transitivity, 3 / 5.0)
+
+    def test_command(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            call_command('friends_graph_stats', output=path, verbosity=0)
+            with open(path) as f:
+                report = json.load(f)
+        finally:
+            os.remove(path)
+        self.assertEqual(report['friendships'], 4)
+        self.assertEqual(report['triangles'], 1)
+        self.assertEqual(report['components'], 1)
+
+
+class SnapshotTestCase(BaseTestCase):
+    def setUp(self):
+        super(SnapshotTestCase, self).setUp()
+        Friendship.objects.befriend(self.user1, self.user3)
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        call_command('friends_snapshot', output=self.path, verbosity=0)
+        self._path = app_settings.SNAPSHOT_PATH
+        app_settings.SNAPSHOT_PATH = self.path
+
+    def tearDown(self):
+        app_settings.SNAPSHOT_PATH = self._path
+        os.remove(self.path)
+
+    def test_snapshot_file(self):
+        graph_snapshot = snapshot.GraphSnapshot(self.path)
+        self.assertEqual(graph_snapshot.friend_ids(self.user1.pk), [2, 3])
+        self.assertEqual(graph_snapshot.friend_ids(self.user4.pk), [])
+        self.assertEqual(graph_snapshot.are_friends(self.user3.pk,
+                                                    self.user1.pk), True)
+        self.assertEqual(graph_snapshot.are_friends(self.user3.pk,
+                                                    self.user2.pk), False)
+        graph_snapshot.close()
+
+    def test_read_mode(self):
+        # The changes of the last FRIENDS_CHANGE_COMMIT_LAG seconds may not
+        # be committed yet, they are applied again.
+        self.assertEqual(snapshot.get_snapshot().seq, 0)
+        Friendship.objects.befriend(self.user4, self.user2)
+        Friendship.objects.unfriend(self.user1, self.user2)
+        self.assertEqual(Friendship.objects.friend_ids(self.user1), [3])
+        self.assertEqual(Friendship.objects.friend_ids(self.user2), [4])
+        self.assertEqual(Friendship.objects.are_friends(self.user2,
+                                                        self.user4), True)
+        self.assertEqual(Friendship.objects.are_friends(self.user2,
+                                                        self.user1), False)
+        self.assertEqual(Friendship.objects.are_friends(self.user1,
+                                                        self.user3), True)
+        app_settings.SNAPSHOT_PATH = None
+        self.assertEqual(Friendship.objects.friend_ids(self.user2), [4])
+
+    def test_committed_seq(self):
+        FriendshipChange.objects.update(created=datetime.datetime(2009, 9, 11))
+        seq = FriendshipChange.objects.order_by('-id')[0].pk
+        Friendship.objects.befriend(self.user4, self.user2)
+        self.assertEqual(FriendshipChange.objects.committed_seq(), seq)
+        call_command('friends_snapshot', output=self.path, verbosity=0)
+        graph_snapshot = snapshot.GraphSnapshot(self.path)
+        self.assertEqual(graph_snapshot.seq, seq)
+        graph_snapshot.close()
+
+    def test_missing_file(self):
+        app_settings.SNAPSHOT_PATH = self.path + '.missing'
+        self.assertEqual(snapshot.get_snapshot(), None)
+        Friendship.objects.befriend(self.user4, self.user2)
+        self.assertEqual(Friendship.objects.friend_ids(self.user2), [1, 4])
+
+    def test_compact_changes(self):
+        Friendship.objects.befriend(self.user4, self.user2)
+        FriendshipChange.objects.update(created=datetime.datetime(2009, 9, 11))
+        call_command('friends_compact_changes', days=30, verbosity=0)
+        self.assertEqual(Friendship.objects.friend_ids(self.user2), [1, 4])
+
+
+class BloomTestCase(BaseTestCase):
+    def setUp(self):
+        super(BloomTestCase, self).setUp()
+        self._settings = (app_settings.BLOOM_MIN_FRIENDS,
+                          app_settings.BLOOM_REBUILD_THREADS)
+        app_settings.BLOOM_MIN_FRIENDS = 1
+        app_settings.BLOOM_REBUILD_THREADS = False
+        cache.clear()
+
+    def tearDown(self):
+        (app_settings.BLOOM_MIN_FRIENDS,
+         app_settings.BLOOM_REBUILD_THREADS) = self._settings
+        cache.clear()
+
+    def test_filter(self):
+        f = bloom.BloomFilter(1000, 0.01)
+        for user_id in xrange(0, 2000, 2):
+            f.add(user_id)
+        self.assertTrue(all(user_id in f for user_id in xrange(0, 2000, 2)))
+        false_positives = sum(user_id in f
+                              for user_id in xrange(1, 20001, 2))
+        self.assertTrue(false_positives < 300, false_positives)
+
+    def test_size(self):
+        for i in range(20):
+            Friendship.objects.befriend(
+                self.user1, User.objects.create(username='other%d' % i))
+        f = bloom.rebuild(self.user1)
+        self.assertEqual(f.capacity, 23)
+        self.assertTrue(len(f.bits) * 8 < 11 * 21, len(f.bits))
+        max_bytes = app_settings.BLOOM_MAX_BYTES
+        app_settings.BLOOM_MAX_BYTES = 100
+        app_settings.BLOOM_REBUILD_THREADS = True
+        try:
+            self.assertEqual(bloom.rebuild(self.user1), None)
+            self.assertEqual(bloom.get_filter(self.user1), None)
+        finally:
+            app_settings.BLOOM_MAX_BYTES = max_bytes
+        # Not rescheduled while the filter is too large.
+        self.assertEqual(cache.get(bloom.SCHEDULED_KEY % self.user1.pk),
+                         None)
+
+    def test_are_friends(self):
+        are_friends = Friendship.objects.are_friends
+        self.assertEqual(bloom.get_filter(self.user1), None)
+        bloom.rebuild(self.user1)
+        bloom.rebuild(self.user3)
+        self.assertEqual(bloom.get_filter(self.user3), None)
+        with self.assertNumQueries(0):
+            self.assertFalse(are_friends(self.user1, self.user3))
+        with self.assertNumQueries(1):
+            self.assertTrue(are_friends(self.user1, self.user2))
+        Friendship.objects.befriend(self.user1, self.user3)
+        self.assertTrue(self.user3.pk in bloom.get_filter(self.user1))
+        self.assertTrue(are_friends(self.user1, self.user3))
+        Friendship.objects.unfriend(self.user1, self.user3)
+        self.assertFalse(are_friends(self.user1, self.user3))
+        self.assertEqual(bloom.rebuild_all(), 2)
+        self.assertEqual(bloom.rebuild_all(), 0)
+        # Friends added recently survive rebuilds, their transaction may
+        # not be committed yet.
+        bloom.added(self.user1, self.user4)
+        bloom.rebuild(self.user1)
+        self.assertTrue(self.user4.pk in bloom.get_filter(self.user1))
+        self.assertFalse(are_friends(self.user1, self.user4))
+
+    def test_rebuild_race(self):
+        # A friendship committed after a rebuild read the ids of a user
+        # without filter, but before it stored the new filter.
+        locked = bloom._locked
+
+        @contextmanager
+        def befriend_then_lock(user_id):
+            bloom._locked = locked
+            Friendship.objects.befriend(self.user1, self.user3)
+            with locked(user_id) as result:
+                yield result
+
+        bloom._locked = befriend_then_lock
+        try:
+            bloom.rebuild(self.user1)
+        finally:
+            bloom._locked = locked
+        self.assertTrue(self.user3.pk in bloom.get_filter(self.user1))
+        self.assertTrue(Friendship.objects.are_friends(self.user1,
+                                                       self.user3))
+
+    def test_filter_friends(self):
+        bloom.rebuild(self.user1)
+        with self.assertNumQueries(0):
+            self.assertEqual(Friendship.objects.filter_friends(
+                self.user1, [self.user3, self.user4]), set())
+        with self.assertNumQueries(1):
+            self.assertEqual(Friendship.objects.filter_friends(
+                self.user1, [self.user2, self.user4]), set([self.user2.pk]))
+
+    def test_lock_contention(self):
+        bloom.rebuild(self.user1)
+        cache.add(bloom.LOCK_KEY % self.user1.pk, True)
+        bloom.added(self.user1, self.user3)
+        self.assertEqual(bloom.get_filter(self.user1), None)
+        cache.delete(bloom.LOCK_KEY % self.user1.pk)
+        bloom.rebuild(self.user1)
+        self.assertEqual(bloom.get_filter(self.user1), None)
+
+
+class SearchFriendsTestCase(BaseTestCase):
+    urls = 'friends.urls'
+
+    def setUp(self):
+        super(SearchFriendsTestCase, self).setUp()
+        for username in ('Alice', 'alfred', 'bob'):
+            friend = User.objects.create(username=username)
+            Friendship.objects.befriend(self.user1, friend)
+        cache.clear()
+        self._min_friends = models.SEARCH_CACHE_MIN_FRIENDS
+
+    def tearDown(self):
+        models.SEARCH_CACHE_MIN_FRIENDS = self._min_friends
+        cache.clear()
+
+    def search(self, prefix, limit=10):
+        return [r['username'] for r in
+                Friendship.objects.search_friends(self.user1, prefix, limit)]
+
+    def test_search_database(self):
+        for min_friends in (None, 100):
+            models.SEARCH_CACHE_MIN_FRIENDS = min_friends
+            self.assertEqual(set(self.search('AL')), set(['Alice', 'alfred']))
+            self.assertEqual(len(self.search('al', 1)), 1)
+            self.assertEqual(self.search('testuser'), ['testuser2'])
+            self.assertEqual(self.search('x'), [])
+
+    def test_search_cache(self):
+        models.SEARCH_CACHE_MIN_FRIENDS = 2
+        self.assertEqual(self.search('al'), ['alfred', 'Alice'])
+        self.assertEqual(self.search('al', 1), ['alfred'])
+        self.assertEqual(self.search('b'), ['bob'])
+        self.assertEqual(self.search('c'), [])
+        Friendship.objects.unfriend(self.user1, User.objects.get(
+            username='bob'))
+        self.assertEqual(self.search('b'), [])
+
+    def test_rename_friend(self):
+        models.SEARCH_CACHE_MIN_FRIENDS = 2
+        self.assertEqual(self.search('al'), ['alfred', 'Alice'])
+        alfred = User.objects.get(username='alfred')
+        alfred.save()
+        self.assertNotEqual(cache.get(Friendship.objects.SEARCH_KEY %
+                                      self.user1.pk), None)
+        alfred.username = 'fred'
+        alfred.save()
+        self.assertEqual(self.search('al'), ['Alice'])
+        self.assertEqual(self.search('f'), ['fred'])
+
+    def test_search_view(self):
+        self.client.login(username='testuser1', password='testuser1')
+        response = self.client.get(reverse('friend_search'), {'q': 'bo'})
+        self.assertEqual(json.loads(response.content)['results'][0]
+                         ['username'], 'bob')
+        response = self.client.get(reverse('friend_search'), {'q': ''})
+        self.assertEqual(json.loads(response.content), {'results': []})
+        response = self.client.get(reverse('friend_search'),
+                                   {'q': 'b', 'limit': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+
+class ThrottlingTestCase(BaseTestCase):
+    urls = 'friends.urls'
+
+    def setUp(self):
+        super(ThrottlingTestCase, self).setUp()
+        app_settings.THROTTLE_RATES['request'] = '2/m'
+        cache.clear()
+
+    def tearDown(self):
+        del app_settings.THROTTLE_RATES['request']
+        cache.clear()
+
+    def test_parse_rate(self):
+        self.assertEqual(throttling.parse_rate('20/m'), (20, 60))
+        self.assertEqual(throttling.parse_rate('1/hour'), (1, 3600))
+
+    def test_is_throttled(self):
+        results = [throttling.is_throttled('test', 1, '3/d')
+                   for i in range(5)]
+        self.assertEqual(results, [False, False, False, True, True])
+        self.assertEqual(throttling.is_throttled('test', 2, '3/d'), False)
+
+    def test_throttled_view(self):
+        self.client.login(username='testuser1', password='testuser1')
+        for username in ('testuser3', 'testuser4'):
+            response = self.client.get(reverse('friendship_request',
+                                               args=(username,)))
+            self.assertEqual(response.status_code, 302)
+        response = self.client.get(reverse('friendship_request',
+                                           args=('nonexistent',)))
+        self.assertEqual(response.status_code, 429)
+        response = self.client.get(reverse('user_block',
+                                           args=('testuser3',)))
+        self.assertEqual(response.status_code, 302)
+
+
+class RequestFriendshipTestCase(BaseTestCase):
+    urls = 'friends.urls'
+
+    def test_request_friendship(self):
+        request_friendship = FriendshipRequest.objects.request_friendship
+        self.assertEqual(request_friendship(self.user1, self.user2),
+                         FriendshipRequest.objects.ALREADY_FRIENDS)
+        self.assertEqual(request_friendship(self.user1, self.user3, u'hi'),
+                         FriendshipRequest.objects.REQUESTED)
+        self.assertEqual(request_friendship(self.user1, self.user3),
+                         FriendshipRequest.objects.ALREADY_REQUESTED)
+        self.assertEqual(FriendshipRequest.objects.get(
+            from_user=self.user1, to_user=self.user3).message, u'hi')
+        self.assertEqual(request_friendship(self.user3, self.user1),
+                         FriendshipRequest.objects.ACCEPTED)
+        self.assertEqual(Friendship.objects.are_friends(self.user1,
+                                                        self.user3), True)
+        self.assertEqual(FriendshipRequest.objects.filter(
+            from_user=self.user3, to_user=self.user1).count(), 0)
+
+    def test_request_view_already_friends(self):
+        self.client.login(username='testuser1', password='testuser1')
+        response = self.client.get(reverse('friendship_request',
+                                           args=('testuser2',)))
+        self.assertEqual(response.status_code, 302)
+
+
+@skipIf(connection.vendor == 'sqlite' and
+        connection.settings_dict.get('TEST_NAME') in (None, '', ':memory:'),
+        'Threads can\'t share an in-memory SQLite database, set TEST_NAME.')
+class ConcurrentRequestTestCase(TransactionTestCase):
+    fixtures = ['test_data.json']
+
+    def run_concurrently(self, *calls):
+        start = threading.Event()
+        errors = []
+
+        def run(function, args):
+            start.wait()
+            try:
+                function(*args)
+            except Exception, e:
+                errors.append(e)
+            finally:
+                connections['default'].close()
+
+        threads = [threading.Thread(target=run, args=call) for call in calls]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_complementary_requests(self):
+        request_friendship = FriendshipRequest.objects.request_friendship
+        for i in range(5):
+            user1 = User.objects.create(username='a%d' % i)
+            user2 = User.objects.create(username='b%d' % i)
+            self.run_concurrently((request_friendship, (user1, user2)),
+                                  (request_friendship, (user2, user1)))
+            self.assertEqual(Friendship.objects.are_friends(user1, user2),
+                             True)
+            self.assertEqual(FriendshipRequest.objects.filter(
+                accepted=False, from_user__in=[user1, user2]).count(), 0)
+
+    def test_duplicate_requests(self):
+        user1, user2 = User.objects.get(pk=3), User.objects.get(pk=4)
+        request_friendship = FriendshipRequest.objects.request_friendship
+        self.run_concurrently(*[(request_friendship, (user1, user2))] * 4)
+        self.assertEqual(FriendshipRequest.objects.filter(
+            from_user=user1, to_user=user2).count(), 1)
+
+
+class FriendshipEdgeTestCase(BaseTestCase):
+    def test_recent_friends(self):
+        Friendship.objects.befriend(self.user1, self.user3)
+        Friendship.objects.befriend(self.user4, self.user1)
+        recent = Friendship.objects.recent_friends(self.user1, 2)
+        self.assertEqual(recent, [self.user4, self.user3])
+        self.assertTrue(recent[0].friends_since >= recent[1].friends_since)
+        self.assertEqual(Friendship.objects.recent_friends(self.user3),
+                         [self.user1])
+        since = Friendship.objects.friends_since(
+            self.user1, datetime.datetime(2010, 1, 1))
+        self.assertEqual(set(since), set([self.user3, self.user4]))
+        self.assertEqual(Friendship.objects.friends_since(
+            self.user2, datetime.datetime(2009, 9, 11, 1, 10)), [self.user1])
+
+    def test_befriend_twice(self):
+        Friendship.objects.befriend(self.user1, self.user2)
+        Friendship.objects.befriend(self.user2, self.user1)
+        self.assertEqual(list(Friendship.objects.friends_of(self.user1)),
+                         [self.user2])
+
+    def test_migrate_edges(self):
+        call_command('friends_migrate_edges', verbosity=0)
+        self.assertEqual(Friendship.objects.recent_friends(self.user1)[0]
+                         .friends_since, datetime.datetime(2009, 9, 11, 1, 10))
+
+
+
+class MigrateEdgesTestCase(TransactionTestCase):
+    fixtures = ['test_data.json']
+
+    def test_migrate_table(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('The table is recreated with SQLite syntax.')
+        # The table as created before FriendshipEdge.created.
+        table = FriendshipEdge._meta.db_table
+        cursor = connection.cursor()
+        cursor.execute('CREATE TABLE old AS SELECT id, from_friendship_id, '
+                       'to_friendship_id FROM %s' % table)
+        cursor.execute('DROP TABLE %s' % table)
+        cursor.execute('ALTER TABLE old RENAME TO %s' % table)
+        call_command('friends_migrate_edges', verbosity=0)
+        self.assertEqual([column[6] for column
+                          in connection.introspection.get_table_description(
+                              connection.cursor(), table)
+                          if column[0] == 'created'], [False])
+        self.assertFalse(FriendshipEdge.objects.filter(created=None).exists())
+        # The time of the accepted friendship request.
+        user1 = User.objects.get(username='testuser1')
+        self.assertEqual(Friendship.objects.recent_friends(user1)[0]
+                         .friends_since, datetime.datetime(2009, 9, 10))
+        Friendship.objects.befriend(user1, 3)
+
+class FriendshipChangeTestCase(BaseTestCase):
+    def actions(self, user):
+        return [(change.action, change.other_id, change.outgoing) for change
+                in FriendshipChange.objects.read_changes(user=user)]
+
+    def test_record_changes(self):
+        FriendshipRequest.objects.request_friendship(self.user3, self.user4)
+        FriendshipRequest.objects.get(from_user=self.user3).accept()
+        Friendship.objects.unfriend(self.user4, self.user3)
+        Friendship.objects.unfriend(self.user4, self.user3)
+        self.assertEqual(self.actions(self.user3), [
+            (FriendshipChange.REQUEST, self.user4.pk, True),
+            (FriendshipChange.BEFRIEND, self.user4.pk, True),
+            (FriendshipChange.ACCEPT, self.user4.pk, False),
+            (FriendshipChange.UNFRIEND, self.user4.pk, False),
+        ])
+        self.assertEqual(UserBlocks.objects.block(self.user3, self.user1),
+                         True)
+        self.assertEqual(UserBlocks.objects.block(self.user3, self.user1),
+                         False)
+        self.assertEqual(UserBlocks.objects.unblock(self.user3, self.user1),
+                         True)
+        self.assertEqual(self.actions(self.user1), [
+            (FriendshipChange.BLOCK, self.user3.pk, False),
+            (FriendshipChange.UNBLOCK, self.user3.pk, False),
+        ])
+
+    def test_read_changes(self):
+        for user in (self.user2, self.user3, self.user4):
+            UserBlocks.objects.block(self.user3, user)
+        changes = FriendshipChange.objects.read_changes(limit=2)
+        self.assertEqual([change.other_id for change in changes],
+                         [self.user2.pk, self.user3.pk])
+        self.assertTrue(all(change.user_id == self.user3.pk
+                            for change in changes))
+        changes = FriendshipChange.objects.read_changes(after=changes[-1].pk)
+        self.assertEqual([change.other_id for change in changes],
+                         [self.user4.pk])
+
+    def test_compact_changes(self):
+        Friendship.objects.befriend(self.user3, self.user4)
+        FriendshipChange.objects.filter(user_id=self.user3.pk).update(
+            created=datetime.datetime(2009, 9, 11))
+        call_command('friends_compact_changes', days=30, verbosity=0)
+        self.assertEqual(list(FriendshipChange.objects.values_list(
+            'user_id', flat=True)), [self.user4.pk])
+
+
+class SyncTestCase(BaseTestCase):
+    urls = 'friends.urls'
+
+    def setUp(self):
+        super(SyncTestCase, self).setUp()
+        self._lag = app_settings.CHANGE_COMMIT_LAG
+        app_settings.CHANGE_COMMIT_LAG = 0
+
+    def tearDown(self):
+        app_settings.CHANGE_COMMIT_LAG = self._lag
+
+    def test_full_sync(self):
+        result = sync_relationships(self.user1)
+        self.assertEqual(result['full'], True)
+        self.assertEqual(result['friends']['added'],
+                         [{'id': self.user2.pk, 'username': 'testuser2'}])
+        self.assertEqual(result['requests_sent']['added'], [])
+        self.assertEqual(result['blocks']['added'],
+                         [{'id': self.user4.pk, 'username': 'testuser4'}])
+        self.assertEqual(sync_relationships(self.user1, 'invalid')['full'],
+                         True)
+        self.assertEqual(
+            sync_relationships(self.user2, result['token'])['full'],
+            True,
+        )
+
+    def test_delta_sync(self):
+        token = sync_relationships(self.user3)['token']
+        FriendshipRequest.objects.request_friendship(self.user3, self.user4)
+        FriendshipRequest.objects.request_friendship(self.user3, self.user1)
+        FriendshipRequest.objects.get(from_user=self.user3,
+                                      to_user=self.user1).cancel()
+        UserBlocks.objects.block(self.user1, self.user3)
+        result = sync_relationships(self.user3, token)
+        self.assertEqual(result['full'], False)
+        self.assertEqual(result['requests_sent'], {
+            'added': [{'id': self.user4.pk, 'username': 'testuser4'}],
+            'removed': [self.user1.pk],
+        })
+        self.assertEqual(result['blocks'], {'added': [], 'removed': []})
+        FriendshipRequest.objects.get(from_user=self.user3).accept()
+        result = sync_relationships(self.user3, result['token'])
+        self.assertEqual(result['friends']['added'],
+                         [{'id': self.user4.pk, 'username': 'testuser4'}])
+        self.assertEqual(result['requests_sent']['removed'], [self.user4.pk])
+        result = sync_relationships(self.user3, result['token'])
+        self.assertEqual(result['friends'], {'added': [], 'removed': []})
+
+    def test_compacted_sync(self):
+        token = sync_relationships(self.user3)['token']
+        Friendship.objects.befriend(self.user3, self.user4)
+        Friendship.objects.unfriend(self.user3, self.user4)
+        FriendshipChange.objects.order_by('id')[0].delete()
+        self.assertEqual(sync_relationships(self.user3, token)['full'], True)
+
+    def test_commit_lag(self):
+        app_settings.CHANGE_COMMIT_LAG = 60
+        token = sync_relationships(self.user3)['token']
+        FriendshipRequest.objects.request_friendship(self.user3, self.user4)
+        added = [{'id': self.user4.pk, 'username': 'testuser4'}]
+        result = sync_relationships(self.user3, token)
+        self.assertEqual(result['requests_sent']['added'], added)
+        # Sent again as a change with a lower id may not be committed yet.
+        result = sync_relationships(self.user3, result['token'])
+        self.assertEqual(result['requests_sent']['added'], added)
+        FriendshipChange.objects.update(created=datetime.datetime(2009, 9, 11))
+        result = sync_relationships(self.user3, result['token'])
+        self.assertEqual(result['requests_sent']['added'], added)
+        result = sync_relationships(self.user3, result['token'])
+        self.assertEqual(result['requests_sent']['added'], [])
+
+    def test_sync_view(self):
+        self.client.login(username='testuser1', password='testuser1')
+        response = self.client.get(reverse('friendship_sync'))
+        self.assertEqual(response['Content-Type'], 'application/json')
+        token = json.loads(response.content)['token']
+        response = self.client.get(reverse('friendship_sync'),
+                                   {'token': token})
+        self.assertEqual(json.loads(response.content)['full'], False)
+
+
+class BackfillTestCase(BaseTestCase):
+    def setUp(self):
+        super(BackfillTestCase, self).setUp()
+        Friendship.objects.filter(user__in=(self.user1, self.user3)).delete()
+        UserBlocks.objects.filter(user=self.user4).delete()
+
+    def test_backfill(self):
+        fd, checkpoint = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(checkpoint)
+        try:
+            call_command('friends_backfill', chunk_size=2, start_after=1,
+                         checkpoint=checkpoint, verbosity=0)
+            self.assertFalse(Friendship.objects.filter(
+                user=self.user1).exists())
+            self.assertEqual(Friendship.objects.count(), 3)
+            self.assertEqual(UserBlocks.objects.count(), 4)
+            with open(checkpoint) as f:
+                self.assertEqual(int(f.read()), self.user4.pk)
+            # Resumes from the checkpoint.
+            call_command('friends_backfill', checkpoint=checkpoint,
+                         verbosity=0)
+            self.assertEqual(Friendship.objects.count(), 3)
+        finally:
+            os.remove(checkpoint)
+
+    def test_backfill_idempotent(self):
+        self.assertEqual(sum(created for high, created in backfill(1)), 3)
+        self.assertEqual(sum(created for high, created in backfill(1)), 0)
+        self.assertEqual(Friendship.objects.count(), 4)
+
+
+class ConsistencyTestCase(BaseTestCase):
+    def setUp(self):
+        super(ConsistencyTestCase, self).setUp()
+        FriendshipEdge.objects.filter(from_friendship__user=self.user2) \
+            .delete()
+        FriendshipRequest.objects.filter(pk=1).update(accepted=False)
+        FriendshipRequest.objects.create(from_user=self.user3,
+                                         to_user=self.user4)
+        FriendshipRequest.objects.create(from_user=self.user4,
+                                         to_user=self.user3)
+        UserBlocks.objects.filter(user=self.user3).delete()
+
+    def test_check(self):
+        results = run_checks(chunk_size=1)
+        self.assertEqual(dict((name, (result['count'], result['samples']))
+                              for name, result in results.iteritems()), {
+            'one_sided_edges': (1, [(self.user1.pk, self.user2.pk)]),
+            'requests_between_friends': (1, [(self.user1.pk,
+                                              self.user2.pk)]),
+            'complementary_requests': (1, [(self.user4.pk, self.user3.pk)]),
+            'missing_rows': (1, [(self.user3.pk,)]),
+        })
+
+    def test_repair(self):
+        call_command('friends_check', repair=True, chunk_size=2, verbosity=0)
+        self.assertTrue(Friendship.objects.are_friends(self.user2,
+                                                       self.user1))
+        self.assertEqual(FriendshipRequest.objects.filter(
+            accepted=False).count(), 1)
+        self.assertTrue(UserBlocks.objects.filter(user=self.user3).exists())
+        self.assertEqual(sum(result['count'] for result
+                             in run_checks().itervalues()), 0)
+
+
+class PurgeUserTestCase(BaseTestCase):
+    def test_purge_user(self):
+        Friendship.objects.befriend(self.user1, self.user3)
+        FriendshipRequest.objects.create(from_user=self.user4,
+                                         to_user=self.user1)
+        self.assertEqual(purge_user(self.user1, chunk_size=1),
+                         {'friends': 2, 'requests': 2, 'blocks': 2})
+        self.assertEqual(list(Friendship.objects.friends_of(self.user2)), [])
+        self.assertFalse(FriendshipEdge.objects.exists())
+        self.assertFalse(FriendshipRequest.objects.filter(
+            to_user=self.user1).exists())
+        self.assertEqual(list(self.user4.user_blocks.blocks.all()),
+                         [self.user3])
+        self.assertFalse(FriendshipChange.objects.filter(
+            user_id=self.user1.pk).exists())
+        self.assertEqual(list(FriendshipChange.objects.filter(
+            user_id=self.user3.pk).values_list('action', flat=True)),
+            [FriendshipChange.BEFRIEND, FriendshipChange.UNFRIEND])
+        # Only the records of the purged user itself are missing.
+        self.assertEqual(dict((name, result['count']) for name, result
+                              in run_checks().iteritems()), {
+            'one_sided_edges': 0,
+            'requests_between_friends': 0,
+            'complementary_requests': 0,
+            'missing_rows': 1,
+        })
+
+    def test_purge_command(self):
+        call_command('friends_purge_user', 'testuser2', delete_user=True,
+                     verbosity=0)
+        self.assertFalse(User.objects.filter(username='testuser2').exists())
+        self.assertEqual(list(Friendship.objects.friends_of(self.user1)), [])
+
+
+class LoadTestTestCase(BaseTestCase):
+    def test_generate_operations(self):
+        operations = generate_operations('celebrity', 4, 50, seed=1)
+        self.assertEqual(len(operations), 50)
+        self.assertTrue(all(0 in (actor, target)
+                            for action, actor, target in operations))
+        self.assertEqual(operations,
+                         generate_operations('celebrity', 4, 50, seed=1))
+        first, second = generate_operations('mutual', 4, 2, seed=1)
+        self.assertEqual(first[1:], second[2:0:-1])
+        self.assertRaises(ValueError, generate_operations, 'nope', 4, 1)
+
+    def test_run_load(self):
+        users = [self.user3, self.user4]
+        report = run_load(users, [('request', 0, 1), ('accept', 1, 0),
+                                  ('accept', 0, 1), ('delete', 0, 1),
+                                  ('block', 1, 0)])
+        self.assertEqual(report['operations'], 5)
+        self.assertEqual(report['outcomes'], {'status 302': 4, 'Http404': 1})
+        self.assertEqual(sum(report['invariants'].values()), 0)
+
+
+class GenerateTestCase(BaseTestCase):
+    def test_generate_graph(self):
+        edges, requests, blocks = generate_graph(200, seed=1,
+                                                 community_size=20)
+        edges = list(edges)
+        self.assertEqual(edges, list(generate_graph(200, seed=1,
+                                                    community_size=20)[0]))
+        self.assertEqual(len(set(edges)), len(edges))
+        self.assertTrue(all(user < friend for user, friend in edges))
+        self.assertEqual((len(requests), len(blocks)), (20, 4))
+        pairs = set(edges)
+        for user, other in requests + blocks:
+            self.assertFalse((min(user, other), max(user, other)) in pairs)
+
+    def test_generate_command(self):
+        call_command('friends_generate', users=50, seed=1, prefix='gen',
+                     requests=0.2, chunk_size=7, verbosity=0)
+        users = User.objects.filter(username__startswith='gen')
+        self.assertEqual(users.count(), 50)
+        self.assertEqual(FriendshipRequest.objects.filter(
+            from_user__in=users).count(), 10)
+        self.assertTrue(FriendshipEdge.objects.filter(
+            from_friendship__user__in=users).exists())
+        self.assertEqual(sum(result['count'] for result
+                             in run_checks().itervalues()), 0)
+
+
+class QueryBudgetTestCase(BaseTestCase):
+    """
+    Pin the number of queries of every public operation, and check that it
+    doesn't depend on the number of friends where it shouldn't.
+    """
+
+    SIZES = (1, 10, 40)
+
+    def setUp(self):
+        super(QueryBudgetTestCase, self).setUp()
+        self.factory = RequestFactory()
+        self.render_to_string = loader.render_to_string
+        # No templates are shipped for the tags.
+        loader.render_to_string = lambda *args, **kwargs: u''
+        self.others = []
+
+    def tearDown(self):
+        loader.render_to_string = self.render_to_string
+        super(QueryBudgetTestCase, self).tearDown()
+
+    @contextmanager
+    def assertQueries(self, num, using='default'):
+        connection = connections[using]
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        start = len(connection.queries)
+        try:
+            yield
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+        queries = connection.queries[start:]
+        if len(queries) != num:
+            self.fail('%d queries executed, %d expected:\n%s' % (
+                len(queries), num,
+                '\n'.join('%d. %s' % (i, query['sql'])
+                          for i, query in enumerate(queries, 1)),
+            ))
+
+    def grow(self, size):
+        """
+        Give user3 ``size`` friends, each having sent a request to user4 and
+        being blocked by user4.
+        """
+        while len(self.others) < size:
+            other = User.objects.create(username='other%d' % len(self.others))
+            Friendship.objects.befriend(self.user3, other)
+            FriendshipRequest.objects.create(from_user=other,
+                                             to_user=self.user4)
+            self.user4.user_blocks.blocks.add(other)
+            self.others.append(other)
+
+    def sized(self, num, func):
+        for size in self.SIZES:
+            self.grow(size)
+            with self.assertQueries(num):
+                func()
+
+    def test_manager_reads(self):
+        manager = Friendship.objects
+        self.sized(1, lambda: list(manager.friends_of(self.user3)))
+        self.sized(1, lambda: manager.are_friends(self.user3, self.user4))
+        self.sized(1, lambda: manager.friend_ids(self.user3))
+        self.sized(1, lambda: manager.recent_friends(self.user3))
+        self.sized(1, lambda: manager.search_friends(self.user3, u'oth'))
+        self.sized(1, Friendship.objects.get(user=self.user3).friend_count)
+
+    def test_filters(self):
+        def requests():
+            result = friends_tags.friendship_requests(self.user4)
+            list(result['sent']), list(result['received'])
+
+        def blocks():
+            result = friends_tags.blocks(self.user4)
+            list(result['applied']), list(result['received'])
+
+        self.sized(1, lambda: list(friends_tags.friends_(self.user3)))
+        self.sized(2, requests)
+        self.sized(2, blocks)
+        self.sized(1, lambda: friends_tags.is_blocked_by(self.user3,
+                                                         self.user4))
+        self.sized(1, lambda: friends_tags.is_friends_with(self.user3,
+                                                           self.user4))
+
+    def test_tags(self):
+        page = Template('{% load friends_tags %}{% for other in others %}'
+                        '{% addtofriends other %}{% blockuser other %}'
+                        '{% endfor %}')
+        for size in self.SIZES:
+            self.grow(size)
+            context = Context({'user': self.user4, 'others': self.others})
+            # are_friends() and the invitation for addtofriends, the block
+            # for blockuser.
+            with self.assertQueries(3 * size):
+                page.render(context)
+
+    def test_views(self):
+        def view(function, user, target, **kwargs):
+            request = self.factory.get('/', kwargs)
+            request.user = user
+            return function(request, username=target.username)
+
+        self.grow(self.SIZES[-1])
+        other = self.others[0]
+        for function, user, target, num in (
+            (views.friendship_request, self.user3, self.user1, 6),
+            (views.friendship_cancel, self.user3, self.user1, 4),
+            (views.friendship_request, self.user1, self.user3, 6),
+            (views.friendship_accept, self.user3, self.user1, 10),
+            (views.friendship_delete, self.user3, other, 4),
+            (views.friendship_request, other, self.user3, 6),
+            (views.friendship_decline, self.user3, other, 4),
+            (views.user_block, self.user3, other, 6),
+            (views.user_unblock, self.user3, other, 6),
+        ):
+            with self.assertQueries(num):
+                response = view(function, user, target)
+            self.assertEqual(response.status_code, 302)
+
+    def test_repeated_writes(self):
+        # Changes are only recorded when rows were inserted or deleted.
+        manager = Friendship.objects
+        for write in (manager.befriend, manager.unfriend):
+            write(self.user1, self.user3)
+            count = FriendshipChange.objects.count()
+            write(self.user1, self.user3)
+            self.assertEqual(FriendshipChange.objects.count(), count)
+
+    def test_insert_ignore_fallback(self):
+        connection = connections['default']
+        connection.vendor = 'unknown'
+        try:
+            self.assertEqual(utils.insert_ignore(
+                'default', Friendship, ['user_id'], 'SELECT %s AS user_id',
+                [self.user1.pk], ['user_id']), 0)
+            for i in range(2):
+                Friendship.objects.befriend(self.user1, self.user3)
+        finally:
+            del connection.vendor
+        self.assertEqual(FriendshipEdge.objects.filter(
+            from_friendship__user=self.user3).count(), 1)
+        self.assertEqual(FriendshipChange.objects.filter(
+            user_id=self.user3.pk).count(), 1)
+
+    def test_json_views(self):
+        self.grow(self.SIZES[-1])
+        for function, params, num in (
+            (views.friend_search, {'q': 'oth'}, 1),
+            # A full sync reads the latest change and exports.
+            (views.friendship_sync, {}, 5),
+            (views.friendship_export, {}, 4),
+        ):
+            request = self.factory.get('/', params)
+            request.user = self.user3
+            with self.assertQueries(num):
+                response = function(request)
+                response.content
+            self.assertEqual(response.status_code, 200)
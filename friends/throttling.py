@@ -0,0 +1,71 @@
+"""
+Throttling
+==========
+
+Rate limiting of the :ref:`action views <class-based-views>`. Rates are
+configured per :attr:`~friends.views.BaseActionView.throttle_scope` with the
+``FRIENDS_THROTTLE_RATES`` setting, as ``'<count>/<period>'`` strings where
+period is one of ``s``, ``m``, ``h`` or ``d``::
+
+    FRIENDS_THROTTLE_RATES = {
+        'request': '20/m',
+        'block': '100/h',
+    }
+
+Scopes without a rate are not throttled.
+
+A sliding window is approximated by weighting the previous fixed window's
+count by how much of it still overlaps the sliding window. Each check is one
+``get_many()`` and one ``incr()`` on the default cache, no database queries
+are made.
+
+.. autofunction:: parse_rate
+
+.. autofunction:: is_throttled
+"""
+
+
+import time
+from django.core.cache import cache
+
+
+PERIODS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+KEY = 'friends.throttle.%s.%s.%d'
+
+
+def parse_rate(rate):
+    """
+    Parse a ``'<count>/<period>'`` string.
+
+    :returns: ``(count, seconds)`` tuple.
+    """
+    count, period = rate.split('/')
+    return int(count), PERIODS[period.strip()[0]]
+
+
+def is_throttled(scope, ident, rate):
+    """
+    Count a hit for ``ident`` in ``scope`` and indicate if it exceeds
+    ``rate``. Throttled hits are not counted.
+
+    :param scope: Name of the throttled action.
+    :param ident: Identifier of the client, such as the user id.
+    :param rate: ``'<count>/<period>'`` string.
+    :rtype: |bool|
+    """
+    count, period = parse_rate(rate)
+    now = time.time()
+    window = int(now // period)
+    key = KEY % (scope, ident, window)
+    hits = cache.get_many([key, KEY % (scope, ident, window - 1)])
+    overlap = 1.0 - (now % period) / period
+    estimate = hits.get(KEY % (scope, ident, window - 1), 0) * overlap + \
+        hits.get(key, 0)
+    if estimate >= count:
+        return True
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, period * 2):
+            cache.incr(key)
+    return False
@@ -27,4 +27,13 @@ urlpatterns = patterns(
     url(r'^unblock/(?P<username>[\+\w\.@-_]+)/$',
         'user_unblock',
         name='user_unblock'),
+    url(r'^export/$',
+        'friendship_export',
+        name='friendship_export'),
+    url(r'^search/$',
+        'friend_search',
+        name='friend_search'),
+    url(r'^sync/$',
+        'friendship_sync',
+        name='friendship_sync'),
 )
@@ -0,0 +1,133 @@
+"""
+Utilities
+=========
+
+.. autofunction:: keyset_iterator
+
+.. autofunction:: key_ranges
+
+.. autofunction:: execute
+
+.. autofunction:: insert_ignore
+"""
+
+
+from django.db import connections, transaction
+
+
+def keyset_iterator(queryset, chunk_size, key='pk'):
+    """
+    Iterate over ``queryset`` in chunks of ``chunk_size`` rows using keyset
+    pagination on ``key``.
+
+    Each chunk is fetched with ``WHERE key > last ORDER BY key LIMIT n``, so
+    memory use stays constant regardless of the size of ``queryset`` and
+    every chunk is served by an index range scan instead of an ``OFFSET``.
+
+    :param queryset: A ``values_list()``
+                     :class:`~django.db.models.query.QuerySet` whose first
+                     column is ``key``.
+    :param |int| chunk_size: Number of rows fetched per query.
+    :param key: Optional. Default ``'pk'``. Unique, orderable column.
+    :returns: Iterator over the rows of ``queryset``.
+    """
+    queryset = queryset.order_by(key)
+    last = None
+    while True:
+        chunk = queryset
+        if last is not None:
+            chunk = chunk.filter(**{'%s__gt' % key: last})
+        rows = list(chunk[:chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            break
+        last = rows[-1][0]
+
+
+def key_ranges(queryset, chunk_size, start_after=0, key='pk'):
+    """
+    Yield ``(low, high)`` tuples such that each of the ranges
+    ``low < key <= high`` holds ``chunk_size`` rows of ``queryset``, except
+    the last one.
+
+    Finding a range costs one index scan of ``chunk_size`` keys, no rows are
+    loaded, so the ranges can be handed to set-based SQL statements or to
+    other processes.
+
+    :param queryset: A flat ``values_list()``
+                     :class:`~django.db.models.query.QuerySet` of ``key``.
+    :param |int| chunk_size: Number of rows per range.
+    :param start_after: Optional. Default ``0``. Key to start after.
+    :param key: Optional. Default ``'pk'``. Unique, orderable column.
+    """
+    queryset = queryset.order_by(key)
+    low = start_after
+    while True:
+        rest = queryset.filter(**{'%s__gt' % key: low})
+        high = rest[chunk_size - 1:chunk_size]
+        if not high:
+            high = rest.order_by('-%s' % key)[:1]
+            if high:
+                yield low, high[0]
+            return
+        yield low, high[0]
+        low = high[0]
+
+
+def execute(using, sql, params=(), **names):
+    """
+    Execute ``sql`` on the database ``using`` and return the number of rows
+    it affected.
+
+    The current transaction is marked dirty so that it is committed.
+
+    :param sql: SQL with ``{name}`` placeholders for the already quoted
+                ``names``, and ``%s`` placeholders for ``params``.
+    :rtype: |int|
+    """
+    if names:
+        sql = sql.format(**names)
+    cursor = connections[using].cursor()
+    cursor.execute(sql, params)
+    transaction.set_dirty(using=using)
+    return cursor.rowcount
+
+
+def insert_ignore(using, model, columns, select, params, unique):
+    """
+    Insert the rows returned by ``select`` into the table of ``model`` with a
+    single statement, skipping those that violate the unique constraint on
+    ``unique``.
+
+    This is ``INSERT OR IGNORE`` on SQLite, ``INSERT IGNORE`` on MySQL and
+    ``ON CONFLICT DO NOTHING`` on PostgreSQL 9.5 and later. Other databases
+    filter out the existing rows with ``NOT EXISTS``, in which case
+    concurrent inserts of the same row may still raise an
+    :exc:`~django.db.IntegrityError`.
+
+    :param columns: Names of the columns inserted.
+    :param select: SQL query returning ``columns``, aliased with their
+                   names, and with ``%s`` placeholders for ``params``.
+    :param unique: Names of the columns of the unique constraint.
+    :returns: Number of rows inserted.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    names = ', '.join(qn(column) for column in columns)
+    vendor = connection.vendor
+    if vendor == 'sqlite':
+        sql = 'INSERT OR IGNORE INTO %s (%s) %s' % (table, names, select)
+    elif vendor == 'mysql':
+        sql = 'INSERT IGNORE INTO %s (%s) %s' % (table, names, select)
+    elif vendor == 'postgresql' and connection.pg_version >= 90500:
+        sql = 'INSERT INTO %s (%s) %s ON CONFLICT DO NOTHING' % (
+            table, names, select)
+    else:
+        sql = ('INSERT INTO %s (%s) SELECT %s FROM (%s) s WHERE NOT EXISTS '
+               '(SELECT 1 FROM %s t WHERE %s)') % (
+            table, names, names, select, table,
+            ' AND '.join('t.%s = s.%s' % (qn(column), qn(column))
+                         for column in unique))
+    return execute(using, sql, params)
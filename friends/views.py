@@ -28,6 +28,12 @@ but :ref:`view functions <view-functions>` are also provided.
 
 .. autoclass:: UserUnblockView
 
+.. autoclass:: FriendshipExportView
+
+.. autoclass:: FriendSearchView
+
+.. autoclass:: FriendshipSyncView
+
 
 .. _view-functions:
 
@@ -52,40 +58,162 @@ View Functions
 .. autofunction:: user_block
 
 .. autofunction:: user_unblock
+
+.. autofunction:: friendship_export
+
+.. autofunction:: friend_search
+
+.. autofunction:: friendship_sync
 """
 
-from django.http import HttpResponseBadRequest, Http404
+import json
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
 from django.db import transaction
-from django.views.generic.base import RedirectView
+from django.db.models import Q
+from django.views.generic.base import RedirectView, View
 from django.shortcuts import get_object_or_404
 from django.utils.translation import ugettext
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
-from models import FriendshipRequest, Friendship
-from app_settings import REDIRECT_FALLBACK_TO_PROFILE
+from models import FriendshipRequest, Friendship, UserBlocks
+from routers import read_database, write_database
+from export import export_relationships
+from sync import sync_relationships
+from throttling import is_throttled
+from app_settings import REDIRECT_FALLBACK_TO_PROFILE, SEARCH_MAX_RESULTS, \
+                         THROTTLE_RATES
 
 
 class BaseActionView(RedirectView):
     """
     Base class for action views.
+
+    Action views redirect after performing their action, see
+    :meth:`set_url`. AJAX requests and requests accepting
+    ``application/json`` get a JSON response instead, with the
+    :meth:`relationship` of the current user with the other user after the
+    action::
+
+        {"relationship": {"friends": false, "request_sent": true, ...}}
+
+    Errors are returned as
+    ``{"error": {"code": ..., "message": ...}}`` with one of these codes:
+
+    ``throttled`` (status 429)
+        The rate of :attr:`throttle_scope` is exceeded.
+
+    ``self_action`` (status 400)
+        The other user is the current user.
+
+    ``not_found`` (status 404)
+        The other user, or the friendship request acted upon, doesn't exist.
     """
 
     http_method_names = ['get', 'post']
     permanent = False
 
+    throttle_scope = None
+    """
+    Key of ``FRIENDS_THROTTLE_RATES`` limiting how often a user can perform
+    this action. See :mod:`friends.throttling`.
+    """
+
     def action(request, user, *args, **kwargs):
         raise NotImplementedError("Subclasses must implement action()")
 
     def get(self, request, username, *args, **kwargs):
+        if self.throttled(request):
+            return self.error(request, 'throttled',
+                              ugettext(u'Too many requests, try again later.'),
+                              429)
         if request.user.username == username:
-            return HttpResponseBadRequest(
-                ugettext(u'You can\'t befriend yourself.'),
-            )
-        user = get_object_or_404(User, username=username)
-        self.action(request, user, *args, **kwargs)
+            return self.error(request, 'self_action',
+                              ugettext(u'You can\'t befriend yourself.'), 400)
+        try:
+            user = get_object_or_404(User, username=username)
+            self.action(request, user, *args, **kwargs)
+        except Http404:
+            if not self.wants_json(request):
+                raise
+            return self.error(request, 'not_found',
+                              ugettext(u'Not found.'), 404)
+        if self.wants_json(request):
+            return self.json_response({
+                'relationship': self.relationship(request.user, user),
+            })
         self.set_url(request, **kwargs)
         return super(BaseActionView, self).get(request, **kwargs)
 
+    def wants_json(self, request):
+        """
+        Indicate if ``request`` is answered with JSON instead of a redirect.
+
+        :rtype: |bool|
+        """
+        return request.is_ajax() or \
+            'application/json' in request.META.get('HTTP_ACCEPT', '')
+
+    def json_response(self, data, status=200):
+        return HttpResponse(json.dumps(data), status=status,
+                            content_type='application/json')
+
+    def error(self, request, code, message, status):
+        """
+        Return an error response, in JSON if :meth:`wants_json`.
+        """
+        if self.wants_json(request):
+            return self.json_response({
+                'error': {'code': code, 'message': message},
+            }, status)
+        return HttpResponse(message, status=status)
+
+    def relationship(self, user, other):
+        """
+        Return the relationship of ``user`` with ``other``, for JSON
+        responses.
+
+        :param user: Current user.
+        :type user: |User|
+        :param other: Other user.
+        :type other: |User|
+        :returns: |dict| with |bool| ``friends``, ``request_sent``,
+                  ``request_received``, ``blocked`` and ``blocked_by``
+                  items.
+        """
+        db = read_database(user)
+        requests = set(FriendshipRequest.objects.using(db).filter(
+            Q(from_user=user, to_user=other) |
+            Q(from_user=other, to_user=user),
+            accepted=False,
+        ).values_list('from_user', flat=True))
+        return {
+            'friends': Friendship.objects.are_friends(user, other),
+            'request_sent': user.pk in requests,
+            'request_received': other.pk in requests,
+            # Including the shared block lists, as enforced.
+            'blocked': UserBlocks.objects.is_blocked(user, other),
+            'blocked_by': UserBlocks.objects.is_blocked(other, user),
+        }
+
+    def throttled(self, request):
+        """
+        Indicate if ``request`` exceeds the rate of
+        :attr:`~BaseActionView.throttle_scope`.
+
+        Clients are identified by their user id, or their IP address if they
+        are not authenticated.
+
+        :rtype: |bool|
+        """
+        rate = THROTTLE_RATES.get(self.throttle_scope)
+        if rate is None:
+            return False
+        if request.user.is_authenticated():
+            ident = request.user.pk
+        else:
+            ident = request.META.get('REMOTE_ADDR')
+        return is_throttled(self.throttle_scope, ident, rate)
+
     def set_url(self, request, **kwargs):
         """
         Set the ``url`` attribute so that it can be used when
@@ -119,10 +247,12 @@ class BaseActionView(RedirectView):
 
 
 class FriendshipAcceptView(BaseActionView):
+    throttle_scope = 'accept'
+
     @transaction.commit_on_success
     def accept_friendship(self, from_user, to_user):
         get_object_or_404(
-            FriendshipRequest,
+            FriendshipRequest.objects.using(write_database(to_user)),
             from_user=from_user,
             to_user=to_user,
         ).accept()
@@ -132,53 +262,132 @@ class FriendshipAcceptView(BaseActionView):
 
 
 class FriendshipRequestView(FriendshipAcceptView):
-    @transaction.commit_on_success
+    throttle_scope = 'request'
+
     def action(self, request, user, **kwargs):
-        if Friendship.objects.are_friends(request.user, user):
-            raise RuntimeError(
-                '%r amd %r are already friends' % (request.user, user),
-            )
-        try:
-            # If there's a friendship request from the other user accept it.
-            self.accept_friendship(user, request.user)
-        except Http404:
-            request_message = request.REQUEST.get('message', u'')
-            # If we already have an active friendship request IntegrityError
-            # will be raised and the transaction will be rolled back.
-            FriendshipRequest.objects.create(
-                from_user=request.user,
-                to_user=user,
-                message=request_message,
-            )
+        # If there's a friendship request from the other user it is
+        # accepted instead.
+        FriendshipRequest.objects.request_friendship(
+            request.user,
+            user,
+            request.REQUEST.get('message', u''),
+        )
 
 
 class FriendshipDeclineView(BaseActionView):
+    throttle_scope = 'decline'
+
     def action(self, request, user, **kwargs):
-        get_object_or_404(FriendshipRequest,
+        get_object_or_404(FriendshipRequest.objects.using(
+                              write_database(request.user)),
                           from_user=user,
                           to_user=request.user).decline()
 
 
 class FriendshipCancelView(BaseActionView):
+    throttle_scope = 'cancel'
+
     def action(self, request, user, **kwargs):
-        get_object_or_404(FriendshipRequest,
+        get_object_or_404(FriendshipRequest.objects.using(
+                              write_database(request.user)),
                           from_user=request.user,
                           to_user=user).cancel()
 
 
 class FriendshipDeleteView(BaseActionView):
+    throttle_scope = 'delete'
+
     def action(self, request, user, **kwargs):
         Friendship.objects.unfriend(request.user, user)
 
 
 class UserBlockView(BaseActionView):
+    throttle_scope = 'block'
+
     def action(self, request, user, **kwargs):
-        request.user.user_blocks.blocks.add(user)
+        UserBlocks.objects.block(request.user, user)
 
 
 class UserUnblockView(BaseActionView):
+    throttle_scope = 'unblock'
+
     def action(self, request, user, **kwargs):
-        request.user.user_blocks.blocks.remove(user)
+        UserBlocks.objects.unblock(request.user, user)
+
+
+class FriendshipExportView(View):
+    """
+    Stream the current user's friends, friendship requests and blocks.
+
+    The ``format`` request parameter selects the output, either ``jsonl``
+    (default) or ``csv``. The response body is generated lazily, so any
+    middleware that consumes the content (such as ``GZipMiddleware``) will
+    defeat the streaming. The body is iterated after the request's database
+    connections were closed, see
+    :func:`~friends.export.export_records` for how it reads the rows.
+    """
+
+    http_method_names = ['get']
+    content_types = {
+        'jsonl': 'application/x-ndjson',
+        'csv': 'text/csv',
+    }
+
+    def get(self, request, *args, **kwargs):
+        format = request.GET.get('format', 'jsonl')
+        if format not in self.content_types:
+            return HttpResponseBadRequest(
+                ugettext(u'Unknown export format.'),
+            )
+        response = HttpResponse(
+            export_relationships(request.user, format),
+            content_type=self.content_types[format],
+        )
+        response['Content-Disposition'] = \
+            'attachment; filename=friends.%s' % format
+        return response
+
+
+class FriendSearchView(View):
+    """
+    Search the current user's friends by username prefix, for typeahead
+    widgets.
+
+    The prefix is given with the ``q`` request parameter and the maximum
+    number of results with ``limit``. The response is a JSON object with a
+    ``results`` list, see
+    :meth:`~friends.models.FriendshipManager.search_friends`.
+    """
+
+    http_method_names = ['get']
+
+    def get(self, request, *args, **kwargs):
+        prefix = request.GET.get('q', u'').strip()
+        try:
+            limit = min(int(request.GET.get('limit', 10)), SEARCH_MAX_RESULTS)
+        except ValueError:
+            return HttpResponseBadRequest(ugettext(u'Invalid limit.'))
+        results = []
+        if prefix and limit > 0:
+            results = Friendship.objects.search_friends(request.user, prefix,
+                                                        limit)
+        return HttpResponse(json.dumps({'results': results}),
+                            content_type='application/json')
+
+
+class FriendshipSyncView(View):
+    """
+    Return the changes to the current user's friends, pending friendship
+    requests and blocks since the sync given by the ``token`` request
+    parameter as JSON, see :mod:`friends.sync`.
+    """
+
+    http_method_names = ['get']
+
+    def get(self, request, *args, **kwargs):
+        result = sync_relationships(request.user, request.GET.get('token'))
+        return HttpResponse(json.dumps(result),
+                            content_type='application/json')
 
 
 friendship_request = login_required(FriendshipRequestView.as_view())
@@ -188,3 +397,6 @@ friendship_cancel = login_required(FriendshipCancelView.as_view())
 friendship_delete = login_required(FriendshipDeleteView.as_view())
 user_block = login_required(UserBlockView.as_view())
 user_unblock = login_required(UserUnblockView.as_view())
+friendship_export = login_required(FriendshipExportView.as_view())
+friend_search = login_required(FriendSearchView.as_view())
+friendship_sync = login_required(FriendshipSyncView.as_view())
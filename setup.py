@@ -26,9 +26,11 @@ setup(
     author=__maintainer__,
     author_email=__email__,
     license=license_text,
-    packages=['friends', 'friends.templatetags'],
+    packages=['friends', 'friends.management',
+              'friends.management.commands', 'friends.templatetags'],
     package_data={
-        'friends': ['fixtures/*.json', 'locale/*/LC_MESSAGES/django.*'],
+        'friends': ['fixtures/*.json', 'locale/*/LC_MESSAGES/django.*',
+                    'sql/*.sql'],
     },
     data_files=[('', ['LICENSE.txt', 'README.rst'])],
     description='Like django-friends, but simpler',